@@ -167,9 +167,13 @@ class test_library_rpc_server(Process):
         if not test_lib:
             return
 
+        redirect = None
         while True:
+            host, port = redirect or (self.host, self.port)
+            # fall back to the configured server if the redirected one is gone
+            redirect = None
             try:
-                async with websockets.connect(f'ws://{self.host}:{self.port}/api_v1/rpc_proxy/rpc') as rpc_ws, websockets.connect(f'ws://{self.host}:{self.port}/api_v1/rpc_proxy/msg') as msg_ws:
+                async with websockets.connect(f'ws://{host}:{port}/api_v1/rpc_proxy/rpc') as rpc_ws, websockets.connect(f'ws://{host}:{port}/api_v1/rpc_proxy/msg') as msg_ws:
                     await rpc_ws.send(json.dumps({
                                    'join_id': self.config['join_id'],
                                    'uid': self.config['uuid'],
@@ -192,6 +196,11 @@ class test_library_rpc_server(Process):
                             await SecureWebsocketRPC(rpc_ws, AsyncRemoteLibrary(testlib, rpc_ws, msg_ws, self.task_id, self.debug), method_prefix='').run()
                         except ConnectionClosedError:
                             print('Websocket closed')
+                    elif ret.startswith('Redirect '):
+                        # the endpoint is owned by another task runner
+                        redirect = ret[len('Redirect '):].rsplit(':', 1)
+                        print('Redirected to the task runner at ' + ':'.join(redirect))
+                        continue
                     elif ret == 'Unauthorized':
                         print('This endpoint is unauthorized, please authorize it on the WEB admin page')
                         await asyncio.sleep(10)
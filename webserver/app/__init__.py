@@ -13,6 +13,7 @@ from sanic_cors import CORS
 from simple_bcrypt import Bcrypt
 
 from app.main.config import get_config
+from app.main.util.messagebus import get_client_manager
 
 development = True if (os.getenv('BOILERPLATE_ENV') or 'dev') == 'dev' else False
 
@@ -21,33 +22,51 @@ app.blueprint(swagger_blueprint)
 app.config.from_object(get_config())
 bcrypt = Bcrypt(app)
 
+client_manager = get_client_manager(app.config)
 if development:
     # CORS(app)
     # app.config['CORS_SUPPORTS_CREDENTIALS'] = True
-    sio = socketio.AsyncServer(async_mode='sanic', cors_allowed_origins='*')
+    sio = socketio.AsyncServer(async_mode='sanic', cors_allowed_origins='*', client_manager=client_manager)
 else:
-    sio = socketio.AsyncServer(async_mode='sanic')
+    sio = socketio.AsyncServer(async_mode='sanic', client_manager=client_manager)
 sio.attach(app)
 
 limits = ['20000 per hour', '200000 per day'] if development else ['200 per hour', '2000 per day']
 limiter = Limiter(app, global_limits=limits, key_func=get_remote_address)
 event_task = None
 heartbeat_task = None
+lease_task = None
+archive_task = None
+cleanup_task = None
 rpc_server = None
 db_client = None
 
 @app.listener('before_server_start')
 async def setup_connection(app, loop):
-    global event_task, heartbeat_task, rpc_server, db_client
+    global event_task, heartbeat_task, lease_task, archive_task, cleanup_task, rpc_server, db_client
 
     db_client = motor.motor_asyncio.AsyncIOMotorClient(f"{app.config['MONGODB_URL']}:{app.config['MONGODB_PORT']}")
     app.config.db = db_client[app.config['MONGODB_DATABASE']]
 
-    from task_runner.runner import initialize_runner, start_event_thread, start_heartbeat_thread, start_xmlrpc_server
-    event_task = asyncio.create_task(start_event_thread(app))
-    heartbeat_task = asyncio.create_task(start_heartbeat_thread(app))
-    rpc_server = start_xmlrpc_server(app)
-    initialize_runner(app)
+    from app.main.model.database import ensure_indexes
+    await ensure_indexes()
+
+    from task_runner.runner import bp as rpc_bp
+    if app.config.ROLE != 'web':
+        from task_runner.runner import initialize_runner, start_archive_thread, start_cleanup_thread, start_event_thread, start_heartbeat_thread, start_lease_thread, start_xmlrpc_server
+        initialize_runner(app)
+        event_task = asyncio.create_task(start_event_thread(app))
+        heartbeat_task = asyncio.create_task(start_heartbeat_thread(app))
+        lease_task = asyncio.create_task(start_lease_thread(app))
+        if app.config.ARCHIVE_AFTER_DAYS > 0:
+            archive_task = asyncio.create_task(start_archive_thread(app))
+        if app.config.UPLOAD_EXPIRE_DAYS > 0 or app.config.TARBALL_CACHE_TTL > 0:
+            cleanup_task = asyncio.create_task(start_cleanup_thread(app))
+        rpc_server = start_xmlrpc_server(app)
+    if app.config.ROLE == 'runner':
+        # the task runner instance only serves the endpoints
+        app.blueprint(Blueprint.group(rpc_bp, url_prefix='/api_v1'))
+        return
 
     from app.main.controller.auth_controller import bp as auth_bp
     from app.main.controller.user_controller import bp as user_bp
@@ -58,16 +77,18 @@ async def setup_connection(app, loop):
     from app.main.controller.script_controller import bp as script_bp
     from app.main.controller.teststore_controller import bp as teststore_bp
     from app.main.controller.task_controller import bp as task_bp
+    from app.main.controller.pipeline_controller import bp as pipeline_bp
     from app.main.controller.taskresource_controller import bp as taskresource_bp
     from app.main.controller.test_controller import bp as test_bp
     from app.main.controller.testresult_controller import bp as testresult_bp
     from app.main.controller.document_controller import bp as document_bp
     from app.main.controller.socketio_controller import handle_message, handle_join_room, handle_enter_room, handle_leave_room
-    from task_runner.runner import bp as rpc_bp
 
     limiter.limit("100 per hour")(user_bp)
 
-    bp_groups = (auth_bp, user_bp, organization_bp, team_bp, endpoint_bp, setting_bp, rpc_bp, script_bp, teststore_bp, task_bp, taskresource_bp, test_bp, testresult_bp, document_bp)
+    bp_groups = (auth_bp, user_bp, organization_bp, team_bp, endpoint_bp, setting_bp, script_bp, teststore_bp, task_bp, pipeline_bp, taskresource_bp, test_bp, testresult_bp, document_bp)
+    if app.config.ROLE != 'web':
+        bp_groups += (rpc_bp,)
     api_v1 = Blueprint.group(*bp_groups, url_prefix='/api_v1')
     app.blueprint(api_v1)
 
@@ -82,10 +103,16 @@ async def wait_tasks_ready(app, loop):
 
 @app.listener('before_server_stop')
 async def cleanup(app, loop):
-    global event_task, heartbeat_task, rpc_server, db_client
-    event_task.cancel()
-    heartbeat_task.cancel()
-    rpc_server.server.stop()
+    global event_task, heartbeat_task, lease_task, archive_task, cleanup_task, rpc_server, db_client
+    if app.config.ROLE != 'web':
+        event_task.cancel()
+        heartbeat_task.cancel()
+        lease_task.cancel()
+        if archive_task:
+            archive_task.cancel()
+        if cleanup_task:
+            cleanup_task.cancel()
+        rpc_server.server.stop()
     db_client.close()
 
 
@@ -103,7 +130,12 @@ async def close_connection(app, loop):
     pass
 
 def run():
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    workers = app.config.WORKERS
+    if workers > 1 and (app.config.ROLE != 'web' or app.config.SOCKETIO_BUS != 'mongo'):
+        # the task runner must run standalone and the socket.io emits must reach the clients of every worker
+        logger.warning('Multiple workers need EMBER_ROLE=web and SOCKETIO_BUS=mongo, run with one worker')
+        workers = 1
+    app.run(host='0.0.0.0', port=app.config.PORT, debug=True, workers=workers)
 
 def test():
     """Runs the unit tests."""
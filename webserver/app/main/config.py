@@ -14,6 +14,34 @@ class Config:
     SSL_DISABLE = False
     SQLALCHEMY_RECORD_QUERIES = True
     DEBUG = False
+    UPLOAD_MAX_SIZE = 4 * 1024 * 1024 * 1024    # upper limit of a streamed upload request body in bytes
+    REQUEST_MAX_SIZE = UPLOAD_MAX_SIZE  # sanic rejects any request body larger than it before the streamed handlers see it
+    TASK_SCHEDULING_POLICY = os.getenv('TASK_SCHEDULING_POLICY', 'fifo')    # fifo or sej (shortest expected job first) within a priority
+    TASK_SCHEDULING_MAX_WAIT = 3600     # seconds a task can wait before it's taken in FIFO order regardless of the policy
+    TASK_PRIORITY_AGING = 1     # priority levels a waiting task gains per hour, 0 to disable aging
+    FAIR_SHARE = True   # share an endpoint registered by several organizations or teams by the weights of the organizations
+    FAIR_SHARE_HALF_LIFE = 24 * 3600    # seconds for the usage of an endpoint to decay by half
+    ROLE = os.getenv('EMBER_ROLE', 'all')   # all, web for the API only or runner for the task runner only
+    RUNNER_ID = os.getenv('RUNNER_ID', '')  # unique among the task runner instances, stable across restarts, default to RUNNER_URL or host:PORT
+    RUNNER_URL = os.getenv('RUNNER_URL', '')    # host:port of this task runner instance for the endpoints to connect
+    RUNNER_LEASE_TTL = 30   # seconds for the lease on an endpoint to expire without being renewed
+    RUNNER_XMLRPC_PORT = int(os.getenv('RUNNER_XMLRPC_PORT', '8270'))
+    EVENT_WORKERS = int(os.getenv('EVENT_WORKERS', '8'))   # events processed concurrently, those of the same endpoint or task in order
+    EVENT_CLAIM_TIMEOUT = 300   # seconds for an event claimed but not acknowledged to be requeued
+    PAGINATION_TOTAL_TTL = 30   # seconds to cache the total of a listing query when it's requested as cached
+    RESULT_LAYOUT = os.getenv('RESULT_LAYOUT', 'sharded')   # sharded for test_results/<year>/<month>/<hash>/<task id>, flat for test_results/<task id>
+    ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', '0'))    # days for the finished tasks to be archived, 0 to keep them, enable it on one task runner instance
+    ARCHIVE_DUTY_CYCLE = 0.2    # share of the time the archive compactor may be busy
+    ARCHIVE_INTERVAL = 3600     # seconds between the archive rounds once nothing is left to archive
+    UPLOAD_EXPIRE_DAYS = int(os.getenv('UPLOAD_EXPIRE_DAYS', '30'))   # days for the upload directories no unfinished task uses to be removed, 0 to keep them
+    TARBALL_CACHE_TTL = 7 * 24 * 3600   # seconds for a cached resource tarball not requested to be evicted, 0 to keep them
+    PARTIAL_UPLOAD_TTL = 24 * 3600   # seconds for a chunked or multipart upload not written to be removed, 0 to keep them
+    CLEANUP_INTERVAL = 3600     # seconds between the rounds of removing the expired upload directories and tarballs
+    PORT = int(os.getenv('PORT', '5000'))
+    WORKERS = int(os.getenv('WORKERS', '1'))    # processes of the web API, more than one needs the web role and the mongo socket.io bus
+    SOCKETIO_BUS = os.getenv('SOCKETIO_BUS', '')    # mongo or memory to share the socket.io emits among servers, empty for a single process
+    SOCKETIO_BUS_SIZE = 16 * 1024 * 1024    # bytes of the capped collection of the mongo socket.io bus
+    RATELIMIT_ENABLED = os.getenv('RATELIMIT_ENABLED', '1') != '0'
 
 
 class DevelopmentConfig(Config):
@@ -1,4 +1,5 @@
 import asyncio
+import datetime
 import random
 import urllib.parse
 import uuid
@@ -10,17 +11,19 @@ from sanic.views import HTTPMethodView
 from sanic.response import json
 from sanic_openapi import doc
 from task_runner.runner import check_endpoint
+from task_runner.util.durations import estimate_queue
 
 from ..model.database import (EVENT_CODE_CANCEL_TASK, EVENT_CODE_START_TASK, QUEUE_PRIORITY,
                               QUEUE_PRIORITY_DEFAULT, QUEUE_PRIORITY_MAX,
-                              QUEUE_PRIORITY_MIN, Endpoint, Task, TaskQueue,
-                              Test)
+                              QUEUE_PRIORITY_MIN, Endpoint, FairShareUsage, Task,
+                              TaskQueue, Test)
 from ..util import js2python_bool
 from ..util.eventqueue import push_event
 from ..util.decorator import (organization_team_required_by_args,
                               organization_team_required_by_json,
                               token_required)
 from ..util.dto import EndpointDto, json_response, organization_team
+from ..util.pagination import TOTAL_MODES, count, paginate
 from ..util.response import response_message, EACCES, SUCCESS, EINVAL, EPERM, ENOENT
 
 _endpoint_query = EndpointDto.endpoint_query
@@ -30,6 +33,7 @@ _endpoint = EndpointDto.endpoint
 _queuing_task_list = EndpointDto.queuing_task_list
 _queuing_task = EndpointDto.queuing_task_list._queuing_task_list._queuing_tasks._queuing_task
 _endpoint_online_check = EndpointDto.endpoint_online_check
+_fair_share_list = EndpointDto.fair_share_list
 
 bp = Blueprint('endpoint', url_prefix='/endpoint')
 
@@ -46,6 +50,8 @@ class EndpointView(HTTPMethodView):
         title = request.args.get('title', default=None)
         forbidden = request.args.get('forbidden', default=False)
         unauthorized = request.args.get('unauthorized', default=False)
+        cursor = request.args.get('cursor', default=None)
+        total = request.args.get('total', default='none' if cursor else 'exact')
 
         forbidden = js2python_bool(forbidden)
         unauthorized = js2python_bool(unauthorized)
@@ -71,8 +77,15 @@ class EndpointView(HTTPMethodView):
             if unauthorized:
                 query['status'] = 'Unauthorized'
 
+        if total not in TOTAL_MODES:
+            return json(response_message(EINVAL, 'Field total should be one of {}'.format(', '.join(TOTAL_MODES))))
+
         ret = []
-        async for ep in Endpoint.find(query).skip((page - 1) * limit).limit(limit):
+        try:
+            endpoints, next_cursor = await paginate(Endpoint, query, None, limit, cursor, 0 if cursor else (page - 1) * limit)
+        except ValueError as e:
+            return json(response_message(EINVAL, str(e)))
+        for ep in endpoints:
             tests = []
             test_refs = []
             if ep.tests:
@@ -92,7 +105,7 @@ class EndpointView(HTTPMethodView):
                 'test_refs': test_refs,
                 'endpoint_uid': str(ep.uid)
             })
-        return json(response_message(SUCCESS, endpoints=ret, total=await Endpoint.count_documents(query)))
+        return json(response_message(SUCCESS, endpoints=ret, total=await count(Endpoint, query, total), next_cursor=next_cursor))
 
     @doc.summary('Delete the test endpoint with the specified endpoint uid')
     @doc.consumes(doc.String(name='X-Token'), location='header')
@@ -205,8 +218,14 @@ class EndpointQueueView(HTTPMethodView):
             query['endpoint'] = endpoint.pk
 
         ret = []
+        estimates = {}
         async for taskqueue in TaskQueue.find(query):
             endpoint = await taskqueue.endpoint.fetch()
+            if endpoint.pk not in estimates:
+                estimates[endpoint.pk] = await estimate_queue(endpoint, organization, team,
+                                                              request.app.config.TASK_SCHEDULING_POLICY,
+                                                              request.app.config.TASK_SCHEDULING_MAX_WAIT)
+            estimate = estimates[endpoint.pk]
             taskqueue_stat = ({
                 'endpoint': endpoint.name,
                 'priority': taskqueue.priority,
@@ -224,7 +243,9 @@ class EndpointQueueView(HTTPMethodView):
                         'priority': taskqueue.priority,
                         'task': running_task.test_suite,
                         'task_id': str(running_task.pk),
-                        'status': 'Running'
+                        'status': 'Running',
+                        'expected_duration': estimate.get(str(running_task.pk), (None, None))[0],
+                        'eta': estimate.get(str(running_task.pk), (None, None))[1]
                     })
             if taskqueue.tasks:
                 for t in taskqueue.tasks:
@@ -234,7 +255,9 @@ class EndpointQueueView(HTTPMethodView):
                         'priority': task.priority,
                         'task': task.test_suite,
                         'task_id': str(task.pk),
-                        'status': 'Waiting'})
+                        'status': 'Waiting',
+                        'expected_duration': estimate.get(str(task.pk), (None, None))[0],
+                        'eta': estimate.get(str(task.pk), (None, None))[1]})
             ret.append(taskqueue_stat)
         return json(response_message(SUCCESS, task_queues=ret))
 
@@ -310,7 +333,12 @@ async def handler(request):
     if endpoint_uid is None:
         return json(response_message(EINVAL, 'Field endpoint_uid is required'))
 
-    ret = await check_endpoint(request.app, uuid.UUID(endpoint_uid), organization, team)
+    if request.app.config.ROLE == 'web':
+        # the endpoints are connected to the task runner instances which keep the status up to date
+        endpoint = await Endpoint.find_one({'uid': uuid.UUID(endpoint_uid), 'organization': organization.pk, 'team': team.pk if team else None})
+        ret = endpoint and endpoint.status == 'Online'
+    else:
+        ret = await check_endpoint(request.app, uuid.UUID(endpoint_uid), organization, team)
     if not ret:
         return json(response_message(SUCCESS, 'Endpoint offline', status=False))
     else:
@@ -402,5 +430,33 @@ async def handler(request):
 
     return json(response_message(SUCCESS, 'Config is not implemented'))
 
+@bp.get('/fair_share')
+@doc.summary('get the usage and queue waiting time of the endpoints shared with other organizations or teams')
+@doc.consumes(doc.String(name='X-Token'), location='header')
+@doc.consumes(organization_team)
+@doc.produces(_fair_share_list)
+@token_required
+@organization_team_required_by_args
+async def handler(request):
+    organization = request.ctx.organization
+    team = request.ctx.team
+
+    now = datetime.datetime.utcnow()
+    half_life = request.app.config.FAIR_SHARE_HALF_LIFE
+    ret = []
+    async for share in FairShareUsage.find({'organization': organization.pk, 'team': team.pk if team else None}):
+        # the usage recorded before the waits were counted has a wait for every task
+        waits = share.waits or share.tasks
+        usage = share.usage * 0.5 ** ((now - share.update_date).total_seconds() / half_life) if share.update_date else 0
+        ret.append({
+            'endpoint_uid': str(share.endpoint_uid),
+            'weight': organization.share_weight or 1,
+            'usage': usage,
+            'tasks': share.tasks,
+            'wait_mean': share.wait_total / waits if waits else 0,
+            'wait_max': share.wait_max
+        })
+    return json(response_message(SUCCESS, shares=ret))
+
 bp.add_route(EndpointView.as_view(), '/')
 bp.add_route(EndpointQueueView.as_view(), '/queue')
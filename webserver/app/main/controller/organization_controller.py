@@ -10,7 +10,8 @@ from sanic.views import HTTPMethodView
 from async_files.utils import async_wraps
 
 from ..util import async_rmtree
-from ..util.decorator import token_required
+from ..util.decorator import admin_token_required, token_required
+from ..util.get_path import invalidate_users_root
 from ..model.database import Organization, Team, User, Test, Task, TaskQueue, TestResult
 
 from ..service.auth_helper import Auth
@@ -28,6 +29,7 @@ _organization_id = OrganizationDto.organization_id
 _organization_team_list = OrganizationDto.organization_team_list
 _transfer_ownership = OrganizationDto.transfer_ownership
 _organization_avatar = OrganizationDto.organization_avatar
+_share_weight = OrganizationDto.share_weight
 
 
 bp = Blueprint('organization', url_prefix='/organization')
@@ -151,6 +153,7 @@ class OrganizationView(HTTPMethodView):
             await team.delete()
 
         await organization.delete()
+        invalidate_users_root(organization=organization)
 
         return json(response_message(SUCCESS))
 
@@ -440,3 +443,30 @@ async def handler(request):
     return json(response_message(SUCCESS))
 
 bp.add_route(OrganizationView.as_view(), '/')
+
+@bp.post('/share_weight')
+@doc.summary('set the weight of an organization sharing the endpoints with others')
+@doc.description('Only the administrator could perform this operation')
+@doc.consumes(doc.String(name='X-Token'), location='header')
+@doc.consumes(_share_weight, location='body')
+@doc.produces(json_response)
+@admin_token_required
+async def handler(request):
+    organization_id = request.json.get('organization_id', None)
+    if not organization_id:
+        return json(response_message(EINVAL, 'Field organization_id is required'))
+
+    organization = await Organization.find_one({'_id': ObjectId(organization_id)})
+    if not organization:
+        return json(response_message(ENOENT, 'Organization not found'))
+
+    try:
+        weight = float(request.json.get('weight', 1))
+    except (TypeError, ValueError):
+        return json(response_message(EINVAL, 'Field weight should be a number'))
+    if weight <= 0:
+        return json(response_message(EINVAL, 'Field weight should be positive'))
+
+    organization.share_weight = weight
+    await organization.commit()
+    return json(response_message(SUCCESS))
@@ -0,0 +1,150 @@
+import datetime
+
+from bson import ObjectId
+from sanic import Blueprint
+from sanic.views import HTTPMethodView
+from sanic.response import json
+from sanic_openapi import doc
+from task_runner.util.pipeline import NODE_CONDITIONS, advance_pipeline, sort_nodes
+
+from ..util.decorator import token_required, organization_team_required_by_args, organization_team_required_by_json
+from ..util.eventqueue import push_event
+from ..model.database import Pipeline, Task, EVENT_CODE_CANCEL_TASK
+from ..util.dto import PipelineDto, json_response
+from ..service.task_service import prepare_tasks
+from ..util.response import response_message, EINVAL, ENOENT, SUCCESS, EPERM
+
+_pipeline = PipelineDto.pipeline
+_pipeline_id = PipelineDto.pipeline_id
+_pipeline_info = PipelineDto.pipeline_info
+
+bp = Blueprint('pipeline', url_prefix='/pipeline')
+
+async def get_pipeline(data, organization, team):
+    pipeline_id = data.get('pipeline_id', None)
+    if not pipeline_id or not ObjectId.is_valid(pipeline_id):
+        return response_message(EINVAL, 'Field pipeline_id is required'), None
+    pipeline = await Pipeline.find_one({'_id': ObjectId(pipeline_id)})
+    if not pipeline:
+        return response_message(ENOENT, 'Pipeline not found'), None
+    if pipeline.organization != organization or pipeline.team != team:
+        return response_message(EPERM, 'Accessing resources that not belong to you is not allowed'), None
+    return None, pipeline
+
+class PipelineView(HTTPMethodView):
+    @doc.summary('Get the status of a pipeline')
+    @doc.consumes(doc.String(name='X-Token'), location='header')
+    @doc.consumes(_pipeline_id)
+    @doc.produces(_pipeline_info)
+    @token_required
+    @organization_team_required_by_args
+    async def get(self, request):
+        err, pipeline = await get_pipeline(request.ctx.data, request.ctx.organization, request.ctx.team)
+        if err:
+            return json(err)
+
+        nodes = [{
+            'name': n['name'],
+            'depends_on': n['depends_on'],
+            'condition': n['condition'],
+            'status': n['status'],
+            'tasks': [str(t) for t in n['tasks']],
+            **({'error': n['error']} if 'error' in n else {})
+        } for n in pipeline.nodes]
+        return json(response_message(SUCCESS, pipeline_id=str(pipeline.pk), name=pipeline.name, status=pipeline.status,
+                                     create_date=pipeline.create_date.timestamp() * 1000, nodes=nodes))
+
+    @doc.summary('Create a pipeline of tasks')
+    @doc.description('A node is scheduled once all of the nodes it depends on have finished and its condition holds, otherwise it is skipped. \
+        Nodes without dependencies are scheduled right away, nodes of no dependencies between each other run in parallel.')
+    @doc.consumes(doc.String(name='X-Token'), location='header')
+    @doc.consumes(_pipeline, location='body')
+    @doc.produces(_pipeline_info)
+    @token_required
+    @organization_team_required_by_json
+    async def post(self, request):
+        organization = request.ctx.organization
+        team = request.ctx.team
+        user = request.ctx.user
+
+        items = request.json.get('nodes', None)
+        if not items or not isinstance(items, list):
+            return json(response_message(EINVAL, 'Field nodes should be a non-empty list'))
+
+        nodes = []
+        for i, data in enumerate(items):
+            if not isinstance(data, dict) or not data.get('name', None):
+                return json(response_message(EINVAL, 'nodes[{}]: Field name is required'.format(i)))
+            depends_on = data.get('depends_on', [])
+            if not isinstance(depends_on, list):
+                return json(response_message(EINVAL, 'nodes[{}]: Field depends_on should be a list'.format(i)))
+            condition = data.get('condition', 'success')
+            if condition not in NODE_CONDITIONS:
+                return json(response_message(EINVAL, 'nodes[{}]: Condition should be one of {}'.format(i, ', '.join(NODE_CONDITIONS))))
+            if not isinstance(data.get('task', None), dict):
+                return json(response_message(EINVAL, 'nodes[{}]: Field task is required'.format(i)))
+            nodes.append({
+                'name': str(data['name']),
+                'depends_on': [str(d) for d in depends_on],
+                'condition': condition,
+                'task': data['task'],
+                'status': 'pending',
+                'tasks': []
+            })
+
+        names = {n['name'] for n in nodes}
+        if len(names) != len(nodes):
+            return json(response_message(EINVAL, 'Node names should be unique'))
+        for n in nodes:
+            if any(d not in names for d in n['depends_on']):
+                return json(response_message(EINVAL, 'Node {} depends on an unknown node'.format(n['name'])))
+        if sort_nodes(nodes) is None:
+            return json(response_message(EINVAL, 'Nodes should not depend on each other in a cycle'))
+
+        # validate the tasks of all nodes upfront rather than failing halfway
+        err, _ = await prepare_tasks([n['task'] for n in nodes], organization, team, user)
+        if err:
+            return json(err)
+
+        pipeline = Pipeline(name=request.json.get('name', ''), nodes=nodes, creator=user, organization=organization)
+        if team:
+            pipeline.team = team
+        await pipeline.commit()
+        await advance_pipeline(pipeline.pk)
+        return json(response_message(SUCCESS, pipeline_id=str(pipeline.pk)))
+
+    @doc.summary('Cancel a pipeline')
+    @doc.description('The pending nodes are skipped and the tasks of the running nodes are cancelled')
+    @doc.consumes(doc.String(name='X-Token'), location='header')
+    @doc.consumes(_pipeline_id, location='body')
+    @doc.produces(json_response)
+    @token_required
+    @organization_team_required_by_json
+    async def delete(self, request):
+        organization = request.ctx.organization
+        team = request.ctx.team
+
+        err, pipeline = await get_pipeline(request.ctx.data, organization, team)
+        if err:
+            return json(err)
+        ret = await Pipeline.collection.update_one({'_id': pipeline.pk, 'status': 'running'},
+                                                   {'$set': {'status': 'cancelled', 'update_date': datetime.datetime.utcnow()}})
+        if ret.modified_count == 0:
+            return json(response_message(EINVAL, 'Pipeline has finished'))
+
+        for i, node in enumerate(pipeline.nodes):
+            if node['status'] == 'pending':
+                await Pipeline.collection.update_one({'_id': pipeline.pk, f'nodes.{i}.status': 'pending'}, {'$set': {f'nodes.{i}.status': 'skipped'}})
+        async for task in Task.find({'pipeline': pipeline.pk, 'status': {'$in': ['waiting', 'running']}}):
+            endpoint = await task.endpoint_run.fetch() if task.endpoint_run else None
+            message = {
+                'endpoint_uid': endpoint.uid if endpoint else '',
+                'priority': task.priority,
+                'task_id': str(task.pk)
+            }
+            ret = await push_event(organization=organization, team=team, code=EVENT_CODE_CANCEL_TASK, message=message)
+            if not ret:
+                return json(response_message(EPERM, 'Pushing the event to event queue failed'))
+        return json(response_message(SUCCESS))
+
+bp.add_route(PipelineView.as_view(), '/')
@@ -1,30 +1,57 @@
 import asyncio
+from bson import ObjectId
 from task_runner.runner import ROOM_MESSAGES
-from app import sio
+from app import app, sio
 from marshmallow.exceptions import ValidationError
 
 from ..service.auth_helper import Auth
-from ..util import get_room_id_by_json
-from ..model.database import Organization, Team, Task, Endpoint
+from ..util import get_room_id, get_room_id_by_json, get_task_room_id
+from ..model.database import Organization, Team, Task, TaskLog, Endpoint
 
 def handle_message(sid, message):
     print(message, sid)
 
+async def enter_task_room(sid, org_team, task_id):
+    """
+    Subscribe the client to the console output of the task, the backlog is sent to the client only
+    """
+    if not ObjectId.is_valid(task_id):
+        return
+    task = await Task.find_one({'_id': ObjectId(task_id)})
+    if not task or get_room_id(str(task.organization.pk), str(task.team.pk) if task.team else '') != org_team:
+        return
+    sio.enter_room(sid, get_task_room_id(task_id))
+
+    backlog = await get_log_backlog(org_team, task)
+    if backlog:
+        await sio.emit('backlog', {'task_id': task_id, 'message': backlog}, room=sid)
+
+async def get_log_backlog(org_team, task):
+    """
+    The console output of a running task so far, a web worker reads the chunks saved by the standalone
+    task runner as it doesn't share the memory of the runner
+    """
+    if app.config.ROLE == 'web':
+        chunks = await TaskLog.collection.find({'task': task.pk}, {'message': 1}).sort('_id', 1).to_list(None)
+        return ''.join(c['message'] for c in chunks)
+    task_id = str(task.pk)
+    if org_team in ROOM_MESSAGES and task_id in ROOM_MESSAGES[org_team] and ROOM_MESSAGES[org_team][task_id]:
+        return ROOM_MESSAGES[org_team][task_id].getvalue()
+    return ''
+
 async def handle_join_room(sid, json):
     if 'X-Token' not in json:
         return
     if not await Auth.is_user_authenticated(json['X-Token']):
         return
 
+    # the summary events of the tasks are sent to the room of the organization or team
     org_team = get_room_id_by_json(json)
     sio.enter_room(sid, org_team)
 
     if 'task_id' not in json:
         return
-    task_id = json['task_id']
-
-    if org_team in ROOM_MESSAGES and task_id in ROOM_MESSAGES[org_team] and ROOM_MESSAGES[org_team][task_id]:
-        await sio.emit('backlog', {'task_id': task_id, 'message': ROOM_MESSAGES[org_team][task_id].getvalue()}, room=org_team)
+    await enter_task_room(sid, org_team, json['task_id'])
 
 async def handle_enter_room(sid, json):
     if 'task_id' not in json:
@@ -35,14 +62,15 @@ async def handle_enter_room(sid, json):
         return
 
     org_team = get_room_id_by_json(json)
-
-    task_id = json['task_id']
-    if org_team in ROOM_MESSAGES and task_id in ROOM_MESSAGES[org_team] and ROOM_MESSAGES[org_team][task_id]:
-        await sio.emit('backlog', {'task_id': task_id, 'message': ROOM_MESSAGES[org_team][task_id].getvalue()}, room=org_team)
+    await enter_task_room(sid, org_team, json['task_id'])
 
 async def handle_leave_room(sid, json):
     if 'X-Token' not in json:
         return
     if await Auth.is_user_authenticated(json['X-Token']):
+        if 'task_id' in json:
+            # stop viewing the task only
+            sio.leave_room(sid, get_task_room_id(json['task_id']))
+            return
         org_team = get_room_id_by_json(json)
         sio.leave_room(sid, org_team)
@@ -1,7 +1,9 @@
 import aiofiles
 import os
+from mimetypes import guess_type
 import uuid
 from async_files.utils import async_wraps
+from bson.objectid import ObjectId
 from pathlib import Path
 from datetime import date, datetime, timedelta
 
@@ -11,12 +13,19 @@ from sanic.views import HTTPMethodView
 from sanic.response import json, file, html
 from sanic_openapi import doc
 from marshmallow.exceptions import ValidationError
-
-from ..util.decorator import token_required, organization_team_required_by_args, organization_team_required_by_json, task_required
-from ..util.get_path import get_test_result_path
-from ..util import js2python_bool, async_exists
+from task_runner.util.archive import get_result_archive_path, list_archived_files, open_archived_file
+from task_runner.util.durations import estimate_drain_times, select_endpoint
+from task_runner.util.rerun import get_failed_test_cases
+from task_runner.util.shard import split_test_suite
+
+from ..util.decorator import token_required, organization_team_required_by_args, organization_team_required_by_json, task_required, task_or_archive_required
+from ..util.blobstore import link_files, remove_files
+from ..util.get_path import get_task_resource_root, get_test_result_path, is_path_secure, UPLOAD_ROOT
+from ..util import js2python_bool, async_exists, async_isfile
+from ..util.fileserve import serve_file, serve_file_object
 from ..util.eventqueue import push_event
 from ..util.tarball import path_to_dict
+from ..service.task_service import prepare_tasks, schedule_tasks
 from ..model.database import Task, Test, Endpoint, TaskQueue, EVENT_CODE_CANCEL_TASK, EVENT_CODE_START_TASK, QUEUE_PRIORITY_DEFAULT, QUEUE_PRIORITY_MAX, QUEUE_PRIORITY_MIN
 from ..util.dto import TaskDto, json_response, organization_team
 from ..config import get_config
@@ -29,10 +38,48 @@ _task_id = TaskDto.task_id
 _task_result_files = TaskDto.task_result_files
 _task_update = TaskDto.task_update
 _task_cancel = TaskDto.task_cancel
+_task_rerun = TaskDto.task_rerun
+_task_bulk = TaskDto.task_bulk
 _task_stat_list = TaskDto.task_stat_list
 
 bp = Blueprint('task', url_prefix='/task')
 
+def get_endpoint_query(uid, organization, team):
+    """
+    An endpoint uid can be registered by several organizations or teams, it's looked up in the scope of the request
+    """
+    return {'uid': uid, 'organization': organization.pk, 'team': team.pk if team else None}
+
+async def find_endpoints(uids, organization, team):
+    """
+    The endpoints of the organization and team by the uids in the same order, those not found are dropped
+    """
+    endpoints = {}
+    async for e in Endpoint.find(get_endpoint_query({'$in': list(uids)}, organization, team)):
+        endpoints[e.uid] = e
+    return [endpoints[uid] for uid in uids if uid in endpoints]
+
+async def enqueue_task(task, endpoint, organization, team):
+    """
+    Push the task to the queue of its priority on the endpoint and notify the task runner,
+    return the error response or None, and whether the queue was idle so that the task runs right away
+    """
+    taskqueue = await TaskQueue.find_one({'endpoint': endpoint.pk, 'priority': task.priority, 'organization': organization.pk, 'team': team.pk if team else None})
+    if not taskqueue:
+        return response_message(ENOENT, 'Task queue not found'), False
+    idle = not taskqueue.running_task and not taskqueue.tasks
+    try:
+        await taskqueue.push(task)
+    except RuntimeError:
+        return response_message(UNKNOWN_ERROR, 'Failed to push task to the task queue'), False
+    message = {
+        'endpoint_uid': endpoint.uid,
+        'task_id': str(task.pk),
+    }
+    if not await push_event(organization=organization, team=team, code=EVENT_CODE_START_TASK, message=message):
+        return response_message(EPERM, 'Pushing the event to event queue failed'), idle
+    return None, idle
+
 @bp.get('/result')
 @doc.summary('Get the task result XML file generated by robot')
 @doc.consumes(doc.String(name='X-Token'), location='header')
@@ -41,17 +88,24 @@ bp = Blueprint('task', url_prefix='/task')
 @doc.response(200, json_response)
 @token_required
 @organization_team_required_by_args
-@task_required
+@task_or_archive_required
 async def handler(request):
     task = request.ctx.task
 
+    if task.result_archive:
+        member = await open_archived_file(get_result_archive_path(task), task.pk, 'output.xml')
+        if member is None:
+            return json(response_message(ENOENT, 'Task result file not found'))
+        return await serve_file_object(member, mime_type='text/xml')
+
     result_dir = await get_test_result_path(task)
     if not await async_exists(result_dir):
         return json(response_message(ENOENT, 'Task result directory not found')) #TODO
 
-    async with aiofiles.open(result_dir / 'output.xml', encoding='utf-8') as f:
-        return html(await f.read(), headers={'Content-Type': 'text/xml'})
-        # return text(await f.read(), headers={'Content-Type': 'text/xml'}) #TODO
+    if not await async_exists(result_dir / 'output.xml'):
+        return json(response_message(ENOENT, 'Task result file not found'))
+
+    return await serve_file(request, result_dir / 'output.xml', mime_type='text/xml')
 
 @bp.get('/result_files')
 @doc.summary('Get the test result file list')
@@ -60,10 +114,13 @@ async def handler(request):
 @doc.produces(_task_result_files)
 @token_required
 @organization_team_required_by_args
-@task_required
+@task_or_archive_required
 async def handler(request):
     task = request.ctx.task
 
+    if task.result_archive:
+        return json(response_message(SUCCESS, files=await list_archived_files(get_result_archive_path(task), task.pk)))
+
     result_dir = await get_test_result_path(task)
     if not await async_exists(result_dir):
         return json(response_message(ENOENT, 'Task result directory not found'))
@@ -81,7 +138,7 @@ async def handler(request):
 @doc.produces(200, json_response)
 @token_required
 @organization_team_required_by_args
-@task_required
+@task_or_archive_required
 async def handler(request):
     file_path = request.args.get('file', default=None)
     if not file_path:
@@ -89,8 +146,126 @@ async def handler(request):
 
     task = request.ctx.task
 
+    if not is_path_secure(file_path):
+        return json(response_message(EINVAL, 'Illegal file path'))
+
+    if task.result_archive:
+        # the archived file is extracted on demand
+        member = await open_archived_file(get_result_archive_path(task), task.pk, file_path)
+        if member is None:
+            return json(response_message(ENOENT, 'Task result file not found'))
+        return await serve_file_object(member, status=201, mime_type=guess_type(file_path)[0])
+
     result_dir = await get_test_result_path(task)
-    return await file(result_dir / file_path, status=201) # as_attachment=True) #TODO
+    if not await async_isfile(result_dir / file_path):
+        return json(response_message(ENOENT, 'Task result file not found'))
+
+    return await serve_file(request, result_dir / file_path, status=201) # as_attachment=True) #TODO
+
+@bp.post('/rerun')
+@doc.summary('Rerun the failed test cases of a finished task')
+@doc.description('The rerun runs on the same endpoint with the same resource files, its outputs are merged with those of the task into a combined report')
+@doc.consumes(doc.String(name='X-Token'), location='header')
+@doc.consumes(_task_rerun, location='body')
+@doc.produces(_run_task)
+@token_required
+@organization_team_required_by_json
+@task_required
+async def handler(request):
+    task = request.ctx.task
+    organization = request.ctx.organization
+    team = request.ctx.team
+    user = request.ctx.user
+
+    if task.status not in ('successful', 'failed', 'cancelled'):
+        return json(response_message(EINVAL, 'Only a finished task can be rerun'))
+
+    try:
+        priority = int(request.json.get('priority', task.priority))
+    except (TypeError, ValueError):
+        return json(response_message(EINVAL, 'Field priority should be an integer'))
+    if priority < QUEUE_PRIORITY_MIN or priority > QUEUE_PRIORITY_MAX:
+        return json(response_message(ERANGE, 'Task priority is out of range'))
+
+    failed = await get_failed_test_cases(task)
+    if failed is None:
+        return json(response_message(ENOENT, 'Task result file not found'))
+    if len(failed) == 0:
+        return json(response_message(EINVAL, 'No failed test cases to rerun'))
+
+    if task.endpoint_run:
+        endpoint = await task.endpoint_run.fetch()
+    else:
+        # a sharded task runs on no specific endpoint
+        endpoints = await find_endpoints(task.endpoint_list, organization, team)
+        if not endpoints:
+            return json(response_message(ENOENT, 'Endpoint not found'))
+        endpoint = await select_endpoint(endpoints, organization, team, task)
+
+    upload_dir = ''
+    if task.upload_dir:
+        # the upload directory of the task expires, the rerun owns a copy linked to the same blobs
+        resource_root = await get_task_resource_root(task)
+        if not await async_exists(resource_root):
+            return json(response_message(ENOENT, 'Task resource files not found'))
+        upload_dir = str(ObjectId())
+        await link_files(resource_root, UPLOAD_ROOT / upload_dir)
+
+    new_task = Task()
+    try:
+        new_task.test = task.test.pk
+        new_task.test_suite = task.test_suite
+        new_task.testcases = failed
+        new_task.endpoint_list = [endpoint.uid]
+        new_task.priority = priority
+        new_task.variables = task.variables or {}
+        new_task.tester = user
+        new_task.upload_dir = upload_dir
+        new_task.rerun_of = task
+        new_task.organization = organization
+        if team:
+            new_task.team = team
+    except ValidationError as e:
+        logger.exception(e)
+        if upload_dir:
+            await remove_files(UPLOAD_ROOT / upload_dir)
+        return json(response_message(EINVAL, 'Task validation failed'))
+    await new_task.commit()
+
+    err, idle = await enqueue_task(new_task, endpoint, organization, team)
+    if err:
+        if err['code'] != EPERM.code:
+            await new_task.delete()
+            if upload_dir:
+                await remove_files(UPLOAD_ROOT / upload_dir)
+        return json(err)
+    return json(response_message(SUCCESS, failed=[], succeeded=[str(new_task.pk)], running=[str(new_task.pk)] if idle else [], test_cases=failed))
+
+@bp.post('/bulk')
+@doc.summary('Schedule a batch of tasks')
+@doc.description('Each task takes the fields of a single task except placement and shards. Either all of the tasks are scheduled or none of them is.')
+@doc.consumes(doc.String(name='X-Token'), location='header')
+@doc.consumes(_task_bulk, location='body')
+@doc.produces(_run_task)
+@token_required
+@organization_team_required_by_json
+async def handler(request):
+    organization = request.ctx.organization
+    team = request.ctx.team
+    user = request.ctx.user
+
+    items = request.json.get('tasks', None)
+    if not items or not isinstance(items, list):
+        return json(response_message(EINVAL, 'Field tasks should be a non-empty list'))
+
+    err, plan = await prepare_tasks(items, organization, team, user)
+    if err:
+        return json(err)
+    err, ret = await schedule_tasks(plan, organization, team)
+    if err:
+        return json(err)
+    succeeded, running = ret
+    return json(response_message(SUCCESS, failed=[], succeeded=succeeded, running=running))
 
 class TaskView(HTTPMethodView):
     @doc.summary('Get the task statistics list of last 7 days')
@@ -193,7 +368,7 @@ class TaskView(HTTPMethodView):
         if len(endpoint_list) == 0:
             return json(response_message(EINVAL, 'Endpoint list is empty'))
         for uid in endpoint_list:
-            if not await Endpoint.find_one({'uid': uuid.UUID(uid)}):
+            if not await Endpoint.find_one(get_endpoint_query(uuid.UUID(uid), organization, team)):
                 return json(response_message(EINVAL, 'One of the uid in the endpoint list is invalid'))
         task.endpoint_list = endpoint_list  # convert to uuid.UUID when assigning
 
@@ -205,6 +380,19 @@ class TaskView(HTTPMethodView):
         parallelization = js2python_bool(data.get('parallelization', False))
         task.parallelization = parallelization == True
 
+        placement = data.get('placement', 'all')
+        if placement not in ('all', 'any', 'shard'):
+            return json(response_message(EINVAL, 'Field placement should be one of all, any and shard'))
+        if placement != 'all' and task.parallelization:
+            return json(response_message(EINVAL, 'Placement {} is not applicable to parallelization'.format(placement)))
+        if placement == 'shard':
+            try:
+                num_shards = int(data.get('shards', len(endpoint_list)))
+            except (TypeError, ValueError):
+                return json(response_message(EINVAL, 'Field shards should be an integer'))
+            if num_shards < 1 or num_shards > len(endpoint_list):
+                return json(response_message(ERANGE, 'Field shards should be between 1 and the number of endpoints'))
+
         variables = data.get('variables', {})
         if not isinstance(variables, dict):
             return json(response_message(EINVAL, 'Variables should be a dictionary'))
@@ -227,74 +415,67 @@ class TaskView(HTTPMethodView):
             return json(response_message(EINVAL, 'Task validation failed'))
         await task.commit()
 
+        endpoint_list = task.endpoint_list
+        shards = None
+        if placement == 'any':
+            # enqueue to the only endpoint of the pool that is expected to finish it first
+            endpoints = await find_endpoints(task.endpoint_list, organization, team)
+            if not endpoints:
+                await task.delete()
+                return json(response_message(ENOENT, 'Endpoint not found'))
+            endpoint = await select_endpoint(endpoints, organization, team, task)
+            endpoint_list = [endpoint.uid]
+        elif placement == 'shard':
+            # run each shard of the test cases on a different endpoint, the least loaded first
+            shards = await split_test_suite(task.test_suite, task.testcases or test.test_cases, num_shards, organization, team)
+            if not shards:
+                await task.delete()
+                return json(response_message(EINVAL, 'No test cases to shard'))
+            endpoints = await find_endpoints(task.endpoint_list, organization, team)
+            if len(endpoints) < len(shards):
+                await task.delete()
+                return json(response_message(ENOENT, 'Endpoint not found'))
+            drain_times = await estimate_drain_times(endpoints, organization, team, task)
+            endpoints.sort(key=lambda e: drain_times[e.pk])
+            endpoint_list = [e.uid for e in endpoints[:len(shards)]]
+
         failed = []
         succeeded = []
         running = []
-        for endpoint_uid in task.endpoint_list:
-            if task.parallelization:
+        for i, endpoint_uid in enumerate(endpoint_list):
+            if task.parallelization or shards:
                 new_task = Task()
                 for name in task:
                     if name != 'id' and not name.startswith('_') and not callable(task[name]):
                         new_task[name] = task[name]
-                else:
-                    await new_task.commit()
-                    endpoint = await Endpoint.find_one({'uid': endpoint_uid})
-                    if not endpoint:
-                        failed.append(str(new_task.pk))
-                        logger.error('Endpoint not found')
-                        continue
-                    taskqueue = await TaskQueue.find_one({'endpoint': endpoint.pk, 'priority': task.priority, 'organization': organization.pk, 'team': team.pk if team else None})
-                    if not taskqueue:
-                        failed.append(str(new_task.pk))
-                        logger.error('Task queue not found')
-                    else:
-                        if not taskqueue.running_task and len(taskqueue.tasks) == 0:
-                            running.append(str(new_task.pk))
-                        ret = await taskqueue.push(new_task)
-                        if ret == None:
-                            failed.append(str(new_task.pk))
-                            logger.error('Failed to push task to the task queue')
-                        else:
-                            message = {
-                                'endpoint_uid': endpoint_uid,
-                                'task_id': str(new_task.pk),
-                            }
-                            ret = await push_event(organization=new_task.test.organization, team=new_task.test.team, code=EVENT_CODE_START_TASK, message=message)
-                            if not ret:
-                                return json(response_message(EPERM, 'Pushing the event to event queue failed'))
-                            succeeded.append(str(new_task.pk))
+                if shards:
+                    new_task.testcases = shards[i]
+                    new_task.endpoint_list = [endpoint_uid]
+                    new_task.parent = task
+                await new_task.commit()
             else:
-                endpoint = await Endpoint.find_one({'uid': endpoint_uid})
-                if not endpoint:
-                    failed.append(str(task.pk))
-                    logger.error('Endpoint not found')
-                    continue
-                taskqueue = await TaskQueue.find_one({'endpoint': endpoint.pk, 'priority': task.priority, 'organization': organization.pk, 'team': team.pk if team else None})
-                if not taskqueue:
-                    failed.append(str(task.pk))
-                    logger.error('Task queue not found')
-                else:
-                    if not taskqueue.running_task and (not taskqueue.tasks or len(taskqueue.tasks) == 0):
-                        running.append(str(task.pk))
-                    try:
-                        await taskqueue.push(task)
-                    except RuntimeError:
-                        failed.append(str(task.pk))
-                        logger.error('Failed to push task to the task queue')
-                    else:
-                        message = {
-                            'endpoint_uid': endpoint_uid,
-                            'task_id': str(task.pk),
-                        }
-                        ret = await push_event(organization=organization, team=team, code=EVENT_CODE_START_TASK, message=message)
-                        if not ret:
-                            return json(response_message(EPERM, 'Pushing the event to event queue failed'))
-                        succeeded.append(str(task.pk))
+                new_task = task
+            endpoint = await Endpoint.find_one(get_endpoint_query(endpoint_uid, organization, team))
+            if not endpoint:
+                failed.append(str(new_task.pk))
+                logger.error('Endpoint not found')
+                continue
+            err, idle = await enqueue_task(new_task, endpoint, organization, team)
+            if err:
+                if err['code'] == EPERM.code:
+                    return json(err)
+                failed.append(str(new_task.pk))
+                continue
+            if idle:
+                running.append(str(new_task.pk))
+            succeeded.append(str(new_task.pk))
         else:
             if task.parallelization:
                 task.delete()
         if len(failed) != 0:
             return json(response_message(UNKNOWN_ERROR, 'Task scheduling failed'))
+        if shards:
+            return json(response_message(SUCCESS, failed=failed, succeeded=succeeded, running=[t for t in running if t in succeeded], parent=str(task.pk)))
         return json(response_message(SUCCESS, failed=failed, succeeded=succeeded, running=[t for t in running if t in succeeded]))
 
     @doc.summary('Update a task with specified fields')
@@ -333,19 +514,25 @@ class TaskView(HTTPMethodView):
         if priority is None:
             return json(response_message(EINVAL, 'Field priority is required'))
 
-        endpoint = await task.endpoint_run.fetch() if task.endpoint_run else None
-        message = {
-            'endpoint_uid': endpoint.uid if endpoint else '',  #TODO str(uid)
-            'priority': priority,
-            'task_id': str(task.pk)
-        }
-
         test = await task.test.fetch()
         organization = await test.organization.fetch()
         team = await test.team.fetch() if test.team else None
-        ret = await push_event(organization=organization, team=team, code=EVENT_CODE_CANCEL_TASK, message=message)
-        if not ret:
-            return json(response_message(EPERM, 'Pushing the event to event queue failed'))
+
+        # a sharded task is cancelled by cancelling its shards, it's never queued itself
+        if await Task.find_one({'parent': task.pk}):
+            targets = await Task.find({'parent': task.pk, 'status': {'$in': ['waiting', 'running']}}).to_list(None)
+        else:
+            targets = [task]
+        for t in targets:
+            endpoint = await t.endpoint_run.fetch() if t.endpoint_run else None
+            message = {
+                'endpoint_uid': endpoint.uid if endpoint else '',  #TODO str(uid)
+                'priority': priority,
+                'task_id': str(t.pk)
+            }
+            ret = await push_event(organization=organization, team=team, code=EVENT_CODE_CANCEL_TASK, message=message)
+            if not ret:
+                return json(response_message(EPERM, 'Pushing the event to event queue failed'))
         return json(response_message(SUCCESS))
 
 bp.add_route(TaskView.as_view(), '/')
@@ -1,4 +1,6 @@
 import aiofiles
+import fcntl
+import json as py_json
 import os
 from pathlib import Path
 from bson.objectid import ObjectId
@@ -6,26 +8,30 @@ from bson.objectid import ObjectId
 from async_files.utils import async_wraps
 from sanic import Blueprint
 from sanic.log import logger
-from sanic.views import HTTPMethodView
-from sanic.response import json, file, html
+from sanic.views import HTTPMethodView, stream
+from sanic.response import json, file_stream, HTTPResponse
 from sanic_openapi import doc
 
-from app.main.util.decorator import token_required, organization_team_required_by_args, task_required, organization_team_required_by_form
-from app.main.util.get_path import get_test_result_path, get_upload_files_root, is_path_secure
+from app.main.util.decorator import token_required, organization_team_required_by_args, organization_team_required_by_json, task_required, organization_team_required_by_form, multipart_form_streamed
+from app.main.util.get_path import get_task_resource_root, is_path_secure, PARTIAL_ROOT, UPLOAD_ROOT
+from app.main.util.fileserve import is_not_modified
+from app.main.util.multipart import receive_to_file, UploadTooLarge
+from app.main.util.blobstore import store_files, link_files, remove_files
+from task_runner.util.indexer import file_digest
 from ..config import get_config
 from ..model.database import Task
-from ..util import async_rmtree, async_copy, async_exists
+from ..util import async_exists, async_makedirs
 from ..util.dto import TaskResourceDto, json_response
-from ..util.tarball import pack_files, path_to_dict
-from ..util.response import response_message, EINVAL, ENOENT, SUCCESS, EIO, NO_TASK_RESOURCES
+from ..util.tarball import get_cached_tarball, path_to_dict
+from ..util.response import response_message, EINVAL, ENOENT, SUCCESS, EIO, EFBIG, EBUSY, NO_TASK_RESOURCES
 
 _task_resource = TaskResourceDto.task_resource
 _task_resource_response = TaskResourceDto.task_resource_response
 _task_id = TaskResourceDto.task_id
 _task_resource_file_list = TaskResourceDto.task_resource_file_list
-
-TARBALL_TEMP = Path('temp')
-
+_chunked_upload = TaskResourceDto.chunked_upload
+_chunk_query = TaskResourceDto.chunk_query
+_chunked_upload_response = TaskResourceDto.chunked_upload_response
 
 bp = Blueprint('taskresource', url_prefix='/taskresource')
 
@@ -47,21 +53,22 @@ async def handler(request, task_id):
     if not task.upload_dir:
         return json(response_message(NO_TASK_RESOURCES), status=204)
 
-    upload_root = get_upload_files_root(task)
-    result_root = await get_test_result_path(task)
-    if not await async_exists(result_root / TARBALL_TEMP):
-        await aiofiles.os.mkdir(result_root / TARBALL_TEMP)
+    upload_root = await get_task_resource_root(task)
 
     upload_file = request.args.get('file', None)
     if upload_file:
-        return await file(upload_root / upload_file)
+        if not is_path_secure(upload_file):
+            return json(response_message(EINVAL, 'Illegal file name'))
+        return await file_stream(upload_root / upload_file)
 
-    tarball = await pack_files(task_id, upload_root, result_root / TARBALL_TEMP)
+    tarball, digest = await get_cached_tarball(upload_root)
     if not tarball:
         return json(response_message(EIO, 'Packing task resource files failed'))
 
-    tarball = os.path.basename(tarball)
-    return await file(result_root / TARBALL_TEMP / tarball)
+    etag = '"{}"'.format(digest)
+    if is_not_modified(request, etag):
+        return HTTPResponse(status=304, headers={'ETag': etag})
+    return await file_stream(tarball, headers={'ETag': etag, 'Cache-Control': 'no-cache'}, filename=task_id + '.tar.gz')
 
 @bp.get('/list')
 @doc.summary('Get the file list in the upload directory')
@@ -76,7 +83,7 @@ async def handler(request):
     if not task.upload_dir:
         return []
 
-    upload_root = get_upload_files_root(task)
+    upload_root = await get_task_resource_root(task)
     if not await async_exists(upload_root):
         return json(response_message(ENOENT, 'Task upload directory does not exist'))
 
@@ -89,28 +96,36 @@ class TaskResourceView(HTTPMethodView):
     @doc.consumes(_task_resource, location="formData", content_type="multipart/form-data")
     @doc.produces(_task_resource_response)
     @token_required
+    @multipart_form_streamed
     @organization_team_required_by_form
+    @stream
     async def post(self, request):
         organization = request.ctx.organization
         team = request.ctx.team
+        form = request.ctx.form
         found = False
 
-        temp_id = request.form.get('resource_id', None)
+        temp_id = form.get('resource_id', None)
         if not temp_id:
             temp_id = str(ObjectId())
-            await aiofiles.os.mkdir(request.app.config.UPLOAD_ROOT / temp_id)
-        upload_root = request.app.config.UPLOAD_ROOT / temp_id
+            await aiofiles.os.mkdir(UPLOAD_ROOT / temp_id)
+        elif not is_path_secure(temp_id):
+            return json(response_message(EINVAL, 'Illegal resource id'))
+        upload_root = UPLOAD_ROOT / temp_id
 
-        for name, file in request.files.items():
-            if not is_path_secure(file.name):
-                return json(response_message(EINVAL, 'saving file with an illegal file name'))
-            found = True
-            async with aiofiles.open(upload_root / file.name, 'wb') as f:
-                await f.write(file.body)
+        uploads = []
+        for name, files in request.ctx.files.items():
+            for file in files:
+                if not is_path_secure(file.name):
+                    return json(response_message(EINVAL, 'saving file with an illegal file name'))
+                found = True
+                uploads.append((file.path, file.name, file.sha256))
+        await store_files(upload_root, uploads)
+        digests = {name: digest for _, name, digest in uploads}
 
-        files = request.form.getlist('file')
+        files = form.getlist('file') or []
         if len(files) > 0:
-            retrigger_task_id = request.form.get('retrigger_task', None)
+            retrigger_task_id = form.get('retrigger_task', None)
             if not retrigger_task_id:
                 return json(response_message(EINVAL, 'Field retrigger_task is required'))
 
@@ -122,21 +137,138 @@ class TaskResourceView(HTTPMethodView):
             if test.organization != organization or test.team != team:
                 return json(response_message(EINVAL, 'Re-triggering a task not belonging to your organization/team is not allowed'))
 
-            retrigger_task_upload_root = get_upload_files_root(retrigger_task)
+            retrigger_task_upload_root = await get_task_resource_root(retrigger_task)
             if not await async_exists(retrigger_task_upload_root):
                 return json(response_message(ENOENT, 'Re-trigger task upload directory does not exist'))
 
-        for f in files:
-            try:
-                await async_copy(retrigger_task_upload_root / f, upload_root)
-                found = True
-            except FileNotFoundError:
-                await async_rmtree(upload_root)
-                return json(response_message(ENOENT, 'File {} used in the re-triggered task not found'.format(f)))
+        if len(files) > 0:
+            if not all(is_path_secure(f) for f in files):
+                return json(response_message(EINVAL, 'Illegal file name'))
+            missing = await link_files(retrigger_task_upload_root, upload_root, files)
+            if missing:
+                await remove_files(upload_root)
+                return json(response_message(ENOENT, 'File {} used in the re-triggered task not found'.format(missing[0])))
+            found = True
 
         if not found:
             return json(response_message(ENOENT, 'No files are found in the request'))
 
-        return json(response_message(SUCCESS, resource_id=temp_id))
+        return json(response_message(SUCCESS, resource_id=temp_id, files=digests))
+
+class ChunkedResourceView(HTTPMethodView):
+    @doc.summary('start or resume a chunked upload of a large resource file')
+    @doc.description('Return the offset the next chunk should be uploaded from, a new resource directory will be created if resource_id is not specified')
+    @doc.consumes(doc.String(name='X-Token'), location='header')
+    @doc.consumes(_chunked_upload, location='body')
+    @doc.produces(_chunked_upload_response)
+    @token_required
+    @organization_team_required_by_json
+    async def post(self, request):
+        data = request.json
+        filename = data.get('file', None)
+        if not filename or not is_path_secure(filename):
+            return json(response_message(EINVAL, 'Field file is required and should be a legal file name'))
+        size = data.get('size', None)
+        if not isinstance(size, int) or size < 0:
+            return json(response_message(EINVAL, 'Field size should be a non-negative integer'))
+        if size > request.app.config.UPLOAD_MAX_SIZE:
+            return json(response_message(EFBIG, 'File size exceeds {} bytes'.format(request.app.config.UPLOAD_MAX_SIZE)))
+
+        temp_id = data.get('resource_id', None)
+        if not temp_id:
+            temp_id = str(ObjectId())
+            await aiofiles.os.mkdir(UPLOAD_ROOT / temp_id)
+        elif not is_path_secure(temp_id) or not await async_exists(UPLOAD_ROOT / temp_id):
+            return json(response_message(ENOENT, 'Resource directory not found'))
+
+        partial = get_partial_upload_path(temp_id, filename)
+        offset = 0
+        if await async_exists(partial):
+            async with aiofiles.open(str(partial) + '.json') as f:
+                if py_json.loads(await f.read())['size'] != size:
+                    return json(response_message(EINVAL, 'File size mismatches the upload in progress'))
+            offset = (await aiofiles.os.stat(partial)).st_size
+        else:
+            await async_makedirs(partial.parent, exist_ok=True)
+            async with aiofiles.open(str(partial) + '.json', 'w') as f:
+                await f.write(py_json.dumps({'size': size}))
+            async with aiofiles.open(partial, 'wb') as f:
+                pass
+        return json(response_message(SUCCESS, resource_id=temp_id, offset=offset, complete=False))
+
+    @doc.summary('upload a chunk of a large resource file')
+    @doc.description('''\
+        The request body is the raw chunk data to append to the file from the offset.
+        When the file is completely uploaded it's moved to the resource directory and its sha256 is returned.
+    ''')
+    @doc.consumes(doc.String(name='X-Token'), location='header')
+    @doc.consumes(_chunk_query)
+    @doc.produces(_chunked_upload_response)
+    @token_required
+    @organization_team_required_by_args
+    @stream
+    async def put(self, request):
+        temp_id = request.args.get('resource_id', None)
+        filename = request.args.get('file', None)
+        if not temp_id or not filename or not is_path_secure(temp_id) or not is_path_secure(filename):
+            return json(response_message(EINVAL, 'Field resource_id and file are required'))
+        try:
+            offset = int(request.args.get('offset', None))
+        except (TypeError, ValueError):
+            return json(response_message(EINVAL, 'Field offset should be an integer'))
+
+        partial = get_partial_upload_path(temp_id, filename)
+        if not await async_exists(partial):
+            return json(response_message(ENOENT, 'Chunked upload not started'))
+
+        with open(partial, 'ab') as fp:
+            # a concurrent chunk at the same offset would pass the offset check too and append twice
+            try:
+                fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return json(response_message(EBUSY, 'Another chunk of the file is being uploaded', resource_id=temp_id, complete=False))
+            try:
+                # the upload may have been completed by the chunk holding the lock before
+                if not await async_exists(str(partial) + '.json'):
+                    return json(response_message(ENOENT, 'Chunked upload not started'))
+                async with aiofiles.open(str(partial) + '.json') as f:
+                    size = py_json.loads(await f.read())['size']
+                current = fp.tell()
+                if current != offset:
+                    return json(response_message(EINVAL, 'Chunk offset mismatches', resource_id=temp_id, offset=current, complete=False))
+                try:
+                    written = await receive_to_file(request, fp, size - offset)
+                except UploadTooLarge:
+                    fp.truncate(offset)
+                    return json(response_message(EFBIG, 'Chunk exceeds the declared file size'), status=413)
+                offset += written
+
+                if offset < size:
+                    return json(response_message(SUCCESS, resource_id=temp_id, offset=offset, complete=False))
+
+                fp.flush()
+                digest = await async_wraps(file_digest)(partial)
+                await store_files(UPLOAD_ROOT / temp_id, [(str(partial), filename, digest)])
+                await aiofiles.os.remove(str(partial) + '.json')
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+        await async_wraps(remove_partial_dirs)(partial)
+        return json(response_message(SUCCESS, resource_id=temp_id, offset=offset, complete=True, sha256=digest))
+
+def get_partial_upload_path(resource_id, filename):
+    return PARTIAL_ROOT / resource_id / filename
+
+def remove_partial_dirs(partial):
+    """
+    Remove the directories of a completed partial upload up to the partial root, unless other files are still being uploaded there
+    """
+    parent = partial.parent
+    while parent != PARTIAL_ROOT:
+        try:
+            os.rmdir(parent)
+        except OSError:
+            break
+        parent = parent.parent
 
 bp.add_route(TaskResourceView.as_view(), '/')
+bp.add_route(ChunkedResourceView.as_view(), '/chunked')
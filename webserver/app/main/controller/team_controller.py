@@ -14,6 +14,7 @@ from sanic.views import HTTPMethodView
 
 from ..util import async_rmtree
 from ..util.decorator import token_required
+from ..util.get_path import invalidate_users_root
 from ..model.database import User, Organization, Team, Test, TestResult, TaskQueue, Task
 
 from ..service.auth_helper import Auth
@@ -166,6 +167,7 @@ class TeamView(HTTPMethodView):
             queue.team = None
             await queue.commit()
         await team.delete()
+        invalidate_users_root(team=team)
 
         return json(response_message(SUCCESS))
 
@@ -12,12 +12,14 @@ from marshmallow.exceptions import ValidationError
 from sanic import Blueprint
 from sanic.log import logger
 from sanic.views import HTTPMethodView
-from sanic.response import json, file, html
+from sanic.response import json, file, html, stream
 from sanic_openapi import doc
 
 from ..util import async_listdir
 from ..util.decorator import token_required, organization_team_required_by_args, organization_team_required_by_json
 from ..util.get_path import get_test_results_root
+from ..util.pagination import TOTAL_MODES, count, paginate
+from ..service.export_service import TASK_FIELDS, TEST_RESULT_FIELDS, export_tasks, export_test_results, to_csv, to_ndjson
 from ..config import get_config
 from ..model.database import QUEUE_PRIORITY_MAX, QUEUE_PRIORITY_MIN, Endpoint, Task, TestResult
 from ..util.dto import TestResultDto, json_response
@@ -26,12 +28,55 @@ from ..util.response import response_message, ENOENT, EINVAL, SUCCESS, EPERM
 _test_report = TestResultDto.test_report
 _record_test_result = TestResultDto.record_test_result
 _test_result_query = TestResultDto.test_result_query
+_test_result_export_query = TestResultDto.test_result_export_query
 _test_result = TestResultDto.test_result
 
 USERS_ROOT = Path(get_config().USERS_ROOT)
 
 bp = Blueprint('testresult', url_prefix='/testresult')
 
+async def get_task_query(args, organization, team):
+    """
+    The query of the tasks by the filters in the request arguments, return (error response, None) or (None, query)
+    """
+    title = args.get('title', default=None)
+    priority = args.get('priority', default=None)
+    endpoint_uid = args.get('endpoint', default=None)
+    start_date = args.get('start_date', None)
+    end_date = args.get('end_date', None)
+
+    if start_date:
+        start_date = parser.parse(start_date)
+        if end_date is None:
+            end_date = datetime.now(timezone.utc)
+        else:
+            end_date = parser.parse(end_date)
+
+        if (start_date - end_date).days > 0:
+            return response_message(EINVAL, 'start date {} is larger than end date {}'.format(start_date, end_date)), None
+
+        query = {'run_date': {'$lte': end_date, '$gte': start_date}, 'organization': organization.pk}
+    else:
+        query = {'organization': organization.pk}
+
+    if team:
+        query['team'] = team.pk
+
+    if priority and priority != '' and priority.isdigit() and \
+            int(priority) >= QUEUE_PRIORITY_MIN and int(priority) <= QUEUE_PRIORITY_MAX:
+        query['priority'] = priority
+
+    if title and priority != '':
+        query['test_suite'] = {'$regex': title}
+
+    if endpoint_uid and endpoint_uid != '':
+        endpoint = await Endpoint.find_one({'uid': uuid.UUID(endpoint_uid)})
+        if not endpoint:
+            return response_message(EINVAL, 'Endpoint not found'), None
+        query['endpoint_run'] = endpoint.pk
+
+    return None, query
+
 class TestResultView(HTTPMethodView):
     @doc.summary('get the task report list')
     @doc.consumes(doc.String(name='X-Token'), location='header')
@@ -42,50 +87,20 @@ class TestResultView(HTTPMethodView):
     async def get(self, request):
         page = request.args.get('page', default=1)
         limit = request.args.get('limit', default=10)
-        title = request.args.get('title', default=None)
-        priority = request.args.get('priority', default=None)
-        endpoint_uid = request.args.get('endpoint', default=None)
         sort = request.args.get('sort', default='-run_date')
-        start_date = request.args.get('start_date', None)
-        end_date = request.args.get('end_date', None)
-
-        organization = request.ctx.organization
-        team = request.ctx.team
-
-        if start_date:
-            start_date = parser.parse(start_date)
-            if end_date is None:
-                end_date = datetime.now(timezone.utc)
-            else:
-                end_date = parser.parse(end_date)
-
-            if (start_date - end_date).days > 0:
-                return json(response_message(EINVAL, 'start date {} is larger than end date {}'.format(start_date, end_date)))
-
-            query = {'run_date': {'$lte': end_date, '$gte': start_date}, 'organization': organization.pk}
-        else:
-            query = {'organization': organization.pk}
-        
-        if team:
-            query['team'] = team.pk
+        cursor = request.args.get('cursor', default=None)
+        total = request.args.get('total', default='none' if cursor else 'exact')
 
         page = int(page)
         limit = int(limit)
         if page <= 0 or limit <= 0:
             return json(response_message(EINVAL, 'Field page and limit should be larger than 1'))
+        if total not in TOTAL_MODES:
+            return json(response_message(EINVAL, 'Field total should be one of {}'.format(', '.join(TOTAL_MODES))))
 
-        if priority and priority != '' and priority.isdigit() and \
-                int(priority) >= QUEUE_PRIORITY_MIN and int(priority) <= QUEUE_PRIORITY_MAX:
-            query['priority'] = priority
-
-        if title and priority != '':
-            query['test_suite'] = {'$regex': title}
-
-        if endpoint_uid and endpoint_uid != '':
-            endpoint = await Endpoint.find_one({'uid': uuid.UUID(endpoint_uid)})
-            if not endpoint:
-                return json(response_message(EINVAL, 'Endpoint not found'))
-            query['endpoint_run'] = endpoint.pk
+        err, query = await get_task_query(request.args, request.ctx.organization, request.ctx.team)
+        if err:
+            return json(err)
 
         # try:
         #     dirs = await async_listdir(await get_test_results_root(team=team, organization=organization))
@@ -104,7 +119,13 @@ class TestResultView(HTTPMethodView):
         ret = []
 
         sort_string_start = 1 if sort[0] in ('-', '+') else 0
-        async for t in Task.find(query).sort(sort[sort_string_start:], pymongo.DESCENDING if sort[0] == '-' else pymongo.ASCENDING).skip((page - 1) * limit).limit(limit):
+        sort = (sort[sort_string_start:], pymongo.DESCENDING if sort[0] == '-' else pymongo.ASCENDING)
+        try:
+            # the page number is only honored without a cursor for the clients not using cursors yet
+            tasks, next_cursor = await paginate(Task, query, sort, limit, cursor, 0 if cursor else (page - 1) * limit)
+        except ValueError as e:
+            return json(response_message(EINVAL, str(e)))
+        for t in tasks:
             tester = await t.tester.fetch()
             test = await t.test.fetch() 
             test_id = str(test.pk) if test else None
@@ -123,7 +144,7 @@ class TestResultView(HTTPMethodView):
                 'parallelization': t.parallelization
             })
 
-        return json(response_message(SUCCESS, test_reports=ret, total=(await Task.count_documents(query))))
+        return json(response_message(SUCCESS, test_reports=ret, total=await count(Task, query, total), next_cursor=next_cursor))
 
     @doc.summary('create the test result in the database for a task')
     @doc.consumes(_record_test_result, location='body')
@@ -164,6 +185,40 @@ class TestResultView(HTTPMethodView):
 
         return json(response_message(SUCCESS))
 
+@bp.get('/export')
+@doc.summary('Export the tasks or their test results matching the filters as NDJSON or CSV')
+@doc.description('The documents are streamed by the chunked transfer encoding, the latest task first')
+@doc.consumes(doc.String(name='X-Token'), location='header')
+@doc.consumes(_test_result_export_query)
+@token_required
+@organization_team_required_by_args
+async def handler(request):
+    kind = request.args.get('kind', default='task')
+    fmt = request.args.get('format', default='ndjson')
+    if kind not in ('task', 'testresult'):
+        return json(response_message(EINVAL, 'Field kind should be task or testresult'))
+    if fmt not in ('ndjson', 'csv'):
+        return json(response_message(EINVAL, 'Field format should be ndjson or csv'))
+
+    err, query = await get_task_query(request.args, request.ctx.organization, request.ctx.team)
+    if err:
+        return json(err)
+
+    if kind == 'task':
+        batches, fields = export_tasks(query), TASK_FIELDS
+    else:
+        batches, fields = export_test_results(query), TEST_RESULT_FIELDS
+    chunks = to_ndjson(batches) if fmt == 'ndjson' else to_csv(batches, fields)
+
+    async def streaming_fn(response):
+        # a chunk is written after the previous one drains so that the memory is bounded by a batch
+        async for chunk in chunks:
+            await response.write(chunk)
+
+    filename = '{}s.{}'.format(kind, fmt)
+    content_type = 'application/x-ndjson' if fmt == 'ndjson' else 'text/csv; charset=utf-8'
+    return stream(streaming_fn, content_type=content_type, headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
 @bp.post('/<task_id>')
 @doc.summary('Update the test result for the test case of a test suite')
 @doc.description('Any items in the field more_result in the payload will be filled to the field more_result in the test result recorded in the database')
@@ -9,15 +9,16 @@ from pkg_resources import parse_version
 
 from sanic import Blueprint
 from sanic.log import logger
-from sanic.views import HTTPMethodView
+from sanic.views import HTTPMethodView, stream
 from sanic.response import json, file
 from sanic_openapi import doc
 
 from ..util import async_move, async_rmtree, async_exists, async_listdir
 from ..util.zipfile import ZipFile
 from ..util.tempdir import TemporaryDirectory
-from ..util.decorator import token_required, organization_team_required_by_args, organization_team_required_by_json, organization_team_required_by_form, token_required_if_proprietary_by_args, token_required_if_proprietary_by_json
+from ..util.decorator import token_required, organization_team_required_by_args, organization_team_required_by_json, organization_team_required_by_form, multipart_form_streamed, token_required_if_proprietary_by_args, token_required_if_proprietary_by_json
 from ..util.get_path import get_test_store_root, is_path_secure, get_user_scripts_root, get_back_scripts_root
+from ..util.pagination import TOTAL_MODES, count, paginate
 from task_runner.util.dbhelper import get_package_info, install_test_suite, get_internal_packages
 from ..config import get_config
 from ..model.database import Package, Test, PackageFile
@@ -48,11 +49,15 @@ class PackageView(HTTPMethodView):
         page = data.get('page', default=1)
         limit = data.get('limit', default=10)
         title = data.get('title', default=None)
+        cursor = data.get('cursor', default=None)
+        total = data.get('total', default='none' if cursor else 'exact')
 
         page = int(page)
         limit = int(limit)
         if page <= 0 or limit <= 0:
             return json(response_message(EINVAL, 'Field page and limit should be larger than 1'))
+        if total not in TOTAL_MODES:
+            return json(response_message(EINVAL, 'Field total should be one of {}'.format(', '.join(TOTAL_MODES))))
 
         proprietary = js2python_bool(data.get('proprietary', False)) #TODO: check organization and team
         package_type = data.get('package_type', None)
@@ -78,7 +83,11 @@ class PackageView(HTTPMethodView):
                 'upload_date': top_package.upload_date
             })
 
-        async for package in Package.find(query).skip((page - 1) * limit).limit(limit):
+        try:
+            packages, next_cursor = await paginate(Package, query, None, limit, cursor, 0 if cursor else (page - 1) * limit)
+        except ValueError as e:
+            return json(response_message(EINVAL, str(e)))
+        for package in packages:
             if package == top_package:
                 continue
             ret.append({
@@ -91,7 +100,7 @@ class PackageView(HTTPMethodView):
                 'versions': await package.versions,
                 'upload_date': package.upload_date.timestamp() * 1000
             })
-        return json(response_message(SUCCESS, packages=ret, total=await Package.count_documents(query)))
+        return json(response_message(SUCCESS, packages=ret, total=await count(Package, query, total), next_cursor=next_cursor))
 
     @doc.summary('upload the package')
     @doc.description('''\
@@ -103,7 +112,9 @@ class PackageView(HTTPMethodView):
     @doc.consumes(_upload_package, location="formData", content_type="multipart/form-data")
     @doc.produces(json_response)
     @token_required
+    @multipart_form_streamed
     @organization_team_required_by_form
+    @stream
     async def post(self, request):
         found = False
 
@@ -111,7 +122,7 @@ class PackageView(HTTPMethodView):
         team = request.ctx.team
         user = request.ctx.user
 
-        data = request.form
+        data = request.ctx.form
         proprietary = js2python_bool(data.get('proprietary', False))
         package_type = data.get('package_type', None)
         if not package_type:
@@ -126,15 +137,14 @@ class PackageView(HTTPMethodView):
             query['organization'] = organization.pk
             query['team'] = team.pk if team else None
 
-        for name, files in request.files.items():
+        for name, files in request.ctx.files.items():
             for file in files:
                 if not is_path_secure(file.name):
                     return json(response_message(EINVAL, 'Illegal file name'))
                 found = True
-                async with TemporaryDirectory() as tempDir:
+                async with TemporaryDirectory(dir=os.path.dirname(file.path)) as tempDir:
                     filename = os.path.join(tempDir, file.name)
-                    async with aiofiles.open(filename, 'wb') as f:
-                        await f.write(file.body)
+                    await async_move(file.path, filename)
 
                     async with ZipFile(filename) as zf:
                         for f in zf.namelist():
@@ -5,7 +5,10 @@ import time
 from urllib.parse import urlparse
 from marshmallow import missing
 from async_property import async_property
+from bson import DBRef
 from pkg_resources import parse_version
+from pymongo import IndexModel, UpdateOne
+from pymongo.errors import OperationFailure
 
 import jwt
 from sanic.log import logger
@@ -68,9 +71,11 @@ class Organization(Document):
     avatar = StringField(validate=validate.Length(max=100))
     path = StringField()
     personal = BooleanField(default=False)
+    share_weight = FloatField(validate=lambda weight: weight > 0, default=1)   # weight of fair sharing the endpoints with others
 
     class Meta:
         collection_name = 'organizations'
+        indexes = ['owner']
 
 @instance.register
 class Team(Document):
@@ -88,6 +93,7 @@ class Team(Document):
 
     class Meta:
         collection_name = 'teams'
+        indexes = [('organization', 'name'), 'owner']
 
 @instance.register
 class User(Document):
@@ -206,6 +212,7 @@ class Test(Document):
 
     class Meta:
         collection_name = 'tests'
+        indexes = [('organization', 'team', 'test_suite'), ('organization', 'team', 'path')]
 
     def __eq__(self, other):
         for key, value in self.items():
@@ -244,9 +251,39 @@ class Task(Document):
     test_results = ListField(ReferenceField('TestResult'))
     organization = ReferenceField('Organization') # embedded document from Test
     team = ReferenceField('Team') # embedded document from Test
+    parent = ReferenceField('Task', allow_none=True)    # the task whose test cases are sharded to this one
+    rerun_of = ReferenceField('Task', allow_none=True)  # the task whose failed test cases are run again by this one
+    pipeline = ReferenceField('Pipeline', allow_none=True)
+    pipeline_node = StringField(validate=validate.Length(max=100))
+    result_archive = StringField(validate=validate.Length(max=300), allow_none=True)   # the archive of the result files relative to USERS_ROOT once archived
+    results_ready = BooleanField()  # False while the result files are still post-processed after the task finished, unset for the older tasks
 
     class Meta:
         collection_name = 'tasks'
+        indexes = [('organization', 'team', '-run_date', '-_id'), ('organization', '-run_date', '-_id'), ('organization', 'team', 'status', 'run_date'),
+                   ('organization', 'team', 'status', 'schedule_date'), 'test', 'parent', 'rerun_of', 'pipeline']
+
+@instance.register
+class Pipeline(Document):
+    '''
+    A DAG of tasks, each node runs once all of the nodes it depends on have finished and its condition holds
+
+    Node: {name, depends_on: [node name], condition: success|failure|always, task: task specification,
+           status: pending|running|successful|failed|skipped|cancelled, tasks: [task id]}
+    '''
+    schema_version = StringField(validate=validate.Length(max=10), default='1')
+    name = StringField(validate=validate.Length(max=100))
+    nodes = ListField(DictField(), default=[])
+    status = StringField(validate=validate.Length(max=50), default='running')
+    create_date = DateTimeField(default=datetime.datetime.utcnow)
+    update_date = DateTimeField(default=datetime.datetime.utcnow)
+    creator = ReferenceField('User')
+    organization = ReferenceField('Organization')
+    team = ReferenceField('Team', allow_none=True)
+
+    class Meta:
+        collection_name = 'pipelines'
+        indexes = [('organization', 'team', '-create_date')]
 
 @instance.register
 class Endpoint(Document):
@@ -262,6 +299,7 @@ class Endpoint(Document):
 
     class Meta:
         collection_name = 'endpoints'
+        indexes = ['uid', ('organization', 'team', 'status')]
 
 @instance.register
 class TaskQueue(Document):
@@ -280,6 +318,7 @@ class TaskQueue(Document):
 
     class Meta:
         collection_name = 'task_queues'
+        indexes = [('endpoint', 'organization', 'team', 'priority'), ('organization', 'team', 'priority')]
 
     async def acquire_lock(self):
         for i in range(LOCK_TIMEOUT):
@@ -292,14 +331,28 @@ class TaskQueue(Document):
     async def release_lock(self):
         await self.collection.find_one_and_update({'_id': self.pk}, {'$set': {'rw_lock': False}})
 
-    async def pop(self):
+    async def pop(self, select=None):
+        '''
+        Pop the first task, or the one at the index returned by the coroutine select(tasks) if given,
+        nothing is popped if select returns None
+        '''
         if not await self.acquire_lock():
             return None
         await self.reload()
         if len(self.tasks) == 0:
             await self.release_lock()
             return None
-        task = self.tasks.pop(0)
+        index = 0
+        if select:
+            try:
+                index = await select(self.tasks)
+            except Exception:
+                await self.release_lock()
+                raise
+            if index is None:
+                await self.release_lock()
+                return None
+        task = self.tasks.pop(index)
         task = await task.fetch()
         self.running_task = task
         await self.commit()
@@ -312,6 +365,26 @@ class TaskQueue(Document):
         self.tasks.append(task)
         await self.commit()
         await self.release_lock()
+
+    @classmethod
+    async def push_many(cls, tasks):
+        '''
+        Append the tasks of {queue id: [task id]} to the queues in one bulk write, the queues are locked in the order of ids
+        '''
+        locked = []
+        try:
+            for pk in sorted(tasks):
+                for i in range(LOCK_TIMEOUT):
+                    if await cls.collection.find_one_and_update({'_id': pk, 'rw_lock': False}, {'$set': {'rw_lock': True}}):
+                        locked.append(pk)
+                        break
+                    await asyncio.sleep(0.1)
+                else:
+                    raise RuntimeError('failed to acquire queue lock')
+            await cls.collection.bulk_write([UpdateOne({'_id': pk}, {'$push': {'tasks': {'$each': ids}}}) for pk, ids in tasks.items()], ordered=False)
+        finally:
+            if locked:
+                await cls.collection.update_many({'_id': {'$in': locked}}, {'$set': {'rw_lock': False}})
     
     async def flush(self, cancelled=False):
         if not await self.acquire_lock():
@@ -339,6 +412,124 @@ class TestResult(Document):
 
     class Meta:
         collection_name = 'test_results'
+        indexes = ['task']
+
+@instance.register
+class RobotResult(Document):
+    '''
+    Suite, test and keyword results ingested from robot's output.xml of a finished task
+    '''
+    schema_version = StringField(validate=validate.Length(max=10), default='1')
+    kind = StringField(validate=validate.OneOf(['suite', 'test', 'keyword']), required=True)
+    name = StringField(required=True)
+    longname = StringField()
+    status = StringField(validate=validate.Length(max=10))
+    start_time = DateTimeField()
+    end_time = DateTimeField()
+    duration = IntField()   # in milliseconds
+    tags = ListField(StringField(), default=[])
+    message = StringField()
+    depth = IntField(default=0)
+    task = ReferenceField('Task')
+    test_suite = StringField(validate=validate.Length(max=100))
+    endpoint = ReferenceField('Endpoint')
+    organization = ReferenceField('Organization')
+    team = ReferenceField('Team')
+
+    class Meta:
+        collection_name = 'robot_results'
+        indexes = ['task', ('organization', 'team', 'kind', 'name', '-start_time'), ('organization', 'team', 'status', '-start_time')]
+
+@instance.register
+class TaskLog(Document):
+    '''
+    A chunk of the console output of a running task, the backlog for the clients of the web workers
+    which don't share the memory of the task runner. The chunks are removed when the task finishes.
+    '''
+    schema_version = StringField(validate=validate.Length(max=10), default='1')
+    task = ReferenceField('Task', required=True)
+    message = StringField(default='')
+    date = DateTimeField(default=datetime.datetime.utcnow)
+
+    class Meta:
+        collection_name = 'task_logs'
+        # the chunks left by a runner which quit in the middle of a task expire eventually
+        indexes = [('task', '_id'), IndexModel([('date', 1)], expireAfterSeconds=7 * 24 * 3600)]
+
+@instance.register
+class DurationStat(Document):
+    '''
+    Run time statistics of a test suite, or a test case of it, on an endpoint or on all endpoints if endpoint is None
+    '''
+    schema_version = StringField(validate=validate.Length(max=10), default='1')
+    test_suite = StringField(validate=validate.Length(max=100), required=True)
+    test_case = StringField(default='')     # empty for the whole test suite
+    endpoint = ReferenceField('Endpoint', allow_none=True)
+    count = IntField(default=0)
+    ewma = FloatField()     # in milliseconds
+    samples = ListField(IntField(), default=[])     # the most recent durations in milliseconds
+    update_date = DateTimeField()
+    organization = ReferenceField('Organization')
+    team = ReferenceField('Team', allow_none=True)
+
+    class Meta:
+        collection_name = 'duration_stats'
+        indexes = [IndexModel([('organization', 1), ('team', 1), ('test_suite', 1), ('test_case', 1), ('endpoint', 1)], unique=True)]
+
+@instance.register
+class FairShareUsage(Document):
+    '''
+    Usage of an endpoint shared by organizations and teams, the endpoint is identified by uid since each
+    organization or team registers the same endpoint on its own
+    '''
+    schema_version = StringField(validate=validate.Length(max=10), default='1')
+    endpoint_uid = UUIDField(required=True)
+    organization = ReferenceField('Organization')
+    team = ReferenceField('Team', allow_none=True)
+    usage = FloatField(default=0)       # seconds of running tasks, decayed over time
+    update_date = DateTimeField()
+    tasks = IntField(default=0)
+    waits = IntField(default=0)         # tasks whose waiting time is recorded
+    wait_total = FloatField(default=0)  # seconds tasks waited in the queues before running
+    wait_max = FloatField(default=0)
+
+    class Meta:
+        collection_name = 'fair_share_usage'
+        indexes = [IndexModel([('endpoint_uid', 1), ('organization', 1), ('team', 1)], unique=True)]
+
+@instance.register
+class EndpointLease(Document):
+    '''
+    Time-bounded ownership of an endpoint by a task runner instance, the one that the endpoint is connected to.
+    Events of the endpoint processed by other instances are forwarded to the owner by the event list.
+    '''
+    schema_version = StringField(validate=validate.Length(max=10), default='1')
+    endpoint_uid = UUIDField(required=True)
+    owner = StringField(validate=validate.Length(max=200))
+    url = StringField(validate=validate.Length(max=200))    # where the endpoints can reach the owner
+    acquire_date = DateTimeField()
+    expire_date = DateTimeField()
+    events = ListField(ReferenceField('Event'), default=[])
+
+    class Meta:
+        collection_name = 'endpoint_leases'
+        indexes = [IndexModel([('endpoint_uid', 1)], unique=True), 'owner']
+
+@instance.register
+class ResourceBlob(Document):
+    '''
+    Content addressed file in the blob store of task resources, refcount is the number of directories linking it
+    '''
+    schema_version = StringField(validate=validate.Length(max=10), default='1')
+    sha256 = StringField(validate=validate.Length(equal=64), required=True, unique=True)
+    size = IntField(validate=validate.Range(min=0), default=0)
+    refcount = IntField(default=0)
+    create_date = DateTimeField(default=datetime.datetime.utcnow)
+    deleting = BooleanField(default=False)  # being removed by the garbage collection, no references can be taken
+
+    class Meta:
+        collection_name = 'resource_blobs'
+        indexes = ['refcount']
 
 @instance.register
 class Event(Document):
@@ -347,11 +538,14 @@ class Event(Document):
     message = DictField()
     organization = ReferenceField('Organization', required=True)
     team = ReferenceField('Team', default=None)
-    status = StringField(validate=validate.Length(max=10), default='Triggered')
+    status = StringField(validate=validate.Length(max=10), default='Triggered')    # Triggered, Processing, Forwarded, Processed or Failed
     date = DateTimeField(default=datetime.datetime.utcnow)
+    owner = StringField(validate=validate.Length(max=200))  # the task runner instance processing the event
+    claim_date = DateTimeField()
 
     class Meta:
         collection_name = 'events'
+        indexes = [('status', 'claim_date')]
 
 @instance.register
 class EventQueue(Document):
@@ -373,7 +567,11 @@ class EventQueue(Document):
     async def release_lock(self):
         await self.collection.find_one_and_update({'_id': self.pk}, {'$set': {'rw_lock': False}})
 
-    async def pop(self):
+    async def pop(self, owner=None):
+        '''
+        Pop the first event, it's claimed by the owner before leaving the queue so that it's never lost,
+        the owner acknowledges it by the status when it's done
+        '''
         if not await self.acquire_lock():
             return None
         await self.reload()
@@ -382,6 +580,11 @@ class EventQueue(Document):
             return None
         event = self.events.pop(0)
         event = await event.fetch()
+        if owner and not isinstance(event, DBRef):
+            event.status = 'Processing'
+            event.owner = owner
+            event.claim_date = datetime.datetime.utcnow()
+            await event.commit()
         await self.commit()
         await self.release_lock()
         return event
@@ -392,6 +595,14 @@ class EventQueue(Document):
         self.events.append(event)
         await self.commit()
         await self.release_lock()
+
+    async def push_many(self, event_ids):
+        if not await self.acquire_lock():
+            raise RuntimeError('failed to acquire queue lock')
+        try:
+            await self.collection.update_one({'_id': self.pk}, {'$push': {'events': {'$each': list(event_ids)}}})
+        finally:
+            await self.release_lock()
     
     async def flush(self, cancelled=False):
         if not await self.acquire_lock():
@@ -444,6 +655,7 @@ class Package(Document):
 
     class Meta:
         collection_name = 'packages'
+        indexes = [('package_type', 'proprietary', 'name'), ('py_packages', 'organization', 'team', 'package_type')]
 
     async def get_package_by_version(self, version=None):
         if version is None and len(self.files) > 0:
@@ -504,6 +716,22 @@ class Documentation(Document):
 
     class Meta:
         collection_name = 'documents'
+        indexes = [('path', 'language')]
+
+# the documents whose declared indexes are created at startup, each hot query shape should be served by one of them
+INDEXED_DOCUMENTS = (Organization, Team, User, BlacklistToken, Test, Task, Pipeline, Endpoint, TaskQueue, TestResult,
+                     RobotResult, TaskLog, DurationStat, FairShareUsage, EndpointLease, ResourceBlob, Event, Package, Documentation)
+
+async def ensure_indexes():
+    '''
+    Create the indexes declared by the documents, those existing are left untouched
+    '''
+    for document in INDEXED_DOCUMENTS:
+        try:
+            await document.ensure_indexes()
+        except OperationFailure as e:
+            # eg. duplicate values against a unique index, the server keeps working without it
+            logger.error('Failed to create the indexes of {}: {}'.format(document.opts.collection_name, e))
 
 # def register_all(db):
 #     instance = Instance(db)
@@ -0,0 +1,132 @@
+import csv
+import io
+import json
+
+import pymongo
+
+from app.main.model.database import Endpoint, Task, TestResult, User
+
+EXPORT_BATCH_SIZE = 500
+REFERENCE_CACHE_SIZE = 10000    # resolved references kept among the batches before starting over
+
+TASK_FIELDS = ('id', 'test_id', 'test_suite', 'testcases', 'comment', 'priority', 'status', 'schedule_date', 'run_date',
+               'tester', 'endpoint', 'endpoint_list', 'parallelization', 'parent', 'rerun_of', 'pipeline')
+TASK_PROJECTION = {'test': 1, 'test_suite': 1, 'testcases': 1, 'comment': 1, 'priority': 1, 'status': 1, 'schedule_date': 1,
+                   'run_date': 1, 'tester': 1, 'endpoint_run': 1, 'endpoint_list': 1, 'parallelization': 1,
+                   'parent': 1, 'rerun_of': 1, 'pipeline': 1}
+TEST_RESULT_FIELDS = ('id', 'task_id', 'test_suite', 'test_case', 'test_site', 'test_date', 'duration', 'summary', 'status', 'more_result')
+TEST_RESULT_PROJECTION = {'test_case': 1, 'test_site': 1, 'task': 1, 'test_date': 1, 'duration': 1, 'summary': 1, 'status': 1, 'more_result': 1}
+
+def _str(value):
+    return str(value) if value is not None else None
+
+def _date(value):
+    return value.isoformat() + 'Z' if value else None
+
+async def _batches(cursor, size=EXPORT_BATCH_SIZE):
+    batch = []
+    async for raw in cursor:
+        batch.append(raw)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+class ReferenceResolver:
+    '''
+    Resolve the references of a batch of documents by one query per referenced collection
+    '''
+    def __init__(self, document, projection, convert):
+        self.document = document
+        self.projection = projection
+        self.convert = convert
+        self.cache = {}
+
+    async def resolve(self, ids):
+        wanted = {i for i in ids if i is not None}
+        missing = [i for i in wanted if i not in self.cache]
+        if not missing:
+            return
+        if len(self.cache) + len(missing) > REFERENCE_CACHE_SIZE:
+            self.cache = {}
+            missing = list(wanted)
+        for i in missing:
+            self.cache[i] = None
+        async for raw in self.document.collection.find({'_id': {'$in': missing}}, self.projection):
+            self.cache[raw['_id']] = self.convert(raw)
+
+    def get(self, i):
+        return self.cache.get(i, None)
+
+async def export_tasks(query):
+    '''
+    Generate the batches of the tasks matching the query as rows of TASK_FIELDS, the latest first
+    '''
+    testers = ReferenceResolver(User, {'name': 1}, lambda u: u.get('name', None))
+    endpoints = ReferenceResolver(Endpoint, {'name': 1, 'uid': 1}, lambda e: e.get('name', None) or _str(e.get('uid', None)))
+
+    cursor = Task.collection.find(query, TASK_PROJECTION).sort([('run_date', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)])
+    async for batch in _batches(cursor.batch_size(EXPORT_BATCH_SIZE)):
+        await testers.resolve([t.get('tester', None) for t in batch])
+        await endpoints.resolve([t.get('endpoint_run', None) for t in batch])
+        yield [{
+            'id': str(t['_id']),
+            'test_id': _str(t.get('test', None)),
+            'test_suite': t.get('test_suite', None),
+            'testcases': t.get('testcases', []),
+            'comment': t.get('comment', None),
+            'priority': t.get('priority', None),
+            'status': t.get('status', None),
+            'schedule_date': _date(t.get('schedule_date', None)),
+            'run_date': _date(t.get('run_date', None)),
+            'tester': testers.get(t.get('tester', None)),
+            'endpoint': endpoints.get(t.get('endpoint_run', None)),
+            'endpoint_list': [str(e) for e in t.get('endpoint_list', [])],
+            'parallelization': t.get('parallelization', False),
+            'parent': _str(t.get('parent', None)),
+            'rerun_of': _str(t.get('rerun_of', None)),
+            'pipeline': _str(t.get('pipeline', None)),
+        } for t in batch]
+
+async def export_test_results(query):
+    '''
+    Generate the batches of the test results of the tasks matching the query as rows of TEST_RESULT_FIELDS,
+    the test results of a batch of tasks are fetched by one query
+    '''
+    cursor = Task.collection.find(query, {'test_suite': 1}).sort([('run_date', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)])
+    async for tasks in _batches(cursor.batch_size(EXPORT_BATCH_SIZE)):
+        test_suites = {t['_id']: t.get('test_suite', None) for t in tasks}
+        results = TestResult.collection.find({'task': {'$in': list(test_suites)}}, TEST_RESULT_PROJECTION)
+        async for batch in _batches(results.batch_size(EXPORT_BATCH_SIZE)):
+            yield [{
+                'id': str(r['_id']),
+                'task_id': _str(r.get('task', None)),
+                'test_suite': test_suites.get(r.get('task', None), None),
+                'test_case': r.get('test_case', None),
+                'test_site': r.get('test_site', None),
+                'test_date': _date(r.get('test_date', None)),
+                'duration': r.get('duration', None),
+                'summary': r.get('summary', None),
+                'status': r.get('status', None),
+                'more_result': r.get('more_result', {}),
+            } for r in batch]
+
+async def to_ndjson(batches):
+    async for rows in batches:
+        yield ''.join(json.dumps(row, default=str) + '\n' for row in rows)
+
+async def to_csv(batches, fields):
+    '''
+    The lists and dictionaries are JSON encoded in their cells
+    '''
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=fields)
+    writer.writeheader()
+    yield buf.getvalue()
+    async for rows in batches:
+        buf.seek(0)
+        buf.truncate()
+        for row in rows:
+            writer.writerow({k: json.dumps(v, default=str) if isinstance(v, (list, dict)) else v for k, v in row.items()})
+        yield buf.getvalue()
@@ -0,0 +1,116 @@
+import uuid
+
+from marshmallow.exceptions import ValidationError
+from sanic.log import logger
+
+from app.main.model.database import (EVENT_CODE_START_TASK, QUEUE_PRIORITY_DEFAULT, QUEUE_PRIORITY_MAX,
+                                     QUEUE_PRIORITY_MIN, Endpoint, Task, TaskQueue, Test)
+from ..util import js2python_bool
+from ..util.eventqueue import push_events
+from ..util.response import response_message, EINVAL, ENOENT, ERANGE, EPERM, UNKNOWN_ERROR
+
+async def prepare_tasks(items, organization, team, user):
+    """
+    Validate the task specifications and build the tasks along with the endpoints to queue each of them on,
+    the test suites, endpoints and task queues are looked up with one query each.
+    Return (error response, None) or (None, plan) where plan is ([(task, [endpoint])], {(endpoint id, priority): task queue}).
+    The task specifications are left untouched, the parsed endpoint uids and priorities are kept aside.
+    """
+    parsed = []     # [(endpoint uids, priority)] of each task specification
+    for i, data in enumerate(items):
+        if not isinstance(data, dict):
+            return response_message(EINVAL, 'tasks[{}]: A task should be an object'.format(i)), None
+        if not data.get('test_suite', None) or data.get('path', None) is None:
+            return response_message(EINVAL, 'tasks[{}]: Field test_suite and path are required'.format(i)), None
+        endpoint_list = data.get('endpoint_list', None)
+        if not endpoint_list or not isinstance(endpoint_list, list):
+            return response_message(EINVAL, 'tasks[{}]: Endpoint list should be a non-empty list'.format(i)), None
+        try:
+            uids = [uuid.UUID(uid) for uid in endpoint_list]
+        except (ValueError, TypeError, AttributeError):
+            return response_message(EINVAL, 'tasks[{}]: One of the uid in the endpoint list is invalid'.format(i)), None
+        try:
+            priority = int(data.get('priority', QUEUE_PRIORITY_DEFAULT))
+        except ValueError:
+            return response_message(EINVAL, 'tasks[{}]: Task priority should be an integer'.format(i)), None
+        if priority < QUEUE_PRIORITY_MIN or priority > QUEUE_PRIORITY_MAX:
+            return response_message(ERANGE, 'tasks[{}]: Task priority is out of range'.format(i)), None
+        if not isinstance(data.get('variables', {}), dict):
+            return response_message(EINVAL, 'tasks[{}]: Variables should be a dictionary'.format(i)), None
+        if not isinstance(data.get('test_cases', []), list):
+            return response_message(EINVAL, 'tasks[{}]: Testcases should be a list'.format(i)), None
+        parsed.append((uids, priority))
+
+    scope = {'organization': organization.pk, 'team': team.pk if team else None}
+    tests = {}
+    async for test in Test.find({**scope, 'test_suite': {'$in': list({d['test_suite'] for d in items})}}):
+        tests.setdefault((test.test_suite, test.path), []).append(test)
+    uids = list({uid for endpoint_list, _ in parsed for uid in endpoint_list})
+    endpoints = {e.uid: e for e in await Endpoint.find({**scope, 'uid': {'$in': uids}}).to_list(len(uids))}
+    taskqueues = {}
+    async for taskqueue in TaskQueue.collection.find({**scope, 'endpoint': {'$in': [e.pk for e in endpoints.values()]}}, {'endpoint': 1, 'priority': 1, 'tasks': 1, 'running_task': 1}):
+        taskqueues[(taskqueue['endpoint'], taskqueue['priority'])] = taskqueue
+
+    new_tasks = []
+    for i, (data, (endpoint_list, priority)) in enumerate(zip(items, parsed)):
+        found = tests.get((data['test_suite'], data['path']), [])
+        if len(found) == 0:
+            return response_message(ENOENT, 'tasks[{}]: The requested test suite is not found'.format(i)), None
+        if len(found) > 1:
+            return response_message(EINVAL, 'tasks[{}]: Found duplicate test suites'.format(i)), None
+        if any(uid not in endpoints for uid in endpoint_list):
+            return response_message(EINVAL, 'tasks[{}]: One of the uid in the endpoint list is invalid'.format(i)), None
+        if any((endpoints[uid].pk, priority) not in taskqueues for uid in endpoint_list):
+            return response_message(ENOENT, 'tasks[{}]: Task queue not found'.format(i)), None
+
+        parallelization = js2python_bool(data.get('parallelization', False)) == True
+        # a parallelized task runs as a copy on each endpoint
+        targets = [[uid] for uid in endpoint_list] if parallelization else [endpoint_list]
+        for target in targets:
+            task = Task()
+            try:
+                task.test_suite = data['test_suite']
+                task.endpoint_list = endpoint_list
+                task.priority = priority
+                task.parallelization = parallelization
+                task.variables = data.get('variables', {})
+                task.testcases = data.get('test_cases', [])
+                task.tester = user
+                task.upload_dir = data.get('upload_dir', '')
+                task.test = found[0]
+                task.organization = organization
+                if team:
+                    task.team = team
+            except ValidationError as e:
+                logger.exception(e)
+                return response_message(EINVAL, 'tasks[{}]: Task validation failed'.format(i)), None
+            new_tasks.append((task, [endpoints[uid] for uid in target]))
+    return None, (new_tasks, taskqueues)
+
+async def schedule_tasks(plan, organization, team):
+    """
+    Insert the tasks prepared by prepare_tasks and queue them in a bulk,
+    one start event is pushed for each endpoint affected since it's enough to kick off the task loop.
+    Return (error response, None) or (None, (task ids, ids of the tasks going to run right away)).
+    """
+    new_tasks, taskqueues = plan
+    ret = await Task.collection.insert_many([t.to_mongo() for t, _ in new_tasks])
+
+    pushes = {}
+    running = []
+    for task_id, (task, targets) in zip(ret.inserted_ids, new_tasks):
+        for endpoint in targets:
+            taskqueue = taskqueues[(endpoint.pk, task.priority)]
+            if not taskqueue.get('running_task') and not taskqueue.get('tasks') and taskqueue['_id'] not in pushes:
+                running.append(str(task_id))
+            pushes.setdefault(taskqueue['_id'], []).append(task_id)
+    try:
+        await TaskQueue.push_many(pushes)
+    except RuntimeError:
+        await Task.collection.delete_many({'_id': {'$in': ret.inserted_ids}})
+        return response_message(UNKNOWN_ERROR, 'Failed to push tasks to the task queues'), None
+
+    affected = {endpoint.uid for _, targets in new_tasks for endpoint in targets}
+    if not await push_events(organization, team, EVENT_CODE_START_TASK, [{'endpoint_uid': uid} for uid in affected]):
+        return response_message(EPERM, 'Pushing the event to event queue failed'), None
+    return None, ([str(t) for t in ret.inserted_ids], running)
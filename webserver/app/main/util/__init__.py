@@ -19,6 +19,10 @@ def get_room_id(organization, team):
     org_team = organization + ':' + (team if team else '')
     return org_team
 
+def get_task_room_id(task_id):
+    # the clients viewing a task subscribe to its console output by its own room
+    return 'task:' + task_id
+
 def get_room_id_by_json(json):
     assert 'organization' in json
     team = json['team'] if 'team' in json else ''
@@ -0,0 +1,313 @@
+import asyncio
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from pathlib import Path
+
+import pymongo
+from async_files.utils import async_wraps
+from bson import ObjectId
+from bson.errors import InvalidId
+from sanic.log import logger
+
+from . import async_exists, async_makedirs, async_rmtree
+from .get_path import INCOMING_ROOT, PARTIAL_ROOT, UPLOAD_ROOT
+from ..model.database import ResourceBlob, Task
+
+BLOB_ROOT = UPLOAD_ROOT / '.blobs'
+MANIFEST_SUFFIX = '.manifest.json'
+FINISHED_STATUS = ('successful', 'failed', 'cancelled')
+INCREF_RETRIES = 100    # tries in 0.1 seconds apart to reference a blob being removed by the garbage collection
+
+def get_blob_path(digest):
+    return BLOB_ROOT / digest[:2] / digest[2:4] / digest
+
+def get_manifest_path(directory):
+    """
+    The manifest sits next to the directory to keep it out of the file listing and tarballs of the directory
+    """
+    directory = Path(directory)
+    return directory.parent / (directory.name + MANIFEST_SUFFIX)
+
+def _load_manifest(directory):
+    try:
+        with open(get_manifest_path(directory)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def _save_manifest(directory, manifest):
+    manifest_path = get_manifest_path(directory)
+    manifest_tmp = manifest_path.with_suffix('.tmp')
+    with open(manifest_tmp, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_tmp, manifest_path)
+
+load_manifest = async_wraps(_load_manifest)
+save_manifest = async_wraps(_save_manifest)
+
+def _link_or_copy(src, dst):
+    """
+    Hard link the file, copy it if the destination is on another file system
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def _store_blob(src, digest):
+    blob = get_blob_path(digest)
+    if os.path.exists(blob):
+        os.remove(src)
+    else:
+        os.makedirs(blob.parent, exist_ok=True)
+        os.replace(src, blob)
+    return blob
+
+async def _incref(digest, size=0, count=1):
+    """
+    Take the references on a blob, a blob being removed by the garbage collection can't be referenced
+    until it's gone, then its document is created anew
+    """
+    live = {'sha256': digest, 'deleting': {'$ne': True}}
+    for _ in range(INCREF_RETRIES):
+        try:
+            await ResourceBlob.collection.find_one_and_update(
+                live,
+                {'$inc': {'refcount': count}, '$setOnInsert': {'size': size, 'schema_version': '1', 'create_date': datetime.datetime.utcnow()}},
+                upsert=True)
+            return
+        except pymongo.errors.DuplicateKeyError:
+            # lost the upsert race, or the document exists but the blob is being removed
+            if await ResourceBlob.collection.find_one_and_update(live, {'$inc': {'refcount': count}}):
+                return
+        await asyncio.sleep(0.1)
+    raise RuntimeError(f'Resource blob {digest} is being removed')
+
+async def release_blob(digest):
+    await ResourceBlob.collection.find_one_and_update({'sha256': digest}, {'$inc': {'refcount': -1}})
+
+async def add_file(src, digest, dest):
+    """
+    Move the file to the blob store if the content is not there yet, otherwise drop it,
+    then link the blob to the destination in place of the file.
+    The reference is taken first so that the garbage collection can't remove the blob in between.
+    """
+    size = os.path.getsize(src)
+    await _incref(digest, size)
+    try:
+        blob = await async_wraps(_store_blob)(src, digest)
+        await async_wraps(_link_or_copy)(blob, dest)
+    except Exception:
+        await release_blob(digest)
+        raise
+
+async def link_blob(digest, dest):
+    """
+    Link an existing blob to the destination, return False if the blob is missing
+    """
+    blob = get_blob_path(digest)
+    await _incref(digest)
+    try:
+        if not await async_exists(blob):
+            await release_blob(digest)
+            return False
+        await async_wraps(_link_or_copy)(blob, dest)
+    except Exception:
+        await release_blob(digest)
+        raise
+    return True
+
+async def store_files(directory, files):
+    """
+    Store the uploaded files of [(temp path, file name, sha256)] in the directory, recording them in its manifest
+    """
+    manifest = await load_manifest(directory)
+    for path, name, digest in files:
+        old = manifest.get(name)
+        await add_file(path, digest, Path(directory) / name)
+        manifest[name] = digest
+        if old:
+            await release_blob(old)
+    await save_manifest(directory, manifest)
+    return manifest
+
+async def link_files(src_dir, dst_dir, names=None):
+    """
+    Populate the destination directory with the files of the source directory by hard links to the blobs,
+    files not in the source manifest, eg. uploaded before the blob store was introduced, are copied.
+    Return the file names that are not found.
+    """
+    src_manifest = await load_manifest(src_dir)
+    dst_manifest = await load_manifest(dst_dir)
+    if names is None:
+        names = [f for f in await async_wraps(os.listdir)(src_dir) if await async_wraps(os.path.isfile)(Path(src_dir) / f)]
+    await async_makedirs(dst_dir, exist_ok=True)
+    missing = []
+    for name in names:
+        digest = src_manifest.get(name)
+        if digest and await link_blob(digest, Path(dst_dir) / name):
+            old = dst_manifest.get(name)
+            dst_manifest[name] = digest
+            if old:
+                await release_blob(old)
+            continue
+        if not await async_exists(Path(src_dir) / name):
+            missing.append(name)
+            continue
+        await async_wraps(_link_or_copy)(Path(src_dir) / name, Path(dst_dir) / name)
+    await save_manifest(dst_dir, dst_manifest)
+    return missing
+
+def _directory_digest(directory, manifest):
+    sha256 = hashlib.sha256()
+    for root, dirs, files in sorted(os.walk(directory)):
+        for f in sorted(files):
+            path = os.path.join(root, f)
+            name = os.path.relpath(path, directory).replace(os.sep, '/')
+            if name in manifest:
+                sha256.update(f'{name}\0{manifest[name]}\n'.encode('utf-8'))
+            else:
+                st = os.stat(path)
+                sha256.update(f'{name}\0{st.st_size}:{st.st_mtime_ns}\n'.encode('utf-8'))
+    return sha256.hexdigest()
+
+async def directory_digest(directory):
+    """
+    A digest of the directory content, derived from the blob digests in the manifest without reading the files,
+    files not in the manifest contribute their size and modification time
+    """
+    manifest = await load_manifest(directory)
+    return await async_wraps(_directory_digest)(directory, manifest)
+
+def _take_manifest(directory):
+    """
+    Rename the manifest away before reading it so that only one caller gets it
+    """
+    manifest_path = get_manifest_path(directory)
+    taken = manifest_path.parent / (manifest_path.name + '.' + uuid.uuid4().hex)
+    try:
+        os.rename(manifest_path, taken)
+    except FileNotFoundError:
+        return {}
+    try:
+        with open(taken) as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+    finally:
+        os.remove(taken)
+
+async def release_files(directory):
+    """
+    Drop the blob references of a directory before it's removed, the references are dropped once even if
+    the directory is released again or concurrently
+    """
+    manifest = await async_wraps(_take_manifest)(directory)
+    for digest in manifest.values():
+        await release_blob(digest)
+
+async def remove_files(directory):
+    """
+    Remove a directory populated by store_files or link_files along with its blob references
+    """
+    await release_files(directory)
+    await async_rmtree(directory, ignore_errors=True)
+
+async def expire_upload_dirs(horizon):
+    """
+    Remove the upload directories created before the horizon that no unfinished task uses,
+    the files of the finished tasks have been linked into their result directories.
+    Return the number of directories removed.
+    """
+    expired = []
+    for name in await async_wraps(os.listdir)(UPLOAD_ROOT):
+        try:
+            # the upload directories are named by ObjectIds, the others like .blobs are skipped
+            if ObjectId(name) >= ObjectId.from_datetime(horizon):
+                continue
+        except InvalidId:
+            continue
+        if await async_wraps(os.path.isdir)(UPLOAD_ROOT / name):
+            expired.append(name)
+    if not expired:
+        return 0
+
+    in_use = set(await Task.collection.distinct('upload_dir', {'upload_dir': {'$in': expired}, 'status': {'$nin': FINISHED_STATUS}}))
+    cnt = 0
+    for name in expired:
+        if name not in in_use:
+            await remove_files(UPLOAD_ROOT / name)
+            cnt += 1
+    if cnt:
+        logger.info(f'Removed {cnt} expired upload directories')
+    return cnt
+
+def _latest_mtime(path):
+    latest = os.path.getmtime(path)
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            try:
+                latest = max(latest, os.path.getmtime(os.path.join(root, name)))
+            except FileNotFoundError:
+                pass
+    return latest
+
+def _expire_partial_uploads(max_age):
+    deadline = time.time() - max_age
+    cnt = 0
+    for root in (PARTIAL_ROOT, INCOMING_ROOT):
+        try:
+            names = os.listdir(root)
+        except FileNotFoundError:
+            continue
+        for name in names:
+            path = root / name
+            try:
+                if _latest_mtime(path) >= deadline:
+                    continue
+            except FileNotFoundError:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+            cnt += 1
+    return cnt
+
+async def expire_partial_uploads(max_age):
+    """
+    Remove the chunked uploads and the incoming multipart files not written for max_age seconds, those of the
+    clients which gave up, the files are not in the blob store yet. Return the number of uploads removed.
+    """
+    cnt = await async_wraps(_expire_partial_uploads)(max_age)
+    if cnt:
+        logger.info(f'Removed {cnt} abandoned partial uploads')
+    return cnt
+
+async def collect_garbage():
+    """
+    Remove the blobs that are no longer referenced by any directory.
+    A blob is marked as being deleted first, no references can be taken on it until both the file and
+    the document are gone, those marked by an interrupted collection are picked up again.
+    """
+    cnt = 0
+    async for blob in ResourceBlob.find({'refcount': {'$lte': 0}}):
+        res = await ResourceBlob.collection.update_one({'_id': blob.pk, 'refcount': {'$lte': 0}}, {'$set': {'deleting': True}})
+        if res.matched_count == 0:
+            continue
+        try:
+            await async_wraps(os.remove)(get_blob_path(blob.sha256))
+        except FileNotFoundError:
+            pass
+        await ResourceBlob.collection.delete_one({'_id': blob.pk})
+        cnt += 1
+    if cnt:
+        logger.info(f'Removed {cnt} unreferenced resource blobs')
+    return cnt
@@ -6,8 +6,12 @@ from sanic.response import json
 from sanic.views import HTTPMethodView
 
 from ..model.database import Organization, Task, Team, User
-from ..util import js2python_bool, js2python_variable
-from ..util.response import SUCCESS, EINVAL, ENOENT, EPERM, response_message, USER_NOT_EXIST, ADMIN_TOKEN_REQUIRED
+from ..util import js2python_bool, js2python_variable, async_makedirs
+from ..util.get_path import INCOMING_ROOT
+from ..util.multipart import receive_multipart, MultipartError, UploadTooLarge
+from ..util.tempdir import TemporaryDirectory
+from ..util.response import SUCCESS, EINVAL, ENOENT, EPERM, EFBIG, response_message, USER_NOT_EXIST, ADMIN_TOKEN_REQUIRED
+from task_runner.util.archive import find_archived_task
 
 
 def token_required(f):
@@ -175,14 +179,38 @@ def organization_team_required_by_form(f):
         if isinstance(args[0], HTTPMethodView):
             request = args[1]
 
-        request.ctx.data = request.form
+        request.ctx.data = request.ctx.form if hasattr(request.ctx, 'form') else request.form
         ret = await organization_team_required(request, *args, **kwargs)
         if ret['code'] != SUCCESS.code:
             return json(ret)
         return await f(*args, **kwargs)
     return decorated
 
-def task_required(f):
+def multipart_form_streamed(f):
+    '''
+    Receive the multipart/form-data request body in a streamed manner, the files are written to a temporary
+    directory as they arrive and hashed on the fly, the directory is removed after the request is handled.
+    The form fields and files are put in request.ctx.form and request.ctx.files, the handler needs to be
+    decorated by sanic.views.stream to get the request body stream.
+    '''
+    @wraps(f)
+    async def decorated(*args, **kwargs):
+        request = args[0]
+        if isinstance(args[0], HTTPMethodView):
+            request = args[1]
+
+        await async_makedirs(INCOMING_ROOT, exist_ok=True)
+        async with TemporaryDirectory(dir=INCOMING_ROOT) as incoming_dir:
+            try:
+                request.ctx.form, request.ctx.files = await receive_multipart(request, incoming_dir, request.app.config.UPLOAD_MAX_SIZE)
+            except UploadTooLarge as e:
+                return json(response_message(EFBIG, str(e)), status=413)
+            except MultipartError as e:
+                return json(response_message(EINVAL, str(e)))
+            return await f(*args, **kwargs)
+    return decorated
+
+def task_required(f, archived=False):
     '''
     Should only be used after organization_team_required_by_xxx family decorators to reuse field data in the kwargs
     '''
@@ -201,6 +229,8 @@ def task_required(f):
             return json(response_message(EINVAL, 'Field task_id is required'))
 
         task = await Task.find_one({'_id': ObjectId(task_id)})
+        if not task and archived:
+            task = await find_archived_task(task_id)
         if not task:
             return json(response_message(ENOENT, 'Task not found'))
         
@@ -212,3 +242,9 @@ def task_required(f):
         return await f(*args, **kwargs)
 
     return decorated
+
+def task_or_archive_required(f):
+    '''
+    Same as task_required but the task may have been archived, the result files of which are in task.result_archive
+    '''
+    return task_required(f, archived=True)
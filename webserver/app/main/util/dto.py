@@ -98,6 +98,8 @@ class TaskDto:
     class task_cancel(task_id):
         endpoint_uid = doc.String(description='The endpoint uid that is running the test')
         priority = doc.Integer(description='The priority of the task')
+    class task_rerun(task_id):
+        priority = doc.Integer(description='The priority of the rerun, default to that of the task')
     class task_stat_list(json_response):
         class _task_stat_list:
             class _task_stat_of_a_day:
@@ -113,9 +115,39 @@ class TaskDto:
         endpoint_list = doc.List(doc.String(description='The endpoints to run the test'))
         priority = doc.Integer(description='The priority of the task(larger number means higher importance)')
         parallelization = doc.Boolean() #default=False)
+        placement = doc.String(description='all: queue the task on every endpoint of the list, any: queue it on the one expected to finish it first, shard: split the test cases to run on the endpoints') #default='all'
+        shards = doc.Integer(description='The number of shards for placement shard, default to the number of endpoints')
         variables = doc.List(doc.String())
         test_cases = doc.List(doc.String())
         upload_dir = doc.String(description='The directory id of the upload files')
+    class task_bulk(organization_team):
+        tasks = doc.List(doc.Object(task), description='The tasks to schedule')
+
+class PipelineDto:
+    class pipeline_id(organization_team):
+        pipeline_id = doc.String(required=True, description='The pipeline id')
+    class pipeline(organization_team):
+        class _node:
+            name = doc.String(required=True, description='The node name unique in the pipeline')
+            depends_on = doc.List(doc.String(), description='The names of the nodes to finish before this one')
+            condition = doc.String(description='success: run if all of the dependencies succeeded, failure: run if any of them failed, always: run anyway') #default='success'
+            task = doc.Object(TaskDto.task, description='The task to run, parallelization fans it out to every endpoint of the list')
+        name = doc.String(description='The pipeline name')
+        nodes = doc.List(doc.Object(_node))
+    class pipeline_info(json_response):
+        class _pipeline_info:
+            class _node_info:
+                name = doc.String()
+                depends_on = doc.List(doc.String())
+                condition = doc.String()
+                status = doc.String(description='pending, running, successful, failed, skipped or cancelled')
+                tasks = doc.List(doc.String(), description='The ids of the tasks of the node')
+            pipeline_id = doc.String()
+            name = doc.String()
+            status = doc.String(description='running, successful, failed or cancelled')
+            create_date = doc.Integer(description='Timestamp in milliseconds')
+            nodes = doc.List(doc.Object(_node_info))
+        data = doc.Object(_pipeline_info)
 
 class TestResultDto:
     class test_result_query:
@@ -127,6 +159,17 @@ class TestResultDto:
         sort = doc.String(description='The sort field') #default='-run_date'
         start_date = doc.String(description='The start date')
         end_date = doc.String(description='The end date')
+        cursor = doc.String(description='The next_cursor of the previous page, the page number is ignored if it is given')
+        total = doc.String(description='exact, cached, estimated or none, default to exact without a cursor and none with it')
+
+    class test_result_export_query:
+        kind = doc.String(description='task or testresult') #default='task'
+        format = doc.String(description='ndjson or csv') #default='ndjson'
+        title = doc.String(description='The test suite name')
+        priority = doc.Integer(description='The priority of the task')
+        endpoint = doc.String(description='The endpoint that runs the test')
+        start_date = doc.String(description='The start date')
+        end_date = doc.String(description='The end date')
 
     class test_report(json_response):
         class _test_report:
@@ -142,6 +185,7 @@ class TestResultDto:
                 status = doc.String()
             test_reports = doc.List(_test_report_summary)
             total = doc.Integer()
+            next_cursor = doc.String(description='The cursor of the next page, null on the last page')
         data = doc.Object(_test_report)
     class task_id:
         task_id = doc.String(required=True, description='The task id')
@@ -164,7 +208,23 @@ class TaskResourceDto:
     class task_resource_response(json_response):
         class _task_resource_resp:
             resource_id = doc.String()
+            files = doc.JsonBody(description='The sha256 digests of the uploaded files keyed by the file names')
         data = doc.Object(_task_resource_resp)
+    class chunked_upload(organization_team):
+        resource_id = doc.String(description='The directory id to accommodate uploaded files')
+        file = doc.String(required=True, description='The file name')
+        size = doc.Integer(required=True, description='The total file size in bytes')
+    class chunk_query(organization_team):
+        resource_id = doc.String(required=True, description='The directory id to accommodate uploaded files')
+        file = doc.String(required=True, description='The file name')
+        offset = doc.Integer(required=True, description='The offset in the file the chunk starts from')
+    class chunked_upload_response(json_response):
+        class _chunked_upload_resp:
+            resource_id = doc.String()
+            offset = doc.Integer(description='The offset the next chunk should be uploaded from')
+            complete = doc.Boolean()
+            sha256 = doc.String(description='The sha256 digest of the file when the upload is complete')
+        data = doc.Object(_chunked_upload_resp)
     class task_resource_file_list(json_response):
         class _task_resource_file_list:
             class _file_list:
@@ -182,6 +242,8 @@ class EndpointDto:
         title = doc.String(description='The test suite name')
         forbidden = doc.String(description='Get endpoints that are forbidden to connect')
         unauthorized = doc.String(description='Get endpoints that have not authorized to connect')
+        cursor = doc.String(description='The next_cursor of the previous page, the page number is ignored if it is given')
+        total = doc.String(description='exact, cached, estimated or none, default to exact without a cursor and none with it')
 
     class endpoint_list(json_response):
         class _endpoint_list:
@@ -196,6 +258,7 @@ class EndpointDto:
                 endpoint_uid = doc.String()
             endpoints = doc.List(doc.Object(_endpoint_item), description='endpoints of the current queried page')
             total = doc.Integer(description='total number of the queried the endpoints')
+            next_cursor = doc.String(description='The cursor of the next page, null on the last page')
         data = doc.Object(_endpoint_list)
     class endpoint_uid(organization_team):
         endpoint_uid = doc.String()
@@ -214,6 +277,8 @@ class EndpointDto:
                     task = doc.String(description="The test name")
                     task_id = doc.String(description="The task id")
                     status = doc.String()
+                    expected_duration = doc.Float(description="The expected run time in seconds, null if never run before")
+                    eta = doc.Float(description="Seconds to wait before it starts, or the remaining time of a running task, null if unknown")
                 endpoint_uid = doc.String(description="The endpoint uid")
                 endpoint = doc.String(description="The endpoint name")
                 priority = doc.Integer()
@@ -226,6 +291,17 @@ class EndpointDto:
         class _endpoint_online_check:
             status = doc.Boolean()
         data = doc.Object(_endpoint_online_check)
+    class fair_share_list(json_response):
+        class _fair_share_list:
+            class _fair_share:
+                endpoint_uid = doc.String(description='The endpoint uid')
+                weight = doc.Float(description='The share weight of the organization')
+                usage = doc.Float(description='Seconds of running tasks on the endpoint, decayed by the half life')
+                tasks = doc.Integer(description='The number of tasks run on the endpoint')
+                wait_mean = doc.Float(description='The mean seconds a task waited before running')
+                wait_max = doc.Float(description='The maximum seconds a task waited before running')
+            shares = doc.List(_fair_share)
+        data = doc.Object(_fair_share_list)
 
 class ScriptDto:
     class update_script(organization_team):
@@ -300,6 +376,9 @@ class OrganizationDto:
     class transfer_ownership(organization_id):
         new_owner = doc.String(description='The new owner\'s ID')
 
+    class share_weight(organization_id):
+        weight = doc.Float(description='The weight of sharing the endpoints with other organizations, default to 1')
+
     class organization_avatar(json_response):
         class _organization_avatar:
             type = doc.String()
@@ -353,6 +432,8 @@ class StoreDto:
         title = doc.String()
         proprietary = doc.String()
         package_type = doc.String()
+        cursor = doc.String(description='The next_cursor of the previous page, the page number is ignored if it is given')
+        total = doc.String(description='exact, cached, estimated or none, default to exact without a cursor and none with it')
 
     class package_info_query:
         name = doc.String()
@@ -393,6 +474,7 @@ class StoreDto:
                 upload_date = doc.Integer(description='The upload date in form of timestamp from the epoch in milliseconds')
             packages = doc.List(doc.Object(_package_summary))
             total = doc.Integer()
+            next_cursor = doc.String(description='The cursor of the next page, null on the last page')
         data = doc.Object(_package_list)
 
 class PypiDto:
@@ -20,3 +20,29 @@ async def push_event(organization, team, code, message=None):
         logger.error('Failed to push the event')
         return False
     return True
+
+async def push_events(organization, team, code, messages):
+    """
+    Push the events of the same code in one insert and one queue update
+    """
+    events = []
+    for message in messages:
+        event = Event(organization=organization, code=code, message=message)
+        if team:
+            event.team = team
+        events.append(event)
+    if not events:
+        return True
+    ret = await Event.collection.insert_many([e.to_mongo() for e in events])
+
+    eventqueue = await EventQueue.find_one({})
+    if not eventqueue:
+        logger.error('Event queue not found')
+        return False
+
+    try:
+        await eventqueue.push_many(ret.inserted_ids)
+    except RuntimeError:
+        logger.error('Failed to push the events')
+        return False
+    return True
@@ -0,0 +1,120 @@
+import gzip
+import os
+import shutil
+from email.utils import formatdate, parsedate_to_datetime
+from mimetypes import guess_type
+
+from async_files.utils import async_wraps
+from sanic.exceptions import HeaderNotFound
+from sanic.handlers import ContentRangeHandler
+from sanic.response import HTTPResponse, file_stream, stream
+
+CHUNK_SIZE = 64 * 1024
+GZIP_SUFFIX = '.gz'
+PRECOMPRESS_FILES = ('output.xml', 'log.html', 'report.html')
+PRECOMPRESS_MIN_SIZE = 1024
+
+def _compress_file(filename):
+    gz_file = filename + GZIP_SUFFIX
+    gz_tmp = gz_file + '.tmp'
+    with open(filename, 'rb') as src, gzip.open(gz_tmp, 'wb', compresslevel=6) as dst:
+        shutil.copyfileobj(src, dst, CHUNK_SIZE)
+    shutil.copystat(filename, gz_tmp)
+    os.replace(gz_tmp, gz_file)
+
+@async_wraps
+def precompress_files(directory, files=PRECOMPRESS_FILES):
+    """
+    Store gzip compressed siblings of the big result files so that they can be served compressed without
+    compressing them on every request
+    """
+    for f in files:
+        filename = os.path.join(directory, f)
+        try:
+            if os.path.getsize(filename) < PRECOMPRESS_MIN_SIZE:
+                continue
+        except OSError:
+            continue
+        _compress_file(filename)
+
+def _opaque_tag(etag):
+    etag = etag.strip()
+    return etag[2:] if etag.startswith('W/') else etag
+
+def is_not_modified(request, etag, mtime=None):
+    """
+    Evaluate the conditional headers of a GET request against the validators of the content,
+    If-None-Match is compared weakly as RFC 7232 asks, If-Modified-Since is only checked without it
+    """
+    if_none_match = request.headers.get('If-None-Match', None)
+    if if_none_match is not None:
+        if if_none_match.strip() == '*':
+            return True
+        return _opaque_tag(etag) in [_opaque_tag(t) for t in if_none_match.split(',')]
+    if_modified_since = request.headers.get('If-Modified-Since', None)
+    if if_modified_since and mtime is not None:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            pass
+    return False
+
+async def serve_file_object(fp, status=200, mime_type=None):
+    """
+    Stream a readable binary file object in chunks read in a thread, eg. a member of an archive, it's closed at the end
+    """
+    read = async_wraps(fp.read)
+
+    async def streaming_fn(response):
+        try:
+            while True:
+                chunk = await read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                await response.write(chunk)
+        finally:
+            fp.close()
+
+    return stream(streaming_fn, status=status, content_type=mime_type or 'application/octet-stream')
+
+async def serve_file(request, location, status=200, mime_type=None):
+    """
+    Stream a file with the validators ETag and Last-Modified, single byte range requests are supported.
+    The precompressed gzip sibling is sent instead if the client accepts gzip and the sibling is up to date.
+    """
+    location = str(location)
+    stats = await async_wraps(os.stat)(location)
+    mime_type = mime_type or guess_type(location)[0] or 'application/octet-stream'
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'Last-Modified': formatdate(stats.st_mtime, usegmt=True),
+        'Vary': 'Accept-Encoding',
+    }
+
+    if 'Range' not in request.headers and 'gzip' in request.headers.get('Accept-Encoding', ''):
+        try:
+            gz_stats = await async_wraps(os.stat)(location + GZIP_SUFFIX)
+        except FileNotFoundError:
+            pass
+        else:
+            if gz_stats.st_mtime >= stats.st_mtime:
+                etag = '"{:x}-{:x}-gz"'.format(stats.st_size, stats.st_mtime_ns)
+                headers['ETag'] = etag
+                if is_not_modified(request, etag, stats.st_mtime):
+                    return HTTPResponse(status=304, headers=headers)
+                headers['Content-Encoding'] = 'gzip'
+                headers['Content-Length'] = str(gz_stats.st_size)
+                return await file_stream(location + GZIP_SUFFIX, status=status, chunk_size=CHUNK_SIZE, mime_type=mime_type, headers=headers)
+
+    etag = '"{:x}-{:x}"'.format(stats.st_size, stats.st_mtime_ns)
+    headers['ETag'] = etag
+    if is_not_modified(request, etag, stats.st_mtime):
+        return HTTPResponse(status=304, headers=headers)
+
+    try:
+        _range = ContentRangeHandler(request, stats)
+    except HeaderNotFound:
+        headers['Content-Length'] = str(stats.st_size)
+        return await file_stream(location, status=status, chunk_size=CHUNK_SIZE, mime_type=mime_type, headers=headers)
+    headers['Content-Length'] = str(_range.size)
+    return await file_stream(location, chunk_size=CHUNK_SIZE, mime_type=mime_type, headers=headers, _range=_range)
@@ -1,10 +1,15 @@
+import hashlib
 import os
+import time
+from collections import OrderedDict
+from bson import ObjectId
 from sanic.log import logger
 from app import app
 from pathlib import Path
 
 from ..model.database import *
 from .response import *
+from . import async_exists
 
 TEST_RESULTS_ROOT = 'test_results'
 USER_SCRIPT_ROOT = 'user_scripts'
@@ -14,9 +19,16 @@ USER_DOCUMENT_ROOT = 'document'
 USER_PICTURE_ROOT = 'pictures'
 USERS_ROOT = Path(app.config.USERS_ROOT)
 UPLOAD_ROOT = Path(app.config.UPLOAD_ROOT)
+PARTIAL_ROOT = UPLOAD_ROOT / '.partial'     # the files of the chunked uploads in progress
+INCOMING_ROOT = UPLOAD_ROOT / '.incoming'   # the files of the streamed multipart requests in progress
 STORE_ROOT = Path(app.config.STORE_ROOT)
 DOCUMENT_ROOT = Path(app.config.DOCUMENT_ROOT)
 PICTURE_ROOT = Path(app.config.PICTURE_ROOT)
+USERS_ROOT_CACHE_SIZE = 10000
+PROPRIETARY_CACHE_TTL = 60
+
+_users_roots = OrderedDict()   # {(organization id, team id): USERS_ROOT/<organization>[/<team>]}, least recently used first
+_proprietary = {}             # {test id: (proprietary, cached time)}
 
 UPLOAD_ROOT.mkdir(parents=True, exist_ok=True)
 USERS_ROOT.mkdir(parents=True, exist_ok=True)
@@ -25,78 +37,126 @@ DOCUMENT_ROOT.mkdir(parents=True, exist_ok=True)
 PICTURE_ROOT.mkdir(parents=True, exist_ok=True)
 
 
-async def get_test_result_path(task):
-    return await get_test_results_root(task) / str(task.pk)
+def get_result_shard(task_id):
+    '''
+    The shard of a task's result directory by the creation month in the task id and a hash of it, eg. 2026/10/ab
+    '''
+    task_id = ObjectId(task_id)
+    return '{:%Y/%m}/{}'.format(task_id.generation_time, hashlib.sha1(task_id.binary).hexdigest()[:2])
+
+async def resolve_test_result_path(results_root, task_id):
+    '''
+    The result directory of a task under the results root, the directories not migrated from the flat layout yet are found as well
+    '''
+    flat = results_root / str(task_id)
+    if app.config.RESULT_LAYOUT == 'flat':
+        return flat
+    sharded = results_root / get_result_shard(task_id) / str(task_id)
+    if not await async_exists(sharded) and await async_exists(flat):
+        return flat
+    return sharded
 
-async def get_test_results_root(task=None, team=None, organization=None):
+async def get_test_result_path(task):
+    return await resolve_test_result_path(await get_test_results_root(task), task.pk)
+
+async def get_users_root(task=None, team=None, organization=None):
+    '''
+    The root of the files of a task's organization and team, USERS_ROOT/<organization>[/<team>].
+    The paths are cached by the ids of the organization and team so that a task's organization and team are fetched
+    only the first time, it's fine since a path is set once when an organization or team is created, the entry is
+    invalidated when it's deleted.
+    '''
     if task:
         if team or organization:
             logger.error('team or organization should not used along wite task')
             return None
-        organization = await task.organization.fetch()
-        team = None
-        if task.team:
-            team = await task.team.fetch()
+        key = (task.organization.pk, task.team.pk if task.team else None)
+    else:
+        key = (organization.pk, team.pk if team else None)
 
-    result_dir = USERS_ROOT / organization.path
-    if team:
-        result_dir = result_dir / team.path
-    result_dir = result_dir / TEST_RESULTS_ROOT
-    return result_dir
+    users_root = _users_roots.get(key, None)
+    if users_root:
+        _users_roots.move_to_end(key)
+        return users_root
 
-async def get_back_scripts_root(task=None, team=None, organization=None):
     if task:
-        if team or organization:
-            logger.error('team or organization should not used along wite task')
-            return None
         organization = await task.organization.fetch()
         team = None
         if task.team:
             team = await task.team.fetch()
-
-    result_dir = USERS_ROOT / organization.path
+    users_root = USERS_ROOT / organization.path
     if team:
-        result_dir = result_dir / team.path
-    result_dir = result_dir / BACK_SCRIPT_ROOT
-    return result_dir
+        users_root = users_root / team.path
+    _users_roots[key] = users_root
+    if len(_users_roots) > USERS_ROOT_CACHE_SIZE:
+        _users_roots.popitem(last=False)
+    return users_root
+
+def invalidate_users_root(organization=None, team=None):
+    '''
+    Drop the cached paths of an organization and its teams, or of a team
+    '''
+    for key in [k for k in _users_roots if (organization and k[0] == organization.pk) or (team and k[1] == team.pk)]:
+        del _users_roots[key]
+
+async def is_test_proprietary(test):
+    '''
+    Whether the package of a test is proprietary, cached for a while as a test is rarely moved to another package
+    '''
+    test_id = test.pk
+    cached = _proprietary.get(test_id, None)
+    if cached and time.monotonic() - cached[1] < PROPRIETARY_CACHE_TTL:
+        return cached[0]
+    test = await test.fetch()
+    proprietary = False
+    if test and test.package:
+        package = await test.package.fetch()
+        proprietary = package.proprietary if package else False
+    if len(_proprietary) >= USERS_ROOT_CACHE_SIZE:
+        _proprietary.clear()
+    _proprietary[test_id] = (proprietary, time.monotonic())
+    return proprietary
 
-async def get_user_scripts_root(task=None, team=None, organization=None):
-    if task:
-        if team or organization:
-            logger.error('team or organization should not used along wite task')
-            return None
-        organization = await task.organization.fetch()
-        team = None
-        if task.team:
-            team = await task.team.fetch()
+async def get_test_results_root(task=None, team=None, organization=None):
+    users_root = await get_users_root(task, team, organization)
+    if users_root is None:
+        return None
+    return users_root / TEST_RESULTS_ROOT
 
-    result_dir = USERS_ROOT / organization.path
-    if team:
-        result_dir = result_dir / team.path
-    result_dir = result_dir / USER_SCRIPT_ROOT
-    return result_dir
+async def get_back_scripts_root(task=None, team=None, organization=None):
+    users_root = await get_users_root(task, team, organization)
+    if users_root is None:
+        return None
+    return users_root / BACK_SCRIPT_ROOT
+
+async def get_user_scripts_root(task=None, team=None, organization=None):
+    users_root = await get_users_root(task, team, organization)
+    if users_root is None:
+        return None
+    return users_root / USER_SCRIPT_ROOT
 
 def get_upload_files_root(task):
     return UPLOAD_ROOT / task.upload_dir
 
+async def get_task_resource_root(task):
+    """
+    The upload directory of a task, or the resource directory in its results once the upload directory expired
+    """
+    upload_root = get_upload_files_root(task)
+    if await async_exists(upload_root):
+        return upload_root
+    return await get_test_result_path(task) / 'resource'
+
 async def get_test_store_root(task=None, proprietary=False, team=None, organization=None):
     if task:
-        organization = await task.organization.fetch()
-        team = None
-        if task.team:
-            team = await task.team.fetch()
-        test = await task.test.fetch()
-        package = await test.package.fetch()
-        proprietary = package.proprietary if test.package else False
+        proprietary = await is_test_proprietary(task.test) if task.test else False
+        if not proprietary:
+            return STORE_ROOT
+        return await get_users_root(task) / TEST_PACKAGE_ROOT
 
     if not proprietary or (not team and not organization):
         return STORE_ROOT
-
-    store_dir = USERS_ROOT / organization.path
-    if team:
-        store_dir = store_dir / team.path
-    store_dir = store_dir / TEST_PACKAGE_ROOT
-    return store_dir
+    return await get_users_root(team=team, organization=organization) / TEST_PACKAGE_ROOT
 
 def is_path_secure(path):
     if not isinstance(path, Path):
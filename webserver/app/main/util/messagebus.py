@@ -0,0 +1,104 @@
+import asyncio
+import pickle
+
+import motor.motor_asyncio
+from socketio.asyncio_pubsub_manager import AsyncPubSubManager
+from pymongo import CursorType, ReturnDocument
+from pymongo.errors import CollectionInvalid, PyMongoError
+from sanic.log import logger
+
+class MongoManager(AsyncPubSubManager):
+    '''
+    Socket.io client manager sharing the emits among processes by a capped collection of MongoDB.
+
+    Each message is numbered by a counter of the channel, every process tails the capped collection
+    from the number of the latest message at the time it starts listening.
+    '''
+    name = 'mongo'
+
+    def __init__(self, url, database, channel='socketio', size=16 * 1024 * 1024, write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.url = url
+        self.database = database
+        self.size = size
+        self.connection = None
+        self.cursor = None
+        self.seq = None
+
+    async def _connect(self):
+        # connect lazily in the process and loop of the worker rather than the one importing the app,
+        # the collection must be created as capped before any message is inserted
+        if self.connection is None:
+            self.connection = asyncio.ensure_future(self._create_collection())
+        return await asyncio.shield(self.connection)
+
+    async def _create_collection(self):
+        db = motor.motor_asyncio.AsyncIOMotorClient(self.url)[self.database]
+        try:
+            await db.create_collection('socketio_messages', capped=True, size=self.size)
+        except CollectionInvalid:
+            pass
+        return db
+
+    async def _publish(self, data):
+        db = await self._connect()
+        counter = await db.socketio_channels.find_one_and_update({'_id': self.channel}, {'$inc': {'seq': 1}},
+                                                                upsert=True, return_document=ReturnDocument.AFTER)
+        await db.socketio_messages.insert_one({'channel': self.channel, 'seq': counter['seq'], 'data': pickle.dumps(data)})
+
+    async def _listen(self):
+        while True:
+            try:
+                db = await self._connect()
+                if self.seq is None:
+                    counter = await db.socketio_channels.find_one({'_id': self.channel})
+                    self.seq = counter['seq'] if counter else 0
+                if self.cursor is None or not self.cursor.alive:
+                    self.cursor = db.socketio_messages.find({'channel': self.channel, 'seq': {'$gt': self.seq}},
+                                                            cursor_type=CursorType.TAILABLE_AWAIT)
+                async for message in self.cursor:
+                    self.seq = max(self.seq, message['seq'])
+                    return message['data']
+            except PyMongoError as e:
+                logger.error(f'Socket.io message bus error: {e}')
+                self.cursor = None
+            # the capped collection is empty or no message arrived within the await time of the cursor
+            await asyncio.sleep(0.1)
+
+class MemoryManager(AsyncPubSubManager):
+    '''
+    Socket.io client manager sharing the emits among the servers in the same process, for tests
+    '''
+    name = 'memory'
+    queues = {}     # {channel: [asyncio.Queue of each listening manager]}
+
+    def __init__(self, channel='socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.queue = None
+
+    def initialize(self):
+        # the queue is bound to the loop of the server
+        if not self.write_only:
+            self.queue = asyncio.Queue()
+            self.queues.setdefault(self.channel, []).append(self.queue)
+        super().initialize()
+
+    async def _publish(self, data):
+        for queue in self.queues.get(self.channel, []):
+            queue.put_nowait(pickle.dumps(data))
+
+    async def _listen(self):
+        return await self.queue.get()
+
+def get_client_manager(config):
+    '''
+    The client manager of the socket.io server by the configuration, None for the default one of a single process
+    '''
+    # a task runner instance has no clients but emits to those of the web servers
+    write_only = config.ROLE == 'runner'
+    if config.SOCKETIO_BUS == 'mongo':
+        return MongoManager(f"{config.MONGODB_URL}:{config.MONGODB_PORT}", config.MONGODB_DATABASE,
+                            size=config.SOCKETIO_BUS_SIZE, write_only=write_only)
+    if config.SOCKETIO_BUS == 'memory':
+        return MemoryManager(write_only=write_only)
+    return None
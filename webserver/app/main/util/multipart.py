@@ -0,0 +1,222 @@
+import asyncio
+import hashlib
+import os
+import uuid
+from email.message import Message
+from email.utils import collapse_rfc2231_value
+
+from sanic.request import RequestParameters
+
+PREAMBLE, DELIMITER, HEADERS, BODY, EPILOGUE = range(5)
+FIELD_MAX_SIZE = 1024 * 1024
+HEADERS_MAX_SIZE = 16 * 1024
+
+
+class MultipartError(ValueError):
+    pass
+
+
+class UploadTooLarge(MultipartError):
+    pass
+
+
+def parse_header(value):
+    '''
+    Parse a header like Content-Type or Content-Disposition into the main value and a dict of parameters
+    '''
+    msg = Message()
+    msg['header'] = value
+    params = msg.get_params(header='header') or [('', '')]
+    return params[0][0].lower(), {k.lower(): collapse_rfc2231_value(v) for k, v in params[1:]}
+
+
+class UploadedFile:
+    '''
+    A file part that has been saved to the disk, the counterpart of sanic's File without the body
+    '''
+    def __init__(self, name, type, path):
+        self.name = name
+        self.type = type
+        self.path = path
+        self.size = 0
+        self._sha256 = hashlib.sha256()
+        self._fp = open(path, 'wb')
+
+    def write(self, data):
+        self._fp.write(data)
+        self._sha256.update(data)
+        self.size += len(data)
+
+    def close(self):
+        if not self._fp.closed:
+            self._fp.close()
+
+    def discard(self):
+        '''
+        Close and remove a partially received file
+        '''
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    @property
+    def sha256(self):
+        return self._sha256.hexdigest()
+
+
+class MultipartParser:
+    '''
+    Incremental multipart/form-data parser, file parts are written to the upload directory as the data arrives
+    so that the memory usage doesn't depend on the request body size.
+    '''
+    def __init__(self, boundary, upload_dir, max_size):
+        self.delimiter = b'\r\n--' + boundary
+        self.upload_dir = upload_dir
+        self.max_size = max_size
+        self.received = 0
+        self.buffer = b'\r\n'   # the first boundary is not preceded by CRLF
+        self.state = PREAMBLE
+        self.form = RequestParameters()
+        self.files = RequestParameters()
+        self._part = None
+        self._part_name = None
+
+    def feed(self, data):
+        self.received += len(data)
+        if self.received > self.max_size:
+            raise UploadTooLarge('Request body exceeds {} bytes'.format(self.max_size))
+        self.buffer += data
+
+        while True:
+            if self.state == PREAMBLE or self.state == BODY:
+                idx = self.buffer.find(self.delimiter)
+                if idx < 0:
+                    # keep the tail in case it's the beginning of a split delimiter
+                    keep = len(self.delimiter) - 1
+                    if len(self.buffer) > keep:
+                        self._write(self.buffer[:-keep])
+                        self.buffer = self.buffer[-keep:]
+                    return
+                self._write(self.buffer[:idx])
+                self.buffer = self.buffer[idx + len(self.delimiter):]
+                self._end_part()
+                self.state = DELIMITER
+            elif self.state == DELIMITER:
+                if len(self.buffer) < 2:
+                    return
+                if self.buffer[:2] == b'--':
+                    self.state = EPILOGUE
+                elif self.buffer[:2] == b'\r\n':
+                    self.state = HEADERS
+                else:
+                    raise MultipartError('Malformed multipart boundary')
+                self.buffer = self.buffer[2:]
+            elif self.state == HEADERS:
+                idx = self.buffer.find(b'\r\n\r\n')
+                if idx < 0:
+                    if len(self.buffer) > HEADERS_MAX_SIZE:
+                        raise MultipartError('Multipart headers too long')
+                    return
+                self._begin_part(self.buffer[:idx].decode('utf-8'))
+                self.buffer = self.buffer[idx + 4:]
+                self.state = BODY
+            else:
+                self.buffer = b''
+                return
+
+    def close(self):
+        if self.state != EPILOGUE:
+            self.abort()
+            raise MultipartError('Incomplete multipart body')
+
+    def abort(self):
+        '''
+        Discard the part being received when the parsing fails
+        '''
+        if isinstance(self._part, UploadedFile):
+            self._part.discard()
+        self._part = None
+
+    def _begin_part(self, raw_headers):
+        headers = {}
+        for line in raw_headers.split('\r\n'):
+            if ':' in line:
+                k, v = line.split(':', 1)
+                headers[k.strip().lower()] = v.strip()
+        _, params = parse_header(headers.get('content-disposition', ''))
+        self._part_name = params.get('name')
+        if not self._part_name:
+            raise MultipartError('Multipart part without a name')
+        if 'filename' in params:
+            filename = os.path.basename(params['filename'].replace('\\', '/'))
+            self._part = UploadedFile(filename, headers.get('content-type', 'application/octet-stream'), os.path.join(self.upload_dir, uuid.uuid4().hex))
+        else:
+            self._part = bytearray()
+
+    def _write(self, data):
+        if not data or self._part is None:
+            return
+        if isinstance(self._part, UploadedFile):
+            self._part.write(data)
+        else:
+            if len(self._part) + len(data) > FIELD_MAX_SIZE:
+                raise UploadTooLarge('Form field {} is too large'.format(self._part_name))
+            self._part.extend(data)
+
+    def _end_part(self):
+        if self._part is None:
+            return
+        if isinstance(self._part, UploadedFile):
+            self._part.close()
+            self.files.setdefault(self._part_name, []).append(self._part)
+        else:
+            self.form.setdefault(self._part_name, []).append(self._part.decode('utf-8'))
+        self._part = None
+        self._part_name = None
+
+
+def get_boundary(content_type):
+    mime, params = parse_header(content_type or '')
+    if mime != 'multipart/form-data' or 'boundary' not in params:
+        raise MultipartError('Content type multipart/form-data with a boundary is expected')
+    return params['boundary'].encode('latin-1')
+
+
+async def receive_multipart(request, upload_dir, max_size):
+    '''
+    Read a streamed multipart/form-data request body into the upload directory,
+    return the form fields and the uploaded files
+    '''
+    parser = MultipartParser(get_boundary(request.headers.get('content-type')), upload_dir, max_size)
+    loop = asyncio.get_event_loop()
+    try:
+        while True:
+            chunk = await request.stream.read()
+            if chunk is None:
+                break
+            await loop.run_in_executor(None, parser.feed, chunk)
+        parser.close()
+    except BaseException:
+        # including the cancellation when the client is gone
+        parser.abort()
+        raise
+    return parser.form, parser.files
+
+
+async def receive_to_file(request, fp, max_size):
+    '''
+    Append a streamed raw request body to an opened file, return the number of bytes written
+    '''
+    loop = asyncio.get_event_loop()
+    written = 0
+    while True:
+        chunk = await request.stream.read()
+        if chunk is None:
+            break
+        written += len(chunk)
+        if written > max_size:
+            raise UploadTooLarge('Request body exceeds {} bytes'.format(max_size))
+        await loop.run_in_executor(None, fp.write, chunk)
+    return written
@@ -0,0 +1,89 @@
+import base64
+import binascii
+import datetime
+import time
+
+import pymongo
+from bson import ObjectId, json_util
+
+from ..config import get_config
+
+TOTAL_MODES = ('exact', 'cached', 'estimated', 'none')
+ESTIMATED_TOTAL_LIMIT = 10000   # an estimated total stops counting here
+CURSOR_TYPES = (type(None), bool, int, float, str, datetime.datetime, ObjectId)    # a document or array would be taken as operators
+
+_totals = {}    # {(collection name, query): (expire time, total)}
+
+def encode_cursor(raw, field):
+    '''
+    The opaque cursor of the position after a raw document, made of its value of the sort field and its _id
+    '''
+    return base64.urlsafe_b64encode(json_util.dumps([raw.get(field), raw['_id']]).encode()).decode()
+
+def decode_cursor(cursor):
+    '''
+    Return (value of the sort field, _id) of a cursor, raise ValueError if it's malformed
+    '''
+    try:
+        value, _id = json_util.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, TypeError, UnicodeDecodeError, ValueError):
+        raise ValueError('Invalid cursor')
+    if not isinstance(value, CURSOR_TYPES) or not isinstance(_id, CURSOR_TYPES):
+        raise ValueError('Invalid cursor')
+    return value, _id
+
+def keyset_filter(field, direction, value, _id):
+    '''
+    The filter of the documents after the position (value, _id) in the order of field then _id,
+    null values sort before any other value as MongoDB does
+    '''
+    after = '$gt' if direction == pymongo.ASCENDING else '$lt'
+    if field == '_id':
+        return {'_id': {after: _id}}
+    tie = {field: value, '_id': {after: _id}}
+    if value is None:
+        return {'$or': [{field: {'$ne': None}}, tie]} if direction == pymongo.ASCENDING else tie
+    if direction == pymongo.ASCENDING:
+        return {'$or': [{field: {after: value}}, tie]}
+    return {'$or': [{field: {after: value}}, {field: None}, tie]}
+
+async def paginate(document, query, sort=None, limit=10, cursor=None, skip=0):
+    '''
+    Return a page of the documents and the cursor of the next page, None if it's the last page.
+
+    The documents are sorted by (field, direction) of sort then by _id so that each position is unique,
+    a page after a cursor is located by the index rather than skipping the ones before it.
+    '''
+    field, direction = sort or ('_id', pymongo.ASCENDING)
+    if cursor:
+        query = {'$and': [query, keyset_filter(field, direction, *decode_cursor(cursor))]}
+    order = [(field, direction)] if field == '_id' else [(field, direction), ('_id', direction)]
+    raw = await document.collection.find(query).sort(order).skip(skip).limit(limit + 1).to_list(limit + 1)
+    next_cursor = encode_cursor(raw[limit - 1], field) if len(raw) > limit else None
+    return [document.build_from_mongo(r) for r in raw[:limit]], next_cursor
+
+async def count(document, query, mode='exact'):
+    '''
+    The total of the documents matching the query by the mode:
+        exact: count all of them
+        cached: the exact total counted within PAGINATION_TOTAL_TTL seconds
+        estimated: count up to ESTIMATED_TOTAL_LIMIT
+        none: don't count, return None
+    '''
+    if mode == 'none':
+        return None
+    if mode == 'estimated':
+        return await document.collection.count_documents(query, limit=ESTIMATED_TOTAL_LIMIT)
+    if mode == 'exact':
+        return await document.collection.count_documents(query)
+
+    key = (document.opts.collection_name, json_util.dumps(query, sort_keys=True))
+    now = time.monotonic()
+    if key in _totals and _totals[key][0] > now:
+        return _totals[key][1]
+    total = await document.collection.count_documents(query)
+    if len(_totals) > 1024:
+        for k in [k for k, (expire, _) in _totals.items() if expire <= now]:
+            del _totals[k]
+    _totals[key] = (now + get_config().PAGINATION_TOTAL_TTL, total)
+    return total
@@ -1,14 +1,22 @@
 import aiofiles
+import asyncio
 import os
+import uuid
 import sys
 import tarfile
+import time
 import zipfile
 from pathlib import Path
 from async_files.utils import async_wraps
 from async_files import FileIO
 from async_files.fileobj import DEFAULT_CONFIG, FileObj
 from sanic.log import logger
-from . import async_rmtree, async_exists, async_walk
+from . import async_rmtree, async_exists, async_walk, async_makedirs
+from .blobstore import directory_digest
+from .get_path import UPLOAD_ROOT
+
+TARBALL_CACHE_ROOT = UPLOAD_ROOT / '.tarballs'
+_TARBALL_BUILDING = {}  # {content digest: future of the tarball being built}
 
 TARBALL_CONFIG = DEFAULT_CONFIG
 TARBALL_CONFIG["strings_async_attrs"].extend(["add", "extract", "extractall"])
@@ -63,6 +71,76 @@ async def pack_files(filename, src, dst):
     else:
         return output
 
+async def _build_tarball(src, tarball):
+    await async_makedirs(TARBALL_CACHE_ROOT, exist_ok=True)
+    output = str(tarball) + '.' + uuid.uuid4().hex + '.tmp.tar.gz'
+    try:
+        await make_tarfile_from_dir(output, src)
+        await async_wraps(os.replace)(output, tarball)
+    except Exception:
+        if await async_exists(output):
+            await aiofiles.os.remove(output)
+        raise
+    return tarball
+
+async def get_cached_tarball(src):
+    """
+    Pack the directory once per content, the tarball is shared by all directories of the same content.
+    Concurrent requests for the same content wait for the one being built.
+    Return the tarball path and the content digest, the tarball path is None if packing failed.
+    """
+    if not await async_exists(src):
+        logger.error('Source files {} do not exist'.format(src))
+        return None, None
+
+    digest = await directory_digest(src)
+    tarball = TARBALL_CACHE_ROOT / (digest + '.tar.gz')
+    if await async_exists(tarball):
+        try:
+            # the modification time tells when it's used last for the eviction
+            await async_wraps(os.utime)(tarball)
+        except FileNotFoundError:
+            pass
+        else:
+            return tarball, digest
+
+    building = _TARBALL_BUILDING.get(digest)
+    if building is None:
+        building = asyncio.ensure_future(_build_tarball(src, tarball))
+        _TARBALL_BUILDING[digest] = building
+        building.add_done_callback(lambda fut: _TARBALL_BUILDING.pop(digest, None))
+    try:
+        return await asyncio.shield(building), digest
+    except Exception as e:
+        logger.exception(e)
+        return None, digest
+
+def _evict_tarballs(max_age):
+    cnt = 0
+    deadline = time.time() - max_age
+    try:
+        entries = list(os.scandir(TARBALL_CACHE_ROOT))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        try:
+            if entry.is_file() and entry.stat().st_mtime < deadline:
+                os.remove(entry.path)
+                cnt += 1
+        except FileNotFoundError:
+            pass
+    return cnt
+
+async def evict_tarballs(max_age):
+    """
+    Remove the cached tarballs not used for max_age seconds, including those of the directories removed
+    and the leftovers of the interrupted builds. Return the number of files removed.
+    """
+    cnt = await async_wraps(_evict_tarballs)(max_age)
+    if cnt:
+        logger.info(f'Evicted {cnt} cached tarballs')
+    return cnt
+
 #@async_wraps    # let caller make it async as it's a recursive function
 def path_to_dict(path):
     d = {'label': os.path.basename(path)}
@@ -0,0 +1,69 @@
+"""
+Benchmark of the socket.io fan-out of the console output of the running tasks.
+
+The clients of a team are connected to a socket.io server without a network, every packet sent is counted,
+the log chunks are emitted to the room of the team as before, then to the rooms of the tasks, eg.
+
+    python app/test/fanoutbench.py --tasks 30 --clients 50 --chunks 100
+"""
+import argparse
+import asyncio
+import sys
+import time
+from pathlib import Path
+sys.path.append(str(Path('.').resolve()))
+
+import socketio
+
+from app.main.util import get_room_id, get_task_room_id
+
+async def run(args, per_task):
+    sio = socketio.AsyncServer(async_mode='asgi')
+    packets = bytes_sent = 0
+
+    async def send_packet(eio_sid, pkt):
+        nonlocal packets, bytes_sent
+        packets += 1
+        bytes_sent += len(pkt.encode())
+    sio._send_packet = send_packet
+
+    org_team = get_room_id('5e8d2a', '')
+    task_ids = ['{:024x}'.format(i) for i in range(args.tasks)]
+    for i in range(args.clients):
+        sid = sio.manager.connect(f'eio{i}', '/')
+        sio.enter_room(sid, org_team)
+        # a client views the detail of one of the tasks, the others are on the pages of no task
+        if i < args.clients * args.viewing:
+            sio.enter_room(sid, get_task_room_id(task_ids[i % args.tasks]))
+
+    chunk = 'x' * args.chunk_size
+    start = time.perf_counter()
+    for task_id in task_ids:
+        await sio.emit('task started', {'task_id': task_id}, room=org_team)
+    for _ in range(args.chunks):
+        for task_id in task_ids:
+            room = get_task_room_id(task_id) if per_task else org_team
+            await sio.emit('test log', {'task_id': task_id, 'message': chunk}, room=room)
+    for task_id in task_ids:
+        await sio.emit('task finished', {'task_id': task_id, 'status': 'successful'}, room=org_team)
+    return packets, bytes_sent, time.perf_counter() - start
+
+async def main(args):
+    print(f'{args.tasks} tasks x {args.chunks} log chunks of {args.chunk_size} bytes, {args.clients} clients, {args.viewing:.0%} viewing a task')
+    print(f'{"rooms":>8} {"packets":>10} {"MB":>10} {"seconds":>8}')
+    results = []
+    for per_task in (False, True):
+        packets, bytes_sent, elapsed = await run(args, per_task)
+        results.append(bytes_sent)
+        print(f'{"task" if per_task else "team":>8} {packets:>10} {bytes_sent / 1024 / 1024:>10.1f} {elapsed:>8.2f}')
+    print(f'The log traffic is cut by {1 - results[1] / results[0]:.1%}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the socket.io traffic of the task logs sent to the team room and to the task rooms')
+    parser.add_argument('-t', '--tasks', type=int, default=30, help='the number of running tasks')
+    parser.add_argument('-c', '--clients', type=int, default=50, help='the number of clients of the team')
+    parser.add_argument('-n', '--chunks', type=int, default=100, help='the number of log chunks of each task')
+    parser.add_argument('-s', '--chunk-size', type=int, default=200, help='bytes of a log chunk')
+    parser.add_argument('-v', '--viewing', type=float, default=0.2, help='the ratio of the clients viewing the detail of a task')
+    asyncio.run(main(parser.parse_args()))
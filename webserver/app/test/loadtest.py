@@ -0,0 +1,102 @@
+"""
+Load test of the request throughput of the web API by the number of workers.
+
+The web server is started with each number of workers in the web role, the task runner isn't needed,
+then the clients keep requesting the same path for the duration, eg.
+
+    python app/test/loadtest.py --workers 1 2 4 --duration 10 --concurrency 64
+"""
+import argparse
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import aiohttp
+
+async def wait_ready(url, timeout=60):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(url) as resp:
+                    if resp.status < 500:
+                        return True
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.5)
+    return False
+
+async def hammer(url, duration, concurrency):
+    '''
+    Keep requesting the url by the concurrent clients, return (succeeded, failed) requests
+    '''
+    succeeded = failed = 0
+    deadline = time.monotonic() + duration
+
+    async def client(session):
+        nonlocal succeeded, failed
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(url) as resp:
+                    await resp.read()
+                    if resp.status == 200:
+                        succeeded += 1
+                    else:
+                        failed += 1
+            except aiohttp.ClientError:
+                failed += 1
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*[client(session) for _ in range(concurrency)])
+    return succeeded, failed
+
+def start_server(workers, port):
+    env = dict(os.environ, WORKERS=str(workers), PORT=str(port), EMBER_ROLE='web', SOCKETIO_BUS='mongo', RATELIMIT_ENABLED='0')
+    return subprocess.Popen([sys.executable, '-c', 'import app; app.run()'], env=env, cwd=Path(__file__).resolve().parents[2],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+def stop_server(server):
+    # the workers are in the process group of the main process
+    os.killpg(server.pid, signal.SIGTERM)
+    try:
+        server.wait(10)
+    except subprocess.TimeoutExpired:
+        os.killpg(server.pid, signal.SIGKILL)
+
+async def main(args):
+    url = f'http://127.0.0.1:{args.port}{args.path}'
+    results = []
+    for workers in args.workers:
+        server = start_server(workers, args.port)
+        try:
+            if not await wait_ready(url):
+                print(f'The server with {workers} workers failed to start')
+                return 1
+            await hammer(url, 1, args.concurrency)     # warm up
+            succeeded, failed = await hammer(url, args.duration, args.concurrency)
+        finally:
+            stop_server(server)
+        results.append((workers, succeeded / args.duration, failed))
+
+    base = results[0][1] / results[0][0]
+    print(f'{"workers":>8} {"req/s":>10} {"speedup":>8} {"efficiency":>10} {"failed":>8}')
+    for workers, rate, failed in results:
+        speedup = rate / results[0][1] if results[0][1] else 0
+        efficiency = rate / workers / base if base else 0
+        print(f'{workers:>8} {rate:>10.1f} {speedup:>8.2f} {efficiency:>10.0%} {failed:>8}')
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the request throughput of the web API by the number of workers')
+    parser.add_argument('-w', '--workers', type=int, nargs='+', default=[1, 2, 4], help='the numbers of workers to measure')
+    parser.add_argument('-d', '--duration', type=int, default=10, help='seconds to measure for each number of workers')
+    parser.add_argument('-c', '--concurrency', type=int, default=64, help='the number of concurrent clients')
+    parser.add_argument('-p', '--port', type=int, default=5100)
+    parser.add_argument('--path', default='/swagger/swagger.json', help='the path to request')
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,117 @@
+import asyncio
+import hashlib
+import os
+import shutil
+import unittest
+
+import motor.motor_asyncio
+from bson import ObjectId
+
+from app import app
+
+
+@unittest.skipUnless(os.getenv('MONGODB_TEST_URL'), 'set MONGODB_TEST_URL to a local mongod, eg. mongodb://127.0.0.1:27017')
+class TestBlobStore(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(cls.loop)
+        cls.client = motor.motor_asyncio.AsyncIOMotorClient(os.getenv('MONGODB_TEST_URL'), serverSelectionTimeoutMS=2000)
+        cls.db_name = 'test_blobstore_{}'.format(os.getpid())
+        app.config.db = cls.client[cls.db_name]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.loop.run_until_complete(cls.client.drop_database(cls.db_name))
+        cls.client.close()
+        cls.loop.close()
+
+    def test_upload_link_remove_collect(self):
+        """ Test a blob is reclaimed once both the upload directory and the result directory linking it are removed """
+        # the models are bound to the database on import
+        from app.main.model.database import ResourceBlob
+        from app.main.util.blobstore import collect_garbage, get_blob_path, link_files, remove_files, store_files
+        from app.main.util.get_path import UPLOAD_ROOT
+
+        upload_dir = UPLOAD_ROOT / str(ObjectId())
+        result_dir = UPLOAD_ROOT / str(ObjectId())
+        os.makedirs(upload_dir)
+        content = os.urandom(1024)
+        digest = hashlib.sha256(content).hexdigest()
+        incoming = UPLOAD_ROOT / (str(ObjectId()) + '.tmp')
+        with open(incoming, 'wb') as f:
+            f.write(content)
+
+        async def refcount():
+            blob = await ResourceBlob.collection.find_one({'sha256': digest})
+            return blob['refcount'] if blob else None
+
+        async def run():
+            await store_files(upload_dir, [(str(incoming), 'firmware.bin', digest)])
+            self.assertEqual(await link_files(upload_dir, result_dir), [])
+            self.assertEqual(await refcount(), 2)
+
+            await remove_files(upload_dir)
+            await remove_files(upload_dir)
+            self.assertFalse(os.path.exists(upload_dir))
+            self.assertEqual(await refcount(), 1)
+            self.assertEqual(await collect_garbage(), 0)
+            self.assertTrue(os.path.exists(get_blob_path(digest)))
+
+            await remove_files(result_dir)
+            self.assertEqual(await refcount(), 0)
+            self.assertEqual(await collect_garbage(), 1)
+            self.assertFalse(os.path.exists(get_blob_path(digest)))
+            self.assertIsNone(await refcount())
+
+        try:
+            self.loop.run_until_complete(run())
+        finally:
+            shutil.rmtree(upload_dir, ignore_errors=True)
+            shutil.rmtree(result_dir, ignore_errors=True)
+
+    def test_reference_waits_for_collection(self):
+        """ Test a blob being collected is stored anew rather than referenced while its file is removed """
+        from app.main.model.database import ResourceBlob
+        from app.main.util.blobstore import add_file, get_blob_path, remove_files, store_files
+        from app.main.util.get_path import UPLOAD_ROOT
+
+        upload_dir = UPLOAD_ROOT / str(ObjectId())
+        os.makedirs(upload_dir)
+        content = os.urandom(1024)
+        digest = hashlib.sha256(content).hexdigest()
+
+        def incoming():
+            path = UPLOAD_ROOT / (str(ObjectId()) + '.tmp')
+            with open(path, 'wb') as f:
+                f.write(content)
+            return str(path)
+
+        async def run():
+            await store_files(upload_dir, [(incoming(), 'firmware.bin', digest)])
+            await remove_files(upload_dir)
+            # the garbage collection has marked the blob but not removed it yet
+            await ResourceBlob.collection.update_one({'sha256': digest}, {'$set': {'deleting': True}})
+            os.makedirs(upload_dir)
+            adding = asyncio.ensure_future(add_file(incoming(), digest, upload_dir / 'firmware.bin'))
+            await asyncio.sleep(0.3)
+            self.assertFalse(adding.done())
+            os.remove(get_blob_path(digest))
+            await ResourceBlob.collection.delete_one({'sha256': digest})
+            await adding
+            self.assertTrue(os.path.exists(get_blob_path(digest)))
+            blob = await ResourceBlob.collection.find_one({'sha256': digest})
+            self.assertEqual(blob['refcount'], 1)
+            self.assertFalse(blob.get('deleting', False))
+            with open(upload_dir / 'firmware.bin', 'rb') as f:
+                self.assertEqual(f.read(), content)
+            await remove_files(upload_dir)
+
+        try:
+            self.loop.run_until_complete(run())
+        finally:
+            shutil.rmtree(upload_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
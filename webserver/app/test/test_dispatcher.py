@@ -0,0 +1,61 @@
+import asyncio
+import unittest
+
+from task_runner.util.dispatcher import KeyedDispatcher
+
+
+class TestKeyedDispatcher(unittest.TestCase):
+    def test_order_per_key(self):
+        """ Test the jobs of the same key run in the order submitted while the keys interleave """
+        async def run():
+            done = []
+            dispatcher = KeyedDispatcher(4)
+
+            def job(key, i):
+                async def _job():
+                    await asyncio.sleep(0.01 * ((i * 7) % 3))
+                    done.append((key, i))
+                return _job
+
+            for i in range(10):
+                for key in ('a', 'b', 'c'):
+                    await dispatcher.submit(key, job(key, i))
+            await dispatcher.join()
+            return done
+
+        done = asyncio.run(run())
+        self.assertEqual(len(done), 30)
+        for key in ('a', 'b', 'c'):
+            self.assertEqual([i for k, i in done if k == key], list(range(10)))
+
+    def test_bounded_workers(self):
+        """ Test no more jobs than the workers run at the same time, and a failed job doesn't stop its key """
+        async def run():
+            running = peak = 0
+            done = []
+            dispatcher = KeyedDispatcher(3)
+
+            def job(i):
+                async def _job():
+                    nonlocal running, peak
+                    running += 1
+                    peak = max(peak, running)
+                    await asyncio.sleep(0.01)
+                    running -= 1
+                    if i == 0:
+                        raise RuntimeError('failed')
+                    done.append(i)
+                return _job
+
+            for i in range(12):
+                await dispatcher.submit(str(i % 6), job(i))
+            await dispatcher.join()
+            return peak, done
+
+        peak, done = asyncio.run(run())
+        self.assertEqual(peak, 3)
+        self.assertEqual(sorted(done), list(range(1, 12)))
+
+
+if __name__ == '__main__':
+    unittest.main()
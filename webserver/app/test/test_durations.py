@@ -0,0 +1,36 @@
+import unittest
+from types import SimpleNamespace
+
+from task_runner.util.durations import case_duration, duration_samples
+
+RECORDS = [
+    {'kind': 'test', 'name': 'Login', 'longname': 'Root.Web.Login', 'duration': 1000},
+    {'kind': 'suite', 'name': 'Web', 'longname': 'Root.Web', 'duration': 1200},
+    {'kind': 'test', 'name': 'Login', 'longname': 'Root.Api.Login', 'duration': 300},
+    {'kind': 'suite', 'name': 'Api', 'longname': 'Root.Api', 'duration': 400},
+    {'kind': 'suite', 'name': 'Root', 'longname': 'Root', 'duration': 1700},
+]
+
+
+class TestDurations(unittest.TestCase):
+    def test_whole_suite_sampled(self):
+        """ Test the whole test suite is sampled along with the tests keyed by their full names """
+        samples = duration_samples(SimpleNamespace(testcases=[]), RECORDS)
+        self.assertEqual(samples, [('', 1700), ('Root.Web.Login', 1000), ('Root.Api.Login', 300)])
+
+    def test_subset_not_sampled_as_suite(self):
+        """ Test a task running part of the test cases doesn't sample the whole test suite """
+        samples = duration_samples(SimpleNamespace(testcases=['Login']), RECORDS)
+        self.assertEqual(samples, [('Root.Web.Login', 1000), ('Root.Api.Login', 300)])
+
+    def test_case_duration(self):
+        """ Test a test case name selects the tests of the name in all nested suites """
+        durations = {'': 1700, 'Root.Web.Login': 1000, 'Root.Api.Login': 300, 'Logout': 50}
+        self.assertEqual(case_duration(durations, 'Login'), 1300)
+        self.assertEqual(case_duration(durations, 'Root.Web.Login'), 1000)
+        self.assertEqual(case_duration(durations, 'Logout'), 50)
+        self.assertIsNone(case_duration(durations, 'Signup'))
+
+
+if __name__ == '__main__':
+    unittest.main()
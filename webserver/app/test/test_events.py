@@ -0,0 +1,101 @@
+import asyncio
+import datetime
+import os
+import unittest
+
+import motor.motor_asyncio
+from bson import ObjectId
+
+from app import app
+
+EVENT_CODE_TEST = 9999
+
+
+@unittest.skipUnless(os.getenv('MONGODB_TEST_URL'), 'set MONGODB_TEST_URL to a local mongod, eg. mongodb://127.0.0.1:27017')
+class TestEventClaims(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(cls.loop)
+        cls.client = motor.motor_asyncio.AsyncIOMotorClient(os.getenv('MONGODB_TEST_URL'), serverSelectionTimeoutMS=2000)
+        cls.db_name = 'test_events_{}'.format(os.getpid())
+        app.config.db = cls.client[cls.db_name]
+
+        # the models are bound to the database on import
+        from task_runner import runner
+        from task_runner.util.lease import LeaseManager
+        cls.runner = runner
+        runner.LEASES = LeaseManager('test-runner', None, 30)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.loop.run_until_complete(cls.client.drop_database(cls.db_name))
+        cls.client.close()
+        cls.loop.close()
+
+    def setUp(self):
+        from app.main.model.database import Event, EventQueue
+
+        async def reset():
+            await Event.collection.delete_many({})
+            await EventQueue.collection.delete_many({})
+            await EventQueue.collection.insert_one({'schema_version': '1', 'events': [], 'rw_lock': False})
+        self.loop.run_until_complete(reset())
+
+    async def claim_event(self, claim_date):
+        from app.main.model.database import Event
+        ret = await Event.collection.insert_one({'schema_version': '1', 'code': EVENT_CODE_TEST, 'message': {},
+                                                 'organization': ObjectId(), 'status': 'Processing',
+                                                 'owner': self.runner.LEASES.owner, 'claim_date': claim_date})
+        return await Event.find_one({'_id': ret.inserted_id})
+
+    def test_held_event_not_requeued(self):
+        """ Test an event held past the claim timeout has its claim renewed, and is requeued only once it's not held """
+        from app.main.model.database import Event, EventQueue
+        expired = datetime.datetime.utcnow() - datetime.timedelta(seconds=app.config.EVENT_CLAIM_TIMEOUT + 60)
+
+        async def run():
+            event = await self.claim_event(expired)
+            self.runner.HELD_EVENTS.add(event.pk)
+            try:
+                await self.runner.requeue_events(app)
+                doc = await Event.collection.find_one({'_id': event.pk})
+                self.assertEqual(doc['status'], 'Processing')
+                self.assertGreater(doc['claim_date'], expired)
+                self.assertEqual((await EventQueue.collection.find_one())['events'], [])
+            finally:
+                self.runner.HELD_EVENTS.discard(event.pk)
+
+            await Event.collection.update_one({'_id': event.pk}, {'$set': {'claim_date': expired}})
+            await self.runner.requeue_events(app)
+            self.assertEqual((await Event.collection.find_one({'_id': event.pk}))['status'], 'Triggered')
+            self.assertEqual((await EventQueue.collection.find_one())['events'], [event.pk])
+
+        self.loop.run_until_complete(run())
+
+    def test_event_acknowledged(self):
+        """ Test an event is held while it waits and runs in the dispatcher, and acknowledged once it's done """
+        from app.main.model.database import Event
+        held = []
+
+        async def handler(app, event):
+            held.append(event.pk in self.runner.HELD_EVENTS)
+
+        async def run():
+            event = await self.claim_event(datetime.datetime.utcnow())
+            await self.runner.submit_event(app, event)
+            self.assertIn(event.pk, self.runner.HELD_EVENTS)
+            await self.runner.get_dispatcher(app).join()
+            self.assertNotIn(event.pk, self.runner.HELD_EVENTS)
+            self.assertEqual((await Event.collection.find_one({'_id': event.pk}))['status'], 'Processed')
+
+        self.runner.EVENT_HANDLERS[EVENT_CODE_TEST] = handler
+        try:
+            self.loop.run_until_complete(run())
+        finally:
+            del self.runner.EVENT_HANDLERS[EVENT_CODE_TEST]
+        self.assertEqual(held, [True])
+
+
+if __name__ == '__main__':
+    unittest.main()
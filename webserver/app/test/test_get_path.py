@@ -0,0 +1,40 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+
+from bson import ObjectId
+
+from app.main.util.get_path import USERS_ROOT, TEST_RESULTS_ROOT, get_test_results_root, invalidate_users_root
+
+
+class FakeReference:
+    def __init__(self, document):
+        self.pk = document.pk
+        self.document = document
+        self.fetched = 0
+
+    async def fetch(self):
+        self.fetched += 1
+        return self.document
+
+
+class TestGetPath(unittest.TestCase):
+    def test_users_root_cached(self):
+        """ Test the organization and team of a task are fetched once for the paths and again after invalidated """
+        organization = SimpleNamespace(pk=ObjectId(), path='org#1')
+        team = SimpleNamespace(pk=ObjectId(), path='team#1')
+        org_ref, team_ref = FakeReference(organization), FakeReference(team)
+        task = SimpleNamespace(pk=ObjectId(), organization=org_ref, team=team_ref)
+
+        for _ in range(3):
+            root = asyncio.run(get_test_results_root(task))
+            self.assertEqual(root, USERS_ROOT / 'org#1' / 'team#1' / TEST_RESULTS_ROOT)
+        self.assertEqual((org_ref.fetched, team_ref.fetched), (1, 1))
+
+        invalidate_users_root(team=team)
+        asyncio.run(get_test_results_root(task))
+        self.assertEqual((org_ref.fetched, team_ref.fetched), (2, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import datetime
+import os
+import unittest
+import uuid
+
+from bson import ObjectId
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+from app.main.model.database import (INDEXED_DOCUMENTS, Endpoint, Event, Organization, Package, Task, TaskLog,
+                                     TaskQueue, Team, Test, TestResult)
+from app.main.util.pagination import keyset_filter
+
+ORG, TEAM, ENDPOINT, TASK = ObjectId(), ObjectId(), ObjectId(), ObjectId()
+NOW = datetime.datetime.utcnow()
+
+# the query shapes of the controllers and the task runner on the hot paths, (document, filter, sort)
+QUERY_SHAPES = [
+    (Task, {'organization': ORG, 'team': TEAM}, [('run_date', -1), ('_id', -1)]),
+    (Task, {'organization': ORG, 'team': TEAM, 'run_date': {'$lte': NOW, '$gte': NOW}, 'priority': 2, 'endpoint_run': ENDPOINT}, [('run_date', -1), ('_id', -1)]),
+    (Task, {'organization': ORG}, [('run_date', -1), ('_id', -1)]),
+    (Task, {'$and': [{'organization': ORG, 'team': TEAM}, keyset_filter('run_date', -1, NOW, TASK)]}, [('run_date', -1), ('_id', -1)]),
+    (Task, {'organization': ORG, 'team': TEAM, 'status': 'successful', 'run_date': {'$gte': NOW, '$lte': NOW}}, None),
+    (Task, {'organization': ORG, 'team': TEAM, 'status': 'waiting', 'schedule_date': {'$gte': NOW, '$lte': NOW}}, None),
+    (Task, {'parent': TASK, 'status': {'$in': ['waiting', 'running']}}, None),
+    (Task, {'pipeline': ObjectId(), 'status': {'$in': ['waiting', 'running']}}, None),
+    (Task, {'rerun_of': {'$in': [TASK]}}, None),
+    (Endpoint, {'uid': uuid.uuid4()}, None),
+    (Endpoint, {'uid': uuid.uuid4(), 'organization': ORG, 'team': TEAM}, None),
+    (Endpoint, {'organization': ORG, 'team': TEAM, 'status': {'$ne': 'Forbidden'}}, None),
+    (TaskQueue, {'endpoint': ENDPOINT, 'priority': 2, 'organization': ORG, 'team': TEAM}, None),
+    (TaskQueue, {'endpoint': ENDPOINT, 'organization': ORG, 'team': TEAM}, None),
+    (TaskQueue, {'endpoint': ENDPOINT, 'running_task': {'$ne': None}}, None),
+    (TaskQueue, {'organization': ORG, 'team': TEAM, 'priority': 2, 'tasks': TASK}, None),
+    (Test, {'test_suite': 'suite', 'organization': ORG, 'team': TEAM}, None),
+    (Test, {'test_suite': 'suite', 'path': 'pkg', 'organization': ORG, 'team': TEAM}, None),
+    (Test, {'path': {'$in': ['pkg']}, 'organization': ORG, 'team': TEAM}, None),
+    (Package, {'py_packages': 'pkg', 'organization': ORG, 'team': TEAM, 'package_type': 'Test Suite'}, None),
+    (Package, {'proprietary': False, 'package_type': 'Test Suite'}, None),
+    (Package, {'name': 'pkg', 'proprietary': True, 'package_type': 'Test Suite', 'organization': ORG, 'team': TEAM}, None),
+    (TestResult, {'task': TASK}, None),
+    (TaskLog, {'task': TASK}, [('_id', 1)]),
+    (Organization, {'owner': ObjectId()}, None),
+    (Team, {'name': 'team', 'organization': ORG}, None),
+    (Team, {'owner': ObjectId()}, None),
+    (Event, {'status': 'Processing', 'claim_date': {'$lt': NOW}}, None),
+]
+
+def plan_stages(plan):
+    yield plan['stage']
+    for key in ('inputStage', 'queryPlan'):
+        if key in plan:
+            yield from plan_stages(plan[key])
+    for child in plan.get('inputStages', []):
+        yield from plan_stages(child)
+
+
+@unittest.skipUnless(os.getenv('MONGODB_TEST_URL'), 'set MONGODB_TEST_URL to a local mongod, eg. mongodb://127.0.0.1:27017')
+class TestIndexes(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.client = MongoClient(os.getenv('MONGODB_TEST_URL'), serverSelectionTimeoutMS=2000)
+        cls.db = cls.client['test_indexes_{}'.format(os.getpid())]
+        try:
+            for document in INDEXED_DOCUMENTS:
+                collection = cls.db[document.opts.collection_name]
+                if document.opts.indexes:
+                    collection.create_indexes(document.opts.indexes)
+                # the plan of a query on a collection not existing is EOF rather than a scan
+                collection.insert_one({})
+        except PyMongoError as e:
+            cls.client.close()
+            raise unittest.SkipTest('mongod is not available: {}'.format(e))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.client.drop_database(cls.db)
+        cls.client.close()
+
+    def test_no_collection_scan(self):
+        """ Test every hot query shape is served by an index """
+        for document, query, sort in QUERY_SHAPES:
+            with self.subTest(collection=document.opts.collection_name, query=query):
+                cursor = self.db[document.opts.collection_name].find(query)
+                if sort:
+                    cursor = cursor.sort(sort)
+                plan = cursor.explain()['queryPlanner']['winningPlan']
+                self.assertNotIn('COLLSCAN', list(plan_stages(plan)))
+                if sort:
+                    self.assertNotIn('SORT', list(plan_stages(plan)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import asyncio
+import unittest
+
+import socketio
+
+from app.main.util.messagebus import MemoryManager
+
+
+class RecordingManager(MemoryManager):
+    def __init__(self, received, **kwargs):
+        super().__init__(**kwargs)
+        self.received = received
+
+    async def _handle_emit(self, message):
+        self.received.append((self.host_id, message['event'], message['room']))
+
+
+class TestMemoryManager(unittest.TestCase):
+    def test_emit_reaches_every_server(self):
+        """ Test the emits of a write only server reach the clients of all the other servers """
+        async def run():
+            received = []
+            servers = [socketio.AsyncServer(async_mode='asgi', client_manager=RecordingManager(received, channel='test_emit')) for _ in range(3)]
+            for s in servers:
+                s.manager.initialize()
+            runner = socketio.AsyncServer(async_mode='asgi', client_manager=MemoryManager(channel='test_emit', write_only=True))
+
+            await runner.emit('test log', {'task_id': '1', 'message': 'hello'}, room='org:team')
+            await asyncio.sleep(0.1)
+            for s in servers:
+                s.manager.thread.cancel()
+            return received
+
+        received = asyncio.run(run())
+        self.assertEqual(len(received), 3)
+        self.assertEqual(len({host_id for host_id, _, _ in received}), 3)
+        self.assertTrue(all(event == 'test log' and room == 'org:team' for _, event, room in received))
+
+    def test_channels_are_isolated(self):
+        """ Test the emits don't cross the channels """
+        async def run():
+            received = []
+            server = socketio.AsyncServer(async_mode='asgi', client_manager=RecordingManager(received, channel='test_isolated'))
+            server.manager.initialize()
+            other = socketio.AsyncServer(async_mode='asgi', client_manager=MemoryManager(channel='test_other', write_only=True))
+
+            await other.emit('test log', {}, room='org:team')
+            await asyncio.sleep(0.1)
+            server.manager.thread.cancel()
+            return received
+
+        self.assertEqual(asyncio.run(run()), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
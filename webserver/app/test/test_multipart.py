@@ -0,0 +1,94 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+
+from sanic import Sanic
+from sanic.config import DEFAULT_CONFIG
+from sanic.response import json
+
+from app.main.config import Config
+from app.main.util.multipart import MultipartParser, MultipartError, UploadTooLarge, get_boundary, receive_multipart
+
+BODY = (b'--XyZ\r\nContent-Disposition: form-data; name="organization"\r\n\r\n5e8d2a\r\n'
+        b'--XyZ\r\nContent-Disposition: form-data; name="file"; filename="firmware.bin"\r\n'
+        b'Content-Type: application/octet-stream\r\n\r\n' + b'\r\n--XyY-' * 1000 + b'\r\n'
+        b'--XyZ--\r\n')
+
+
+class TestMultipartParser(unittest.TestCase):
+    def setUp(self):
+        self.upload_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.upload_dir)
+
+    def parse(self, body, chunk_size, max_size=1024 * 1024):
+        parser = MultipartParser(get_boundary('multipart/form-data; boundary=XyZ'), self.upload_dir, max_size)
+        for i in range(0, len(body), chunk_size):
+            parser.feed(body[i:i + chunk_size])
+        parser.close()
+        return parser
+
+    def test_split_chunks(self):
+        """ Test delimiters split across chunks are recognized """
+        for chunk_size in (1, 5, 7, 4096, len(BODY)):
+            parser = self.parse(BODY, chunk_size)
+            self.assertEqual(parser.form.get('organization'), '5e8d2a')
+            upload = parser.files.get('file')
+            self.assertEqual(upload.name, 'firmware.bin')
+            self.assertEqual(upload.size, 8000)
+            with open(upload.path, 'rb') as f:
+                self.assertEqual(f.read(), b'\r\n--XyY-' * 1000)
+            os.remove(upload.path)
+
+    def test_size_cap(self):
+        """ Test the request body size cap """
+        with self.assertRaises(UploadTooLarge):
+            self.parse(BODY, 4096, max_size=1024)
+
+    def test_incomplete_body(self):
+        """ Test a truncated body is rejected and the partial file is removed """
+        with self.assertRaises(MultipartError):
+            self.parse(BODY[:-10], 4096)
+        self.assertEqual(os.listdir(self.upload_dir), [])
+
+    def test_streamed_upload(self):
+        """ Test a streamed upload larger than the default request size limit of sanic """
+        app = Sanic('test_streamed_upload')
+        app.config.REQUEST_MAX_SIZE = Config.REQUEST_MAX_SIZE
+        chunk = b'\0' * (1024 * 1024)
+        size = (DEFAULT_CONFIG['REQUEST_MAX_SIZE'] // len(chunk) + 1) * len(chunk)
+
+        @app.post('/', stream=True)
+        async def handler(request):
+            form, files = await receive_multipart(request, self.upload_dir, Config.UPLOAD_MAX_SIZE)
+            return json({'size': files.get('file').size})
+
+        async def upload():
+            server = await app.create_server(host='127.0.0.1', port=0, return_asyncio_server=True)
+            port = server.server.sockets[0].getsockname()[1]
+            head = b'--XyZ\r\nContent-Disposition: form-data; name="file"; filename="big.bin"\r\n\r\n'
+            tail = b'\r\n--XyZ--\r\n'
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write('POST / HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\nContent-Type: multipart/form-data; boundary=XyZ\r\n'
+                         'Content-Length: {}\r\n\r\n'.format(len(head) + size + len(tail)).encode() + head)
+            for _ in range(size // len(chunk)):
+                writer.write(chunk)
+                await writer.drain()
+            writer.write(tail)
+            await writer.drain()
+            response = await reader.read()
+            writer.close()
+            server.close()
+            await server.wait_closed()
+            return response
+
+        response = asyncio.run(upload())
+        self.assertTrue(response.startswith(b'HTTP/1.1 200'))
+        self.assertTrue(response.endswith('{{"size":{}}}'.format(size).encode()))
+
+
+if __name__ == '__main__':
+    unittest.main()
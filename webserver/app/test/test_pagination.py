@@ -0,0 +1,45 @@
+import base64
+import datetime
+import unittest
+
+import pymongo
+from bson import ObjectId
+
+from app.main.util.pagination import decode_cursor, encode_cursor, keyset_filter
+
+
+class TestPagination(unittest.TestCase):
+    def test_cursor_round_trip(self):
+        """ Test a cursor keeps the value of the sort field and the _id """
+        run_date = datetime.datetime(2026, 10, 1, 12, 0, 0, 123000)
+        _id = ObjectId()
+        value, cursor_id = decode_cursor(encode_cursor({'run_date': run_date, '_id': _id}, 'run_date'))
+        self.assertEqual(value.replace(tzinfo=None), run_date)
+        self.assertEqual(cursor_id, _id)
+
+    def test_invalid_cursor(self):
+        """ Test a malformed cursor is rejected by ValueError """
+        for cursor in ('not a cursor!', base64.urlsafe_b64encode(b'[1]').decode(), base64.urlsafe_b64encode(b'{}').decode()):
+            with self.assertRaises(ValueError):
+                decode_cursor(cursor)
+
+    def test_operator_cursor(self):
+        """ Test a cursor of a document or an array rather than a value is rejected, it would inject operators to the filter """
+        for raw in (b'[{"$ne": null}, {"$oid": "5f0000000000000000000000"}]', b'["a", {"$gt": ""}]', b'[["a"], 1]'):
+            with self.assertRaises(ValueError):
+                decode_cursor(base64.urlsafe_b64encode(raw).decode())
+
+    def test_keyset_filter(self):
+        """ Test the filter of the position after the cursor in both directions """
+        _id = ObjectId()
+        self.assertEqual(keyset_filter('_id', pymongo.ASCENDING, _id, _id), {'_id': {'$gt': _id}})
+        self.assertEqual(keyset_filter('name', pymongo.ASCENDING, 'a', _id),
+                         {'$or': [{'name': {'$gt': 'a'}}, {'name': 'a', '_id': {'$gt': _id}}]})
+        # null values sort first, they are after any value in the descending order
+        self.assertEqual(keyset_filter('name', pymongo.DESCENDING, 'a', _id),
+                         {'$or': [{'name': {'$lt': 'a'}}, {'name': None}, {'name': 'a', '_id': {'$lt': _id}}]})
+        self.assertEqual(keyset_filter('name', pymongo.DESCENDING, None, _id), {'name': None, '_id': {'$lt': _id}})
+
+
+if __name__ == '__main__':
+    unittest.main()
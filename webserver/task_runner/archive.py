@@ -0,0 +1,38 @@
+import argparse
+import asyncio
+import datetime
+import sys
+from pathlib import Path
+sys.path.append(str(Path('.').resolve()))
+
+import motor.motor_asyncio
+
+from app import app
+
+
+async def main(args):
+    db_client = motor.motor_asyncio.AsyncIOMotorClient(f"{app.config['MONGODB_URL']}:{app.config['MONGODB_PORT']}")
+    app.config.db = db_client[app.config['MONGODB_DATABASE']]
+
+    # the models are bound to the database on import
+    from app.main.util.blobstore import collect_garbage
+    from task_runner.util.archive import archive_tasks
+    horizon = datetime.datetime.utcnow() - datetime.timedelta(days=args.days)
+    total = 0
+    try:
+        while True:
+            cnt = await archive_tasks(horizon, args.duty_cycle)
+            if cnt == 0:
+                break
+            total += cnt
+        await collect_garbage()
+    finally:
+        db_client.close()
+    print(f'Archived {total} tasks created before {horizon}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Archive the finished tasks along with their test results and result directories')
+    parser.add_argument('-d', '--days', type=int, default=app.config.ARCHIVE_AFTER_DAYS or 90, help='archive the tasks created the days ago, default to ARCHIVE_AFTER_DAYS or 90')
+    parser.add_argument('-c', '--duty-cycle', type=float, default=1.0, help='share of the time to be busy, eg. 0.2 to throttle it on a production server')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,29 @@
+import argparse
+import asyncio
+import sys
+from pathlib import Path
+sys.path.append(str(Path('.').resolve()))
+
+import motor.motor_asyncio
+
+from app import app
+
+
+async def main(args):
+    db_client = motor.motor_asyncio.AsyncIOMotorClient(f"{app.config['MONGODB_URL']}:{app.config['MONGODB_PORT']}")
+    app.config.db = db_client[app.config['MONGODB_DATABASE']]
+
+    # the models are bound to the database on import
+    from task_runner.util.ingest import backfill
+    try:
+        tasks, records = await backfill(args.jobs, args.force)
+    finally:
+        db_client.close()
+    print(f'Ingested {records} records from {tasks} tasks')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Ingest the output.xml of existing test results into the robot result store')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='number of result directories to ingest in parallel, default to the CPU count')
+    parser.add_argument('-f', '--force', action='store_true', help='ingest again the tasks that have been ingested')
+    asyncio.run(main(parser.parse_args()))
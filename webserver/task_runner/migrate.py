@@ -0,0 +1,29 @@
+import argparse
+import asyncio
+import sys
+from pathlib import Path
+sys.path.append(str(Path('.').resolve()))
+
+import motor.motor_asyncio
+
+from app import app
+
+
+async def main(args):
+    db_client = motor.motor_asyncio.AsyncIOMotorClient(f"{app.config['MONGODB_URL']}:{app.config['MONGODB_PORT']}")
+    app.config.db = db_client[app.config['MONGODB_DATABASE']]
+
+    # the models are bound to the database on import
+    from task_runner.util.layout import migrate_result_layout
+    try:
+        moved, skipped = await migrate_result_layout(args.jobs, args.dry_run)
+    finally:
+        db_client.close()
+    print(f'{"Would move" if args.dry_run else "Moved"} {moved} result directories, skipped {skipped} of the tasks in progress')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Move the result directories of the flat layout to the sharded one, it can run along with the server')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='number of directories to move in parallel, default to the CPU count')
+    parser.add_argument('-n', '--dry-run', action='store_true', help='count the directories to move without moving them')
+    asyncio.run(main(parser.parse_args()))
@@ -8,6 +8,7 @@ import pymongo
 import queue
 import re
 import signal
+import socket
 import subprocess
 import sys
 import threading
@@ -26,11 +27,12 @@ from app.main.model.database import (EVENT_CODE_CANCEL_TASK,
                                      EVENT_CODE_START_TASK,
                                      EVENT_CODE_UPDATE_USER_SCRIPT,
                                      EVENT_CODE_GET_ENDPOINT_CONFIG,
-                                     QUEUE_PRIORITY, Endpoint, EventQueue,
-                                     Organization, Task, TaskQueue, Team)
-from app.main.util import get_room_id, async_rmtree, async_exists, async_makedirs
+                                     QUEUE_PRIORITY, Endpoint, Event, EventQueue, Organization, Task, TaskLog, TaskQueue, Team)
+from app.main.util import get_room_id, get_task_room_id, async_rmtree, async_exists, async_makedirs
 from app.main.util.get_path import get_test_result_path, get_upload_files_root, get_user_scripts_root
-from app.main.util.tarball import make_tarfile_from_dir
+from app.main.util.blobstore import collect_garbage, expire_partial_uploads, expire_upload_dirs, link_files
+from app.main.util.fileserve import precompress_files
+from app.main.util.tarball import evict_tarballs
 
 from bson import DBRef, ObjectId
 from wsrpc import WebsocketRPC
@@ -39,8 +41,18 @@ from sanic import Blueprint
 from sanic.log import logger
 from sanic.websocket import ConnectionClosed, WebSocketProtocol
 
+from task_runner.util.archive import archive_tasks
 from task_runner.util.dbhelper import db_update_test
+from task_runner.util.dispatcher import KeyedDispatcher
+from task_runner.util.fairshare import get_gate, get_share_weight
+from task_runner.util.durations import POLICY_SEJ, task_selector
+from task_runner.util.ingest import ingest_output
+from task_runner.util.lease import LeaseManager
 from task_runner.util.notification import notification_chain_call, notification_chain_init
+from task_runner.util.pipeline import advance_pipeline
+from task_runner.util.rerun import merge_rerun
+from task_runner.util.scheduler import EndpointScheduler
+from task_runner.util.shard import finish_shard, start_shard
 from task_runner.util.xmlrpcserver import XMLRPCServer
 
 ROBOT_PROCESSES = {}  # {task id: process instance}
@@ -48,7 +60,11 @@ TASK_PER_ENDPOINT = {}     # {taskqueue id: idle counter (int)}}
 #TASK_LOCK = threading.Lock()
 ROOM_MESSAGES = {}  # {"organziation:team": old_message, new_message}
 RPC_PROXIES = {}    # {"endpoint_id": (websocket, rpc)}
-TASKS_CACHED = {}
+SCHEDULERS = {}     # {endpoint id: EndpointScheduler}
+LEASES = None       # LeaseManager of the endpoints owned by this instance
+DISPATCHER = None   # KeyedDispatcher of the events
+HELD_EVENTS = set() # ids of the events claimed by this instance, waiting in the dispatcher or being processed
+LOG_BACKLOG_INTERVAL = 1    # seconds between the saves of the console output for the web workers
 
 bp = Blueprint('rpc_proxy', url_prefix='/rpc_proxy')
 
@@ -87,6 +103,8 @@ async def event_handler_cancel_task(app, event):
         task.status = 'cancelled'
         await task.commit()
         logger.info('Waiting task cancelled')
+        if task.pipeline:
+            await advance_pipeline(task.pipeline.pk)
         return
 
     if task.status == 'waiting':
@@ -112,6 +130,8 @@ async def event_handler_cancel_task(app, event):
             task.status = 'cancelled'
             await task.commit()
             logger.info('Waiting task cancelled without process running')
+            if task.pipeline:
+                await advance_pipeline(task.pipeline.pk)
             return
     if task.status == 'running':
         if str(endpoint.pk) in TASK_PER_ENDPOINT:
@@ -145,15 +165,29 @@ async def event_handler_start_task(app, event):
         if not to_delete:
             logger.error('Endpoint not found for {}@{}'.format(org_name, endpoint_uid))
         return
+    await start_endpoint_loop(app, endpoint, organization, team)
+
+async def save_log_backlog(task, message):
+    await TaskLog.collection.insert_one({'schema_version': '1', 'task': task.pk, 'message': message, 'date': datetime.datetime.utcnow()})
+
+async def start_endpoint_loop(app, endpoint, organization, team):
     endpoint_id = str(endpoint.pk)
 
     def delete_task(task):
-        del TASK_PER_ENDPOINT[endpoint_id]
+        TASK_PER_ENDPOINT.pop(endpoint_id, None)
 
+    if endpoint_id in SCHEDULERS:
+        SCHEDULERS[endpoint_id].wake()
     if endpoint_id not in TASK_PER_ENDPOINT:
-        await reset_task_queue_status(app, organization, team)
-        task = asyncio.create_task(process_task_per_endpoint(app, endpoint, organization, team))
+        # mark it before awaiting as the events are processed concurrently
         TASK_PER_ENDPOINT[endpoint_id] = 1
+        try:
+            await reset_task_queue_status(app, organization, team, endpoint)
+        except BaseException:
+            # unmark it so that the endpoint loop is started by the next event
+            TASK_PER_ENDPOINT.pop(endpoint_id, None)
+            raise
+        task = asyncio.create_task(process_task_per_endpoint(app, endpoint, organization, team))
         task.add_done_callback(delete_task)
     else:
         TASK_PER_ENDPOINT[endpoint_id] = 2
@@ -190,7 +224,7 @@ async def event_loop(app):
 
     while True:
         try:
-            event = await eventqueue.pop()
+            event = await eventqueue.pop(owner=LEASES.owner)
         except pymongo.errors.AutoReconnect:
             logger.warning('polling event queue network error')
             event = None
@@ -202,14 +236,108 @@ async def event_loop(app):
             logger.warning('event {} has been deleted, ignore it'.format(event.pk))
             continue
 
-        logger.info('Start to process event {} ...'.format(event.code))
+        await submit_event(app, event)
 
-        try:
-            await EVENT_HANDLERS[event.code](app, event)
-            event.status = 'Processed'
-            await event.commit()
-        except KeyError:
-            logger.error('Unknown message: %s' % event.code)
+def get_dispatcher(app):
+    global DISPATCHER
+    if not DISPATCHER:
+        DISPATCHER = KeyedDispatcher(app.config.EVENT_WORKERS)
+    return DISPATCHER
+
+async def submit_event(app, event):
+    """
+    Events are processed concurrently except those of the same endpoint, or of the same task if it's not on an endpoint yet
+    """
+    key = event.message.get('endpoint_uid', None) or event.message.get('task_id', None) or event.code
+    HELD_EVENTS.add(event.pk)
+    await get_dispatcher(app).submit(str(key), lambda: release_event(app, event))
+
+async def release_event(app, event):
+    try:
+        await dispatch_event(app, event)
+    finally:
+        HELD_EVENTS.discard(event.pk)
+
+async def dispatch_event(app, event):
+    endpoint_uid = event.message.get('endpoint_uid', None)
+    if endpoint_uid and event.code in (EVENT_CODE_START_TASK, EVENT_CODE_CANCEL_TASK) and not LEASES.holds(endpoint_uid):
+        # the task loop of an endpoint runs on the instance owning it
+        acquired, previous = await LEASES.acquire(endpoint_uid)
+        if not acquired:
+            if await LEASES.forward(endpoint_uid, event.pk):
+                logger.info('Forward event {} to the owner of endpoint {}'.format(event.code, endpoint_uid))
+                event.status = 'Forwarded'
+                await event.commit()
+                return
+            acquired, previous = await LEASES.acquire(endpoint_uid)
+        if previous:
+            await take_over_endpoint(app, endpoint_uid)
+
+    if event.code not in EVENT_HANDLERS:
+        logger.error('Unknown message: %s' % event.code)
+        event.status = 'Failed'
+        await event.commit()
+        return
+    logger.info('Start to process event {} ...'.format(event.code))
+
+    # acknowledge the event once it's done, a failed one isn't retried as it would most likely fail again
+    try:
+        await EVENT_HANDLERS[event.code](app, event)
+    except Exception:
+        event.status = 'Failed'
+        await event.commit()
+        raise
+    event.status = 'Processed'
+    await event.commit()
+
+async def requeue_events(app, own=False):
+    """
+    Put back to the event queue the events claimed but not acknowledged in time, or those of this instance's previous run.
+    The claims on the events still held by this instance are renewed first, so that an event waiting long in the dispatcher
+    or taking long to process isn't processed twice.
+    """
+    now = datetime.datetime.utcnow()
+    held = list(HELD_EVENTS)
+    if held:
+        await Event.collection.update_many({'_id': {'$in': held}, 'status': 'Processing', 'owner': LEASES.owner},
+                                           {'$set': {'claim_date': now}})
+    query = {'status': 'Processing', 'claim_date': {'$lt': now - datetime.timedelta(seconds=app.config.EVENT_CLAIM_TIMEOUT)}}
+    if own:
+        query = {'status': 'Processing', '$or': [{'owner': LEASES.owner}, {'claim_date': query['claim_date']}]}
+    query['_id'] = {'$nin': held}
+    requeued = []
+    async for event in Event.collection.find(query, {'claim_date': 1}):
+        # only one instance gets to requeue an event
+        if await Event.collection.find_one_and_update({'_id': event['_id'], 'status': 'Processing', 'claim_date': event['claim_date']},
+                                                      {'$set': {'status': 'Triggered'}}):
+            requeued.append(event['_id'])
+    if not requeued:
+        return
+    eventqueue = await EventQueue.find_one()
+    try:
+        await eventqueue.push_many(requeued)
+    except RuntimeError:
+        await Event.collection.update_many({'_id': {'$in': requeued}}, {'$set': {'status': 'Processing'}})
+        return
+    logger.warning('Requeued {} events not acknowledged'.format(len(requeued)))
+
+async def take_over_endpoint(app, endpoint_uid):
+    """
+    The tasks left running by a dead instance are failed, then the task loops are resumed
+    """
+    async for endpoint in Endpoint.find({'uid': endpoint_uid}):
+        async for taskqueue in TaskQueue.find({'endpoint': endpoint.pk, 'running_task': {'$ne': None}}):
+            task = await taskqueue.running_task.fetch()
+            if task.status in ('waiting', 'running'):
+                task.status = 'failed'
+                task.comment = 'Interrupted as the task runner is gone'
+                await task.commit()
+                logger.warning('Task {} on endpoint {} is interrupted by the failover'.format(task.pk, endpoint_uid))
+            del taskqueue.running_task
+            await taskqueue.commit()
+        organization = await endpoint.organization.fetch()
+        team = await endpoint.team.fetch() if endpoint.team else None
+        await start_endpoint_loop(app, endpoint, organization, team)
 
 def convert_json_to_robot_variable(variables, default_variables, variable_file):
     sub_type = 0
@@ -302,78 +430,84 @@ def convert_json_to_robot_variable(variables, default_variables, variable_file):
 
 
 async def process_task_per_endpoint(app, endpoint, organization=None, team=None):
-    global ROBOT_PROCESSES, TASKS_CACHED
+    global ROBOT_PROCESSES, SCHEDULERS
 
     if not organization and not team:
         logger.error('Argument organization and team must neither be None')
         return
     room_id = get_room_id(str(organization.pk), str(team.pk) if team else '')
 
-    taskqueues = await TaskQueue.find({'organization': organization.pk, 'team': team.pk if team else None, 'endpoint': endpoint.pk}).to_list(len(QUEUE_PRIORITY))
-    if len(taskqueues) == 0:
-        logger.error('Taskqueue not found')
-        return
-    # taskqueues = [q for q in taskqueues]  # query becomes stale if the document it points to gets changed elsewhere, use document instead of query to perform deletion
-    taskqueue_first = taskqueues[0]
-
     endpoint_id = str(endpoint.pk)
     endpoint_uid = endpoint.uid
     if team and not organization:
         organization = await team.organization.fetch()
     org_name = (organization.name + '-' + team.name) if team else organization.name
 
+    if endpoint_id not in SCHEDULERS:
+        SCHEDULERS[endpoint_id] = EndpointScheduler(endpoint, organization, team, app.config.TASK_PRIORITY_AGING)
+    scheduler = SCHEDULERS[endpoint_id]
+    selector = None
+    if app.config.TASK_SCHEDULING_POLICY == POLICY_SEJ:
+        selector = lambda taskqueue: task_selector(endpoint, organization, team,
+                                                   app.config.TASK_SCHEDULING_POLICY,
+                                                   app.config.TASK_SCHEDULING_MAX_WAIT)
+
     while True:
-        await taskqueue_first.reload()
-        if taskqueue_first.to_delete:
-            for taskqueue in taskqueues:
+        taskqueue, task = await scheduler.pop(selector)
+        if scheduler.released:
+            del SCHEDULERS[endpoint_id]
+            logger.warning('Abort the task loop as the lease is lost: {} @ {}'.format(org_name, endpoint_uid))
+            break
+        if scheduler.to_delete:
+            for taskqueue in scheduler.taskqueues.values():
                 await taskqueue.delete()
             await endpoint.delete()
+            del SCHEDULERS[endpoint_id]
             logger.info('Abort the task loop: {} @ {}'.format(org_name, endpoint_uid))
             break
-        # TODO: lower priority tasks will take precedence if higher priority queue is empty first
-        # but filled then when thread is searching for tasks in the lower priority task queues
-        for priority in QUEUE_PRIORITY:
-            exit_task = False
-            for taskqueue in taskqueues:
-                await taskqueue.reload()
-                if taskqueue.to_delete:
-                    exit_task = True
-                    break
-                if taskqueue.priority == priority:
-                    break
-            else:
-                logger.error('Found task queue with unknown priority')
-                continue
-
-            if exit_task:
-                break
-
-            # "continue" to search for tasks in the lower priority task queues
-            # "break" to start over to search for tasks from the top priority task queue
-            task = await taskqueue.pop()
-            if not task:
+        if not taskqueue:
+            if TASK_PER_ENDPOINT[endpoint_id] != 1:
+                TASK_PER_ENDPOINT[endpoint_id] = 1
+                logger.info('Run the recently scheduled task')
                 continue
-            task_id = str(task.pk)
-            if isinstance(task, DBRef):
-                logger.warning('task {} has been deleted, ignore it'.format(task_id))
-                taskqueue.running_task = None
-                await taskqueue.commit()
-                break
+            # del TASK_PER_ENDPOINT[endpoint_id]
+            logger.info('task processing finished, exiting the process loop')
+            break
+        if not task:
+            continue
+        task_id = str(task.pk)
+        if isinstance(task, DBRef):
+            logger.warning('task {} has been deleted, ignore it'.format(task_id))
+            taskqueue.running_task = None
+            await taskqueue.commit()
+            continue
 
-            if task.kickedoff != 0 and not task.parallelization:
-                logger.info('task has been taken over by other threads, do nothing')
-                taskqueue.running_task = None
-                await taskqueue.commit()
-                break
+        if task.kickedoff != 0 and not task.parallelization:
+            logger.info('task has been taken over by other threads, do nothing')
+            taskqueue.running_task = None
+            await taskqueue.commit()
+            continue
 
-            await task.collection.find_one_and_update({'_id': task.pk}, {'$inc': {'kickedoff': 1}})
-            await task.reload()
-            if task.kickedoff != 1 and not task.parallelization:
-                logger.warning('a race condition happened')
-                taskqueue.running_task = None
-                await taskqueue.commit()
-                break
-            test = await task.test.fetch()
+        await task.collection.find_one_and_update({'_id': task.pk}, {'$inc': {'kickedoff': 1}})
+        await task.reload()
+        if task.kickedoff != 1 and not task.parallelization:
+            logger.warning('a race condition happened')
+            taskqueue.running_task = None
+            await taskqueue.commit()
+            continue
+        test = await task.test.fetch()
+
+        gate = None
+        usage = (0, None)   # the run time and the waiting time of the task accounted on releasing the endpoint
+        if app.config.FAIR_SHARE:
+            # the endpoint may be shared with other organizations or teams, wait for its turn
+            gate = get_gate(endpoint_uid, app.config.FAIR_SHARE_HALF_LIFE)
+            await gate.acquire(organization, team, await get_share_weight(organization))
+        try:
+            if gate:
+                await task.reload()
+                if task.status == 'cancelled':
+                    continue
 
             logger.info('Start to run task {} in the thread {}'.format(task_id, threading.current_thread().name))
 
@@ -393,7 +527,7 @@ async def process_task_per_endpoint(app, endpoint, organization=None, team=None)
                 convert_json_to_robot_variable(task.variables, test.variables, variable_file)
                 args.extend(['--variablefile', str(variable_file)])
 
-            addr, port = '127.0.0.1', 8270
+            addr, port = '127.0.0.1', app.config.RUNNER_XMLRPC_PORT
             args.extend(['-v', f'address_daemon:{addr}', '-v', f'port_daemon:{port}',
                         '-v', f'task_id:{task_id}', '-v', f'endpoint_uid:{endpoint_uid}'])
             args.append(os.path.join(scripts_dir, test.path, test.test_suite + '.md'))
@@ -406,6 +540,8 @@ async def process_task_per_endpoint(app, endpoint, organization=None, team=None)
             task.run_date = datetime.datetime.utcnow()
             task.endpoint_run = endpoint
             await task.commit()
+            if task.parent:
+                await start_shard(task)
             await sio.emit('task started', {'task_id': task_id}, room=room_id)
 
             log_msg = StringIO()
@@ -433,17 +569,35 @@ async def process_task_per_endpoint(app, endpoint, organization=None, team=None)
                         await msg_q.put(c)
             asyncio.create_task(_read_log())
 
+            # a standalone runner doesn't share ROOM_MESSAGES with the web workers, the backlog is saved for them
+            save_backlog = app.config.ROLE == 'runner'
             async def _emit_log():
                 nonlocal msg_q
                 msg = ''
+                backlog = ''
+                save_time = time.monotonic()
                 while True:
                     try:
                         c = msg_q.get_nowait()
                     except asyncio.QueueEmpty:
                         if msg:
-                            await sio.emit('test report', {'task_id': task_id, 'message': msg}, room=room_id)
+                            await sio.emit('test report', {'task_id': task_id, 'message': msg}, room=get_task_room_id(task_id))
+                            if save_backlog:
+                                backlog += msg
                             msg = ''
-                        c = await msg_q.get()
+                        if backlog and time.monotonic() >= save_time:
+                            await save_log_backlog(task, backlog)
+                            backlog, save_time = '', time.monotonic() + LOG_BACKLOG_INTERVAL
+                        if backlog:
+                            # save the rest once the interval is over even if no more output comes
+                            try:
+                                c = await asyncio.wait_for(msg_q.get(), save_time - time.monotonic())
+                            except asyncio.TimeoutError:
+                                await save_log_backlog(task, backlog)
+                                backlog, save_time = '', time.monotonic() + LOG_BACKLOG_INTERVAL
+                                c = await msg_q.get()
+                        else:
+                            c = await msg_q.get()
                     finally:
                         if c:
                             msg += c
@@ -467,7 +621,7 @@ async def process_task_per_endpoint(app, endpoint, organization=None, team=None)
                 else:
                     log_msg_all.write(ss)
                 logger.info('\n' + log_msg_all.getvalue())
-                await sio.emit('test report', {'task_id': task_id, 'message': ss}, room=room_id)
+                await sio.emit('test report', {'task_id': task_id, 'message': ss}, room=get_task_room_id(task_id))
             else:
                 logger.info('\n' + log_msg.getvalue())
 
@@ -478,44 +632,63 @@ async def process_task_per_endpoint(app, endpoint, organization=None, team=None)
                 await task.reload()
                 if task.status != 'cancelled':
                     task.status = 'failed'
+            # the result directory is written on after the task finished, it's not ready to move until then
+            task.results_ready = False
             await task.commit()
-            await sio.emit('task finished', {'task_id': task_id, 'status': task.status}, room=room_id)
-            ROOM_MESSAGES[room_id][task_id].close()
-            del ROOM_MESSAGES[room_id][task_id]
-            if task_id in TASKS_CACHED:
-                del TASKS_CACHED[task_id]
+            usage = ((datetime.datetime.utcnow() - task.run_date).total_seconds(),
+                     (task.run_date - task.schedule_date).total_seconds() if task.schedule_date else None)
+        finally:
+            # never keep the endpoint from the others sharing it, even if running the task failed
+            if gate:
+                await gate.release(organization, team, *usage)
+        await sio.emit('task finished', {'task_id': task_id, 'status': task.status}, room=room_id)
+        ROOM_MESSAGES[room_id][task_id].close()
+        del ROOM_MESSAGES[room_id][task_id]
+        if app.config.ROLE == 'runner':
+            await TaskLog.collection.delete_many({'task': task.pk})
 
-            del taskqueue.running_task
-            await taskqueue.commit()
-            endpoint.last_run_date = datetime.datetime.utcnow()
-            await endpoint.commit()
+        del taskqueue.running_task
+        await taskqueue.commit()
+        endpoint.last_run_date = datetime.datetime.utcnow()
+        await endpoint.commit()
 
+        try:
             if task.upload_dir:
                 resource_dir_tmp = get_upload_files_root(task)
                 if await async_exists(resource_dir_tmp):
-                    await make_tarfile_from_dir(str(result_dir / 'resource.tar.gz'), resource_dir_tmp)
+                    await link_files(resource_dir_tmp, result_dir / 'resource')
 
             result_dir_tmp = result_dir / 'temp'
             if await async_exists(result_dir_tmp):
                 await async_rmtree(result_dir_tmp)
-
-            await notification_chain_call(task)
-            TASK_PER_ENDPOINT[endpoint_id] = 1
-            break
-        else:
-            if TASK_PER_ENDPOINT[endpoint_id] != 1:
-                TASK_PER_ENDPOINT[endpoint_id] = 1
-                logger.info('Run the recently scheduled task')
-                continue
-            # del TASK_PER_ENDPOINT[endpoint_id]
-            logger.info('task processing finished, exiting the process loop')
-            break
+            try:
+                await ingest_output(task, result_dir)
+            except Exception as e:
+                logger.error(f'Failed to ingest the results of task {task_id}: {e}')
+            # the rerun is ingested by its own output before it's merged into a combined report
+            if task.rerun_of:
+                await merge_rerun(task, result_dir)
+            await precompress_files(result_dir)
+
+            if task.parent:
+                parent = await finish_shard(task)
+                if parent:
+                    await sio.emit('task finished', {'task_id': str(parent.pk), 'status': parent.status}, room=room_id)
+                    await notification_chain_call(parent)
+            else:
+                await notification_chain_call(task)
+        finally:
+            # never leave the result directory out of the migration and the archive, even if post-processing failed
+            await Task.collection.update_one({'_id': task.pk}, {'$set': {'results_ready': True}})
+        if task.pipeline:
+            await advance_pipeline(task.pipeline.pk)
+        TASK_PER_ENDPOINT[endpoint_id] = 1
 
 async def check_endpoint(app, endpoint_uid, organization, team):
     if team:
         assert organization == team.organization
     org_name = (organization.name + '-' + team.name) if team else organization.name
-    url = 'http://127.0.0.1:8270/{}'.format(endpoint_uid)
+    url = 'http://127.0.0.1:{}/{}'.format(app.config.RUNNER_XMLRPC_PORT, endpoint_uid)
     async with aiohttp_xmlrpc.client.ServerProxy(url) as server:
         endpoint = await Endpoint.find_one({'uid': endpoint_uid, 'organization': organization.pk, 'team': team.pk if team else None})
         try:
@@ -557,7 +730,6 @@ def normalize_url(url):
 
 @bp.websocket('/msg')
 async def rpc_message_relay(request, ws):
-    global TASKS_CACHED
     while True:
         try:
             ret = await ws.recv()
@@ -571,15 +743,8 @@ async def rpc_message_relay(request, ws):
             # task daemon's message
             continue
         data = ret['data']
-        if task_id not in TASKS_CACHED:
-            task = await Task.find_one({'_id': ObjectId(task_id)})
-            TASKS_CACHED[task_id] = task
-        else:
-            task = TASKS_CACHED[task_id]
-        organization = await task.organization.fetch()
-        team = await task.team.fetch()
-        room_id = get_room_id(str(organization.id), str(team.id) if team else '')
-        await sio.emit('test log', {'task_id': task_id, 'message': data}, room=room_id)
+        # only the clients viewing the task get its log
+        await sio.emit('test log', {'task_id': task_id, 'message': data}, room=get_task_room_id(task_id))
 
 @bp.websocket('/rpc')
 async def rpc_proxy(request, ws):
@@ -628,6 +793,17 @@ async def rpc_proxy(request, ws):
     if endpoint.status == 'Unauthorized':
         await ws.send(endpoint.status)
         return
+    acquired, previous = await LEASES.acquire(endpoint.uid)
+    if not acquired:
+        lease = await LEASES.get_owner(endpoint.uid)
+        if lease and lease.get('url'):
+            # route the endpoint to the instance owning it
+            await ws.send('Redirect ' + lease['url'])
+        else:
+            await ws.send('Endpoint is owned by another task runner')
+        return
+    if previous:
+        await take_over_endpoint(request.app, endpoint.uid)
     await ws.send('OK')
 
     def error_check(fut):
@@ -662,12 +838,14 @@ async def rpc_proxy(request, ws):
             rpc._request_table[k].set_result({'status': 'FAIL', 'error': f'Connection of {url} was lost, possibly due to long time blocking operations'})
         rpc._request_table = {}
 
-    try:
-        await RPC_PROXIES[url].close()
-    except websockets.exceptions.ConnectionClosedError:
-        pass
-        # print(f'websocket close error for endpoint {url}')
-    del RPC_PROXIES[url]
+    # the proxy may have been replaced by a reconnection or dropped as the lease is lost
+    if RPC_PROXIES.get(url) is rpc:
+        try:
+            await rpc.close()
+        except websockets.exceptions.ConnectionClosedError:
+            pass
+            # print(f'websocket close error for endpoint {url}')
+        del RPC_PROXIES[url]
 
 def restart_interrupted_tasks(app, organization=None, team=None):
     """
@@ -686,9 +864,13 @@ async def reset_event_queue_status(app):
     if ret:
         logger.info('Reset the read/write lock for event queue')
 
-async def reset_task_queue_status(app, organization=None, team=None):
+async def reset_task_queue_status(app, organization=None, team=None, endpoint=None):
     cnt = 0
-    async for q in TaskQueue.find({'organization': organization.pk, 'team': team.pk if team else None}):
+    query = {'organization': organization.pk, 'team': team.pk if team else None}
+    # the queues of the other endpoints may be locked by the loops running on them
+    if endpoint:
+        query['endpoint'] = endpoint.pk
+    async for q in TaskQueue.find(query):
         ret = await q.collection.find_one_and_update({'_id': q.pk, 'rw_lock': True}, {'$set': {'rw_lock': False}})
         if ret:
             logger.info('Reset the read/write lock for queue {} with priority {}'.format(q.endpoint.uid, q.priority))
@@ -717,12 +899,15 @@ async def prepare_to_run(app, organization=None, team=None):
 async def start_event_thread(app):
     logger.info('Start the event loop')
     await reset_event_queue_status(app)
+    await requeue_events(app, own=True)
     await event_loop(app)
 
 async def start_heartbeat_thread(app):
     logger.info('Start the endpoint online check loop')
     while True:
-        async for endpoint in Endpoint.find():
+        # the endpoints owned by other instances are connected to them
+        peers = await LEASES.peer_endpoints()
+        async for endpoint in Endpoint.find({'uid': {'$nin': list(peers)}}):
             organization = await endpoint.organization.fetch()
             team = None
             if endpoint.team:
@@ -730,12 +915,107 @@ async def start_heartbeat_thread(app):
             await check_endpoint(app, endpoint.uid, organization, team)
         await asyncio.sleep(30)
 
+async def start_archive_thread(app):
+    logger.info('Start the archive compactor for the tasks finished {} days ago'.format(app.config.ARCHIVE_AFTER_DAYS))
+    while True:
+        horizon = datetime.datetime.utcnow() - datetime.timedelta(days=app.config.ARCHIVE_AFTER_DAYS)
+        cnt = 0
+        try:
+            cnt = await archive_tasks(horizon, app.config.ARCHIVE_DUTY_CYCLE)
+            if cnt:
+                await collect_garbage()
+        except Exception as e:
+            logger.exception(e)
+        # keep going while there is a backlog, the duty cycle throttles it
+        await asyncio.sleep(1 if cnt else app.config.ARCHIVE_INTERVAL)
+
+async def start_cleanup_thread(app):
+    logger.info('Start the cleanup of the expired upload directories, partial uploads and cached tarballs')
+    while True:
+        try:
+            if app.config.UPLOAD_EXPIRE_DAYS > 0:
+                horizon = datetime.datetime.utcnow() - datetime.timedelta(days=app.config.UPLOAD_EXPIRE_DAYS)
+                if await expire_upload_dirs(horizon):
+                    await collect_garbage()
+            if app.config.TARBALL_CACHE_TTL > 0:
+                await evict_tarballs(app.config.TARBALL_CACHE_TTL)
+            if app.config.PARTIAL_UPLOAD_TTL > 0:
+                await expire_partial_uploads(app.config.PARTIAL_UPLOAD_TTL)
+        except Exception as e:
+            logger.exception(e)
+        await asyncio.sleep(app.config.CLEANUP_INTERVAL)
+
+async def submit_forwarded_events(app, event_ids):
+    """
+    Hand the events forwarded to this instance to the dispatcher, apart from the lease loop
+    as submitting waits while the dispatcher is full but the leases must be renewed in time
+    """
+    # the events are claimed on taking, hold them for the claims to be renewed while waiting
+    HELD_EVENTS.update(event_ids)
+    for event_id in event_ids:
+        try:
+            event = await Event.find_one({'_id': event_id})
+            if event:
+                await submit_event(app, event)
+            else:
+                HELD_EVENTS.discard(event_id)
+        except Exception as e:
+            HELD_EVENTS.discard(event_id)
+            logger.exception(e)
+
+async def drop_endpoint(endpoint_uid):
+    '''
+    Stop serving the endpoint whose lease is lost, another instance may have taken it over
+    '''
+    for endpoint_id, scheduler in list(SCHEDULERS.items()):
+        if scheduler.endpoint.uid != endpoint_uid:
+            continue
+        if endpoint_id in TASK_PER_ENDPOINT:
+            # the task loop exits before taking the next task, the running task is failed by the new owner
+            scheduler.release()
+            async for task in Task.collection.find({'endpoint_run': scheduler.endpoint.pk, 'status': 'running'}, {'_id': 1}):
+                if str(task['_id']) in ROBOT_PROCESSES:
+                    ROBOT_PROCESSES[str(task['_id'])].terminate()
+        else:
+            del SCHEDULERS[endpoint_id]
+    for url in [url for url in RPC_PROXIES if url != 'loop' and uuid.UUID(url.strip('/').split('/')[0]) == endpoint_uid]:
+        rpc = RPC_PROXIES.pop(url)
+        try:
+            await rpc.close()
+        except websockets.exceptions.ConnectionClosedError:
+            pass
+
+async def start_lease_thread(app):
+    logger.info('Start the endpoint lease loop of task runner {}'.format(LEASES.owner))
+    forwarder = None
+    ticks = 0
+    while True:
+        if ticks % max(app.config.RUNNER_LEASE_TTL // 3, 1) == 0:
+            # the endpoints in use are those connected or having a task loop running
+            in_use = {uuid.UUID(url.strip('/').split('/')[0]) for url in RPC_PROXIES if url != 'loop'}
+            in_use |= {s.endpoint.uid for endpoint_id, s in SCHEDULERS.items() if endpoint_id in TASK_PER_ENDPOINT}
+            for endpoint_uid in await LEASES.renew(in_use):
+                logger.error('Lost the lease on endpoint {}'.format(endpoint_uid))
+                await drop_endpoint(endpoint_uid)
+            await requeue_events(app)
+        ticks += 1
+
+        # the forwarded events are left on the leases until those taken before are submitted
+        if forwarder is None or forwarder.done():
+            event_ids = await LEASES.take_events()
+            forwarder = asyncio.ensure_future(submit_forwarded_events(app, event_ids)) if event_ids else None
+        await asyncio.sleep(1)
+
 def start_xmlrpc_server(app):
     logger.info('Start local XML RPC server')
-    thread = XMLRPCServer(RPC_PROXIES, host='0.0.0.0', port=8270)
+    thread = XMLRPCServer(RPC_PROXIES, host='0.0.0.0', port=app.config.RUNNER_XMLRPC_PORT)
     thread.daemon = True
     thread.start()
     return thread
 
 def initialize_runner(app):
+    global LEASES
+    # the id must survive a restart for the instance to recognize the events it claimed before
+    LEASES = LeaseManager(app.config.RUNNER_ID or app.config.RUNNER_URL or '{}:{}'.format(socket.getfqdn(), app.config.PORT),
+                          app.config.RUNNER_URL, app.config.RUNNER_LEASE_TTL)
     notification_chain_init(app)
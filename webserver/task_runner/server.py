@@ -0,0 +1,27 @@
+import argparse
+import os
+import socket
+import sys
+from pathlib import Path
+sys.path.append(str(Path('.').resolve()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a task runner instance which serves the test endpoints connected to it')
+    parser.add_argument('--host', default='0.0.0.0', help='the address to listen on')
+    parser.add_argument('-p', '--port', type=int, default=5001, help='the port for the endpoints to connect')
+    parser.add_argument('--xmlrpc-port', type=int, default=None, help='the local XML RPC port for robot, default to 8270')
+    parser.add_argument('--url', default=None, help='host:port for the endpoints to reach this instance, default to the hostname and the port')
+    parser.add_argument('--id', default=None, help='the unique id of this instance, stable across restarts, default to the url')
+    args = parser.parse_args()
+
+    # the configuration is read on import
+    os.environ['EMBER_ROLE'] = 'runner'
+    os.environ['RUNNER_URL'] = args.url or '{}:{}'.format(socket.getfqdn(), args.port)
+    if args.xmlrpc_port:
+        os.environ['RUNNER_XMLRPC_PORT'] = str(args.xmlrpc_port)
+    if args.id:
+        os.environ['RUNNER_ID'] = args.id
+
+    from app import app
+    app.run(host=args.host, port=args.port)
@@ -0,0 +1,196 @@
+import asyncio
+import os
+import time
+import zipfile
+from pathlib import Path
+
+from async_files.utils import async_wraps
+from bson import ObjectId
+from pymongo import ReplaceOne, UpdateOne
+from sanic.log import logger
+
+from app.main.model.database import Organization, RobotResult, Task, Team, TestResult
+from app.main.util import async_exists, async_rmtree
+from app.main.util.blobstore import MANIFEST_SUFFIX, remove_files
+from app.main.util.fileserve import GZIP_SUFFIX
+from app.main.util.get_path import USERS_ROOT, get_test_results_root, resolve_test_result_path
+
+TEST_RESULTS_ARCHIVE_ROOT = 'test_results_archive'
+FINISHED_STATUS = ('successful', 'failed', 'cancelled')
+ARCHIVE_BATCH_SIZE = 100
+WRITE_BATCH_SIZE = 1000
+
+_indexed = set()    # the archive collections whose indexes have been created
+
+def get_archive_month(task_id):
+    '''
+    A task is archived to the partition of the month it was created in, which is told by its id without a lookup
+    '''
+    return ObjectId(task_id).generation_time.strftime('%Y%m')
+
+def get_archive_collection(collection, month):
+    '''
+    The monthly partition of a collection holding the archived documents, eg. tasks_archive_202610
+    '''
+    return collection.database['{}_archive_{}'.format(collection.name, month)]
+
+async def find_archived_task(task_id):
+    raw = await get_archive_collection(Task.collection, get_archive_month(task_id)).find_one({'_id': ObjectId(task_id)})
+    return Task.build_from_mongo(raw) if raw else None
+
+def get_result_archive_path(task):
+    return USERS_ROOT / task.result_archive
+
+def _pack_results(zip_path, result_dirs):
+    '''
+    Pack the result directories into a new zip archive with the members prefixed by the task ids,
+    it's written aside then renamed so that an archive is never seen half written
+    '''
+    zip_path.parent.mkdir(parents=True, exist_ok=True)
+    zip_tmp = zip_path.with_suffix('.tmp')
+    with zipfile.ZipFile(zip_tmp, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        for task_id, result_dir in result_dirs:
+            for root, dirs, files in os.walk(result_dir):
+                for name in files:
+                    # the blob references of the resource files are released on archiving
+                    if name.endswith(MANIFEST_SUFFIX):
+                        continue
+                    # the compressed siblings for serving are made again from the originals if ever needed
+                    if name.endswith(GZIP_SUFFIX) and name[:-len(GZIP_SUFFIX)] in files:
+                        continue
+                    path = os.path.join(root, name)
+                    zf.write(path, '{}/{}'.format(task_id, Path(os.path.relpath(path, result_dir)).as_posix()))
+    os.replace(zip_tmp, zip_path)
+
+def _list_archived_files(zip_path, task_id):
+    '''
+    The result files of a task in the archive, in the form of tarball.path_to_dict
+    '''
+    tree = {'label': str(task_id), 'type': 'directory', 'children': []}
+    prefix = '{}/'.format(task_id)
+    with zipfile.ZipFile(zip_path) as zf:
+        names = zf.namelist()
+        members = set(names)
+        for name in names:
+            if not name.startswith(prefix):
+                continue
+            # archives packed earlier may still have the compressed siblings
+            if name.endswith(GZIP_SUFFIX) and name[:-len(GZIP_SUFFIX)] in members:
+                continue
+            node = tree
+            parts = name[len(prefix):].split('/')
+            for part in parts[:-1]:
+                child = next((c for c in node['children'] if c['label'] == part and c['type'] == 'directory'), None)
+                if not child:
+                    child = {'label': part, 'type': 'directory', 'children': []}
+                    node['children'].append(child)
+                node = child
+            node['children'].append({'label': parts[-1], 'type': 'file'})
+
+    def sort(node):
+        node['children'].sort(key=lambda x: x['type'] == 'directory')
+        for c in node['children']:
+            if c['type'] == 'directory':
+                sort(c)
+    sort(tree)
+    return tree
+
+def _open_archived_file(zip_path, task_id, file_path):
+    '''
+    Open a result file of a task in the archive for reading, None if it's not there.
+    The member keeps the archive open until it's closed.
+    '''
+    with zipfile.ZipFile(zip_path) as zf:
+        try:
+            return zf.open('{}/{}'.format(task_id, Path(file_path).as_posix()))
+        except KeyError:
+            return None
+
+list_archived_files = async_wraps(_list_archived_files)
+open_archived_file = async_wraps(_open_archived_file)
+
+async def _move_documents(collection, month, query):
+    archive = get_archive_collection(collection, month)
+    if archive.name not in _indexed and collection.name != Task.collection.name:
+        await archive.create_index('task')
+        _indexed.add(archive.name)
+    requests = []
+    async for doc in collection.find(query):
+        requests.append(ReplaceOne({'_id': doc['_id']}, doc, upsert=True))
+        if len(requests) == WRITE_BATCH_SIZE:
+            await archive.bulk_write(requests, ordered=False)
+            requests = []
+    if requests:
+        await archive.bulk_write(requests, ordered=False)
+    await collection.delete_many(query)
+
+async def _archive_group(organization_id, team_id, month, tasks):
+    organization = await Organization.find_one({'_id': organization_id}) if organization_id else None
+    team = await Team.find_one({'_id': team_id}) if team_id else None
+    result_dirs = []
+    zip_path = None
+    if organization:
+        results_root = await get_test_results_root(team=team, organization=organization)
+        for t in tasks:
+            result_dir = await resolve_test_result_path(results_root, t['_id'])
+            if await async_exists(result_dir):
+                result_dirs.append((t['_id'], result_dir))
+        if result_dirs:
+            zip_path = results_root.parent / TEST_RESULTS_ARCHIVE_ROOT / month / '{}.zip'.format(ObjectId())
+            await async_wraps(_pack_results)(zip_path, result_dirs)
+
+    # a task archived again after a crash gets a new result archive if its result directory is still there,
+    # otherwise the result archive recorded the first time is kept, so it's idempotent
+    packed = {task_id for task_id, _ in result_dirs}
+    archive = get_archive_collection(Task.collection, month)
+    requests = []
+    for t in tasks:
+        if t['_id'] in packed:
+            requests.append(ReplaceOne({'_id': t['_id']}, {**t, 'result_archive': zip_path.relative_to(USERS_ROOT).as_posix()}, upsert=True))
+        else:
+            requests.append(UpdateOne({'_id': t['_id']}, {'$set': {k: v for k, v in t.items() if k != '_id'}}, upsert=True))
+    await archive.bulk_write(requests, ordered=False)
+    task_ids = [t['_id'] for t in tasks]
+    await _move_documents(TestResult.collection, month, {'task': {'$in': task_ids}})
+    await _move_documents(RobotResult.collection, month, {'task': {'$in': task_ids}})
+
+    # the files go before the tasks, a crash in between leaves the tasks to be archived again rather than the files leaked
+    for _, result_dir in result_dirs:
+        await remove_files(result_dir / 'resource')
+        await async_rmtree(result_dir)
+    await Task.collection.delete_many({'_id': {'$in': task_ids}})
+
+async def archive_tasks(horizon, duty_cycle=1.0, batch_size=ARCHIVE_BATCH_SIZE):
+    '''
+    Move a batch of the finished tasks created before the horizon, along with their test results, to the monthly
+    archive collections and pack their result directories into a compressed archive of the month.
+    Each batch adds a zip to the month's directory rather than appending to one zip, so that a crash never damages
+    what was archived before, the archived tasks record which zip of the month holds their results.
+    The compactor sleeps between the groups of tasks so that it's busy for no more than the duty cycle of the time.
+    Return the number of tasks archived.
+    '''
+    # the result directory of a task just finished may still be post-processed
+    query = {'_id': {'$lt': ObjectId.from_datetime(horizon)}, 'status': {'$in': FINISHED_STATUS}, 'results_ready': {'$ne': False}}
+    tasks = await Task.collection.find(query).sort('_id', 1).limit(batch_size).to_list(batch_size)
+
+    # the results of a task are still read by the reruns and the shards of it not finished yet, eg. to merge the reports
+    task_ids = [t['_id'] for t in tasks]
+    busy = set()
+    async for t in Task.collection.find({'$and': [{'$or': [{'rerun_of': {'$in': task_ids}}, {'parent': {'$in': task_ids}}]},
+                                                  {'$or': [{'status': {'$nin': FINISHED_STATUS}}, {'results_ready': False}]}]},
+                                        {'rerun_of': 1, 'parent': 1}):
+        busy.update((t.get('rerun_of', None), t.get('parent', None)))
+    tasks = [t for t in tasks if t['_id'] not in busy]
+
+    groups = {}
+    for t in tasks:
+        groups.setdefault((t.get('organization', None), t.get('team', None), get_archive_month(t['_id'])), []).append(t)
+
+    for (organization_id, team_id, month), group in groups.items():
+        start = time.monotonic()
+        await _archive_group(organization_id, team_id, month, group)
+        if duty_cycle < 1:
+            await asyncio.sleep((time.monotonic() - start) * (1 / duty_cycle - 1))
+    if tasks:
+        logger.info('Archived {} tasks'.format(len(tasks)))
+    return len(tasks)
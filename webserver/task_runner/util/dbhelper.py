@@ -20,7 +20,7 @@ from wheel import wheelfile
 from wheel import pkginfo
 from distutils import dir_util
 
-import mistune
+from pymongo import UpdateOne
 from sanic.log import logger
 
 from app.main.model.database import Test, User
@@ -30,6 +30,8 @@ from app.main.util.zipfile import ZipFile, is_zipfile
 from app.main.util.get_path import get_back_scripts_root, get_user_scripts_root
 from app.main.model.database import Package
 from app.main.util.semver import parse_constraint, parse_single_constraint
+from task_runner.util.indexer import index_scripts, parse_md, refresh_manifest_entry
+from task_runner.util.installer import install_package_files
 
 METADATA = 'METADATA'
 WHEEL_INFO = 'WHEEL'
@@ -42,16 +44,6 @@ WHEEL_INFO_RE = re.compile(
 VERSION_CHECK = re.compile(r'(?P<name>.*?)(?P<constraint>\s*(\^|~|==|>=?|><|<=?|!=)\s*.*)$').match
 MODULE_IMPORT = re.compile(r'^\s*(import|from)\s+(?P<module>.+?)(#|$|\s+import\s+.+$)').match
 
-def filter_kw(item):
-    item = item.strip()
-    if item.startswith('${') or item.startswith('@{') or item.startswith('&{'):
-        item = item[2:]
-        if not item.endswith('}'):
-            logger.error('{ } mismatch for ' + item)
-        else:
-            item = item[0:-1]
-    return item
-
 @async_wraps
 def get_package_info(package):
     package = str(package)
@@ -155,41 +147,69 @@ async def install_test_suite(package, user, organization, team, pypi_root, propr
 
     scripts_root = await get_user_scripts_root(organization=organization, team=team)
     libraries_root = await get_back_scripts_root(organization=organization, team=team)
-    async with ZipFile(pkg_file_path) as zf:
-        for f in zf.namelist():
-            if f.startswith('EGG-INFO'):
-                continue
-            dirname = os.path.dirname(f)
-            if await async_exists(scripts_root / dirname):
-                await async_rmtree(scripts_root / dirname)
-            if await async_exists(libraries_root / dirname):
-                await async_rmtree(libraries_root / dirname)
-
-    async with ZipFile(pkg_file_path) as zf:
-        libraries = (f for f in zf.namelist() if not f.startswith('EGG-INFO') and '/scripts/' not in f)
-        for l in libraries:
-            await zf.extract(l, libraries_root)
-        scripts = [f for f in zf.namelist() if '/scripts/' in f]
-        for s in scripts:
-            await zf.extract(s, scripts_root)
-        new_tests = []
-        all_tests = []
-        for pkg_name in set((s.split('/', 1)[0] for s in scripts)):
-            for f in await async_listdir(scripts_root / pkg_name / 'scripts'):
-                await async_move(str(scripts_root / pkg_name / 'scripts' / f), scripts_root / pkg_name)
-                test = await db_update_test(scripts_root, os.path.join(pkg_name, f), user, organization, team, package, version)
-                if test:
-                    new_tests.append(test)
-            await async_rmtree(scripts_root / pkg_name / 'scripts')
-            async for test in Test.find({'path': pkg_name, 'organization': organization.pk, 'team': team.pk if team else None}):
-                all_tests.append(test)
-        tests = set(all_tests) - set(new_tests)
-        for test in tests:
+    namelist = await async_wraps(install_package_files)(pkg_file_path, scripts_root, libraries_root)
+    scripts = [f for f in namelist if '/scripts/' in f]
+
+    pkg_names = set((s.split('/', 1)[0] for s in scripts))
+    md_scripts = []
+    for s in scripts:
+        pkg_name, _, f = s.split('/', 2)
+        if f.endswith('.md') and '/' not in f:
+            md_scripts.append(os.path.join(pkg_name, f))
+    new_tests = await db_update_tests(scripts_root, md_scripts, user, organization, team, package, version)
+    async for test in Test.find({'path': {'$in': list(pkg_names)}, 'organization': organization.pk, 'team': team.pk if team else None}):
+        if (test.path, test.test_suite) not in new_tests:
             logger.critical(f'Remove the staled test suite: {test.test_suite}')
             await test.delete()
     await package.collection.find_one_and_update({'_id': package.pk}, {'$inc': {'download_times': 1}})
     return True
 
+async def db_update_tests(scripts_dir, scripts, user, organization, team, package=None, version=None):
+    """
+    Bulk version of db_update_test, only the scripts changed since last indexing are parsed,
+    while the package and version are set for all the scripts. All test documents are created or updated with one bulk write.
+    Return the set of (path, test_suite) of the scripts.
+    """
+    query = {'organization': organization.pk, 'team': team.pk if team else None}
+    keys = {}
+    for script in scripts:
+        keys[script] = (os.path.dirname(script), os.path.splitext(os.path.basename(script))[0])
+    existing = set()
+    async for test in Test.collection.find({**query, 'path': {'$in': list(set(k[0] for k in keys.values()))}}, {'path': 1, 'test_suite': 1}):
+        existing.add((test['path'], test['test_suite']))
+    missing = [script for script, key in keys.items() if key not in existing]
+    parsed = await index_scripts(scripts_dir, scripts, force=missing)
+
+    now = datetime.datetime.utcnow()
+    requests = []
+    for script, (test_cases, variables) in parsed.items():
+        dirname, test_suite = keys[script]
+        update = {
+            '$set': {'test_cases': test_cases, 'variables': variables, 'update_date': now},
+            '$setOnInsert': {'schema_version': '1', 'author': user.pk, 'create_date': now, 'staled': False},
+        }
+        if package and version:
+            update['$set']['package'] = package.pk
+            update['$set']['package_version'] = version
+        requests.append(UpdateOne({**query, 'path': dirname, 'test_suite': test_suite}, update, upsert=True))
+        logger.critical(f'Update test suite for {script}')
+    if package and version:
+        # the unchanged scripts are not parsed again, but they belong to the newly installed version as well
+        for script in scripts:
+            if script not in parsed:
+                dirname, test_suite = keys[script]
+                requests.append(UpdateOne({**query, 'path': dirname, 'test_suite': test_suite},
+                                          {'$set': {'package': package.pk, 'package_version': version}}))
+    if requests:
+        await Test.collection.bulk_write(requests, ordered=False)
+
+    if not package and parsed:
+        packages = await Test.collection.distinct('package', {**query, '$or': [{'path': keys[s][0], 'test_suite': keys[s][1]} for s in parsed]})
+        packages = [p for p in packages if p]
+        if packages:
+            await Package.collection.update_many({'_id': {'$in': packages}}, {'$set': {'modified': True}})
+    return set(keys.values())
+
 async def db_update_test(scripts_dir, script, user, organization, team, package=None, version=None):
     if scripts_dir is None:
         return None
@@ -223,6 +243,8 @@ async def db_update_test(scripts_dir, script, user, organization, team, package=
     if ret:
         await test.commit()
         logger.critical(f'Update test suite for {script}')
+    # the bulk indexing of the package installs compares the scripts against the manifest
+    await async_wraps(refresh_manifest_entry)(scripts_dir, script)
     return test
 
 @async_wraps
@@ -231,53 +253,7 @@ def update_test_from_md(md_file, test):
     update test cases and variables for the test
     """
     ret = False
-    test_cases = []
-    variables = {}
-    with open(md_file, encoding='utf-8') as f:
-        parser = mistune.BlockLexer()
-        text = f.read()
-        parser.parse(mistune.preprocessing(text))
-        for t in parser.tokens:
-            if t["type"] == "table":
-                table_header = t["header"][0].lower()
-                if table_header == 'test case' or table_header == 'test cases':
-                    for c in t["cells"]:
-                        if not c[0] == '---':
-                            test_cases.append(c[0])
-                            break
-                if table_header == 'variable' or table_header == 'variables':
-                    list_var = None
-                    for c in t["cells"]:
-                        if c[0].startswith('#') or c[0].startswith('---'):
-                            continue
-                        if c[0].startswith('${'):
-                            list_var = None
-                            dict_var = None
-                            variables[filter_kw(c[0])] = c[1] if len(c) > 1 else ''
-                        elif c[0].startswith('@'):
-                            dict_var = None
-                            list_var = filter_kw(c[0])
-                            variables[list_var] = c[1:]
-                        elif c[0].startswith('...'):
-                            if list_var:
-                                variables[list_var].extend(c[1:])
-                            elif dict_var:
-                                for i in c[1:]:
-                                    if not i:
-                                        continue
-                                    k, v = i.split('=')
-                                    variables[dict_var][k] = v
-                        elif c[0].startswith('&'):
-                            list_var = None
-                            dict_var = filter_kw(c[0])
-                            variables[dict_var] = {}
-                            for i in c[1:]:
-                                if not i:
-                                    continue
-                                k, v = i.split('=')
-                                variables[dict_var][k] = v
-                        else:
-                            logger.error('Unknown tag: ' + c[0])
+    test_cases, variables = parse_md(md_file)
     if test.test_cases != test_cases:
         test.test_cases = test_cases
         ret = True
@@ -0,0 +1,50 @@
+import asyncio
+from collections import deque
+
+from sanic.log import logger
+
+class KeyedDispatcher:
+    '''
+    Run the jobs concurrently by a bounded number of workers, the jobs of the same key run one by one in the order submitted.
+
+    Submitting blocks once max_pending jobs are waiting so that the producer is throttled rather than the memory.
+    '''
+    def __init__(self, workers, max_pending=None):
+        self.running = asyncio.Semaphore(workers)
+        self.pending = asyncio.Semaphore(max_pending or workers * 16)
+        self.queues = {}    # {key: deque of the jobs}
+        self.drainers = set()
+
+    async def submit(self, key, job):
+        '''
+        Submit a job, a coroutine function without arguments, to run after the jobs of the same key
+        '''
+        await self.pending.acquire()
+        if key in self.queues:
+            self.queues[key].append(job)
+            return
+        self.queues[key] = deque([job])
+        drainer = asyncio.ensure_future(self._drain(key))
+        self.drainers.add(drainer)
+        drainer.add_done_callback(self.drainers.discard)
+
+    async def _drain(self, key):
+        queue = self.queues[key]
+        while queue:
+            job = queue[0]
+            try:
+                async with self.running:
+                    await job()
+            except Exception as e:
+                logger.exception(e)
+            finally:
+                queue.popleft()
+                self.pending.release()
+        del self.queues[key]
+
+    async def join(self):
+        '''
+        Wait for all of the jobs submitted to finish
+        '''
+        while self.drainers:
+            await asyncio.gather(*self.drainers)
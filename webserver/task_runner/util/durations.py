@@ -0,0 +1,221 @@
+import datetime
+import statistics
+
+from pymongo import UpdateOne
+
+from app.main.model.database import QUEUE_PRIORITY, DurationStat, Task, TaskQueue
+
+EWMA_ALPHA = 0.3
+SAMPLES_MAX = 50
+POLICY_FIFO = 'fifo'
+POLICY_SEJ = 'sej'
+
+def percentile(samples, q):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    k = (len(samples) - 1) * q / 100
+    f = int(k)
+    c = min(f + 1, len(samples) - 1)
+    return samples[f] + (samples[c] - samples[f]) * (k - f)
+
+def duration_summary(stat):
+    return {
+        'count': stat['count'],
+        'ewma': stat['ewma'],
+        'p50': percentile(stat['samples'], 50),
+        'p90': percentile(stat['samples'], 90),
+    }
+
+def _fold(duration, now):
+    """
+    An update pipeline to fold a duration into the EWMA and the recent samples atomically
+    """
+    return [{'$set': {
+        'schema_version': '1',
+        'ewma': {'$cond': [{'$gt': [{'$ifNull': ['$count', 0]}, 0]},
+                           {'$add': [{'$multiply': ['$ewma', 1 - EWMA_ALPHA]}, duration * EWMA_ALPHA]},
+                           duration]},
+        'samples': {'$slice': [{'$concatArrays': [{'$ifNull': ['$samples', []]}, [duration]]}, -SAMPLES_MAX]},
+        'count': {'$add': [{'$ifNull': ['$count', 0]}, 1]},
+        'update_date': now,
+    }}]
+
+def duration_samples(task, records):
+    """
+    The (test case, duration) samples of a finished task, the test cases are keyed by their full names
+    as the same name may be used in different nested suites. The duration of the whole test suite is
+    only sampled when the task ran all the test cases.
+    """
+    samples = []
+    if not task.testcases:
+        suites = [r for r in records if r['kind'] == 'suite' and r['duration'] is not None]
+        if suites:
+            # the top level suite ends last
+            samples.append(('', suites[-1]['duration']))
+    samples.extend((r['longname'], r['duration']) for r in records if r['kind'] == 'test' and r['duration'] is not None)
+    return samples
+
+def case_duration(durations, case):
+    """
+    The expected duration of the test case name in a dict of {test case: duration} of a test suite, that is the sum
+    of the tests of the name in all nested suites as robot runs all of them. The statistics recorded by the name
+    alone are honored if no full names are matched. None if it can't be told.
+    """
+    matched = [d for name, d in durations.items() if name.endswith('.' + case)]
+    if matched:
+        return sum(matched)
+    return durations.get(case)
+
+async def update_duration_stats(task, records):
+    """
+    Fold the durations of a finished task into the statistics of its test suite and test cases,
+    on the endpoint it ran on as well as across all endpoints
+    """
+    samples = duration_samples(task, records)
+    if not samples:
+        return
+
+    now = datetime.datetime.utcnow()
+    scope = {'organization': task.organization.pk, 'team': task.team.pk if task.team else None, 'test_suite': task.test_suite}
+    endpoints = {task.endpoint_run.pk if task.endpoint_run else None, None}
+    await DurationStat.collection.bulk_write([UpdateOne({**scope, 'test_case': case, 'endpoint': endpoint}, _fold(duration, now), upsert=True)
+                                              for endpoint in endpoints for case, duration in samples], ordered=False)
+
+async def get_expected_durations(tasks, endpoint, organization, team):
+    """
+    Expected run time in milliseconds of each task on the endpoint, None if it can't be told.
+    The statistics of the endpoint take precedence over those across all endpoints.
+    For a task running part of the test cases, it's the sum of the test cases if all of them are known.
+    """
+    ewma = {}   # {test suite: {test case: ewma}}
+    query = {
+        'organization': organization.pk,
+        'team': team.pk if team else None,
+        'test_suite': {'$in': list({t.test_suite for t in tasks})},
+        'endpoint': {'$in': [endpoint.pk, None]}
+    }
+    async for s in DurationStat.collection.find(query, {'samples': 0}):
+        cases = ewma.setdefault(s['test_suite'], {})
+        if s['endpoint'] or s['test_case'] not in cases:
+            cases[s['test_case']] = s['ewma']
+
+    ret = {}
+    for task in tasks:
+        expected = None
+        cases = ewma.get(task.test_suite, {})
+        if task.testcases:
+            durations = [case_duration(cases, c) for c in task.testcases]
+            if all(d is not None for d in durations):
+                expected = sum(durations)
+        if expected is None:
+            expected = cases.get('')
+        ret[task.pk] = expected
+    return ret
+
+def order_tasks(tasks, expected, policy, max_wait, now=None):
+    """
+    Order the waiting tasks of a queue in the way they are going to run.
+    With the policy of shortest expected job first, tasks that have waited longer than max_wait seconds
+    go first in FIFO order to avoid starvation, tasks never run before are taken as of the median duration.
+    """
+    if policy != POLICY_SEJ:
+        return list(tasks)
+    now = now or datetime.datetime.utcnow()
+    overdue = [t for t in tasks if t.schedule_date and (now - t.schedule_date).total_seconds() > max_wait]
+    rest = [t for t in tasks if t not in overdue]
+    known = [expected[t.pk] for t in rest if expected.get(t.pk) is not None]
+    if not known:
+        return overdue + rest
+    median = statistics.median(known)
+    return overdue + sorted(rest, key=lambda t: expected[t.pk] if expected.get(t.pk) is not None else median)
+
+def task_selector(endpoint, organization, team, policy, max_wait):
+    """
+    The selector for TaskQueue.pop() to take the next task according to the policy
+    """
+    async def select(task_refs):
+        if policy != POLICY_SEJ or len(task_refs) < 2:
+            return 0
+        tasks = {t.pk: t for t in await Task.find({'_id': {'$in': [r.pk for r in task_refs]}}).to_list(len(task_refs))}
+        tasks = [tasks[r.pk] for r in task_refs if r.pk in tasks]
+        if not tasks:
+            return 0
+        expected = await get_expected_durations(tasks, endpoint, organization, team)
+        first = order_tasks(tasks, expected, policy, max_wait)[0]
+        return next(i for i, r in enumerate(task_refs) if r.pk == first.pk)
+    return select
+
+async def _load_queues(endpoint, organization, team):
+    """
+    Return the task queues of the endpoint in the order of priority, the running tasks and the waiting tasks of each queue
+    """
+    taskqueues = await TaskQueue.find({'endpoint': endpoint.pk, 'organization': organization.pk, 'team': team.pk if team else None}).to_list(len(QUEUE_PRIORITY))
+    taskqueues.sort(key=lambda q: QUEUE_PRIORITY.index(q.priority) if q.priority in QUEUE_PRIORITY else len(QUEUE_PRIORITY))
+    running = [await q.running_task.fetch() for q in taskqueues if q.running_task]
+    running = [t for t in running if t]
+    waiting = {}
+    for q in taskqueues:
+        tasks = {t.pk: t for t in await Task.find({'_id': {'$in': [r.pk for r in q.tasks]}}).to_list(len(q.tasks))} if q.tasks else {}
+        waiting[q.pk] = [tasks[r.pk] for r in q.tasks if r.pk in tasks]
+    return taskqueues, running, waiting
+
+def _remaining(task, expected, now):
+    if expected is None:
+        return None
+    elapsed = (now - task.run_date).total_seconds() if task.run_date else 0
+    return max(expected / 1000 - elapsed, 0)
+
+async def estimate_queue(endpoint, organization, team, policy, max_wait):
+    """
+    Estimate the start time of the tasks queuing on the endpoint, return {task id: (expected duration, ETA)} in seconds,
+    either of them is None if it can't be told, the ETA of the running task is its remaining time
+    """
+    taskqueues, running, waiting = await _load_queues(endpoint, organization, team)
+    expected = await get_expected_durations(running + [t for tasks in waiting.values() for t in tasks], endpoint, organization, team)
+
+    now = datetime.datetime.utcnow()
+    ret = {}
+    eta = 0
+    for task in running:
+        remaining = _remaining(task, expected[task.pk], now)
+        ret[str(task.pk)] = (expected[task.pk] / 1000 if expected[task.pk] is not None else None, remaining)
+        eta = eta + remaining if eta is not None and remaining is not None else None
+    for q in taskqueues:
+        for task in order_tasks(waiting[q.pk], expected, policy, max_wait, now):
+            duration = expected[task.pk] / 1000 if expected[task.pk] is not None else None
+            ret[str(task.pk)] = (duration, eta)
+            eta = eta + duration if eta is not None and duration is not None else None
+    return ret
+
+async def estimate_drain_times(endpoints, organization, team, task):
+    """
+    Expected time in seconds for each endpoint to finish the task, that is the remaining time of the running task,
+    the waiting tasks going before the task by priority and the task itself.
+    Durations that can't be told are taken as the mean of the known ones, return {endpoint pk: seconds}.
+    """
+    now = datetime.datetime.utcnow()
+    loads = {}
+    known = []
+    for endpoint in endpoints:
+        taskqueues, running, waiting = await _load_queues(endpoint, organization, team)
+        ahead = [t for q in taskqueues if q.priority >= task.priority for t in waiting[q.pk]]
+        expected = await get_expected_durations(running + ahead + [task], endpoint, organization, team)
+        durations = [_remaining(t, expected[t.pk], now) for t in running]
+        durations.extend(expected[t.pk] / 1000 if expected[t.pk] is not None else None for t in ahead)
+        durations.append(expected[task.pk] / 1000 if expected[task.pk] is not None else None)
+        known.extend(d for d in durations if d is not None)
+        loads[endpoint.pk] = durations
+
+    # nothing is known yet, fall back to the queue depth
+    fallback = statistics.mean(known) if known else 1
+    return {k: sum(d if d is not None else fallback for d in v) for k, v in loads.items()}
+
+async def select_endpoint(endpoints, organization, team, task):
+    """
+    Pick the endpoint that is expected to finish the task first, online endpoints take precedence
+    """
+    online = [e for e in endpoints if e.status == 'Online' and e.enable]
+    candidates = online or endpoints
+    drain_times = await estimate_drain_times(candidates, organization, team, task)
+    return min(candidates, key=lambda e: drain_times[e.pk])
@@ -0,0 +1,102 @@
+import asyncio
+import datetime
+from collections import deque
+
+from app.main.model.database import FairShareUsage, Organization
+
+GATES = {}      # {endpoint uid: FairShareGate}
+
+class FairShareGate:
+    '''
+    Weighted fair sharing of a test endpoint among the organizations and teams that have registered it.
+
+    Whenever the endpoint is free, it's granted to the waiting team of the least usage in proportion to
+    the weight of its organization. The usage decays exponentially by the half life so that only the recent
+    history counts, it's persisted so that fairness holds across runner restarts.
+    '''
+    def __init__(self, endpoint_uid, half_life):
+        self.endpoint_uid = endpoint_uid
+        self.half_life = half_life
+        self.holder = None
+        self.waiters = {}   # {(organization id, team id): deque of (future, weight)}
+        self.usage = {}     # {(organization id, team id): (usage, update date)}
+
+    def _decayed(self, key, now):
+        usage, update_date = self.usage.get(key, (0, None))
+        if not usage or not update_date:
+            return 0
+        return usage * 0.5 ** ((now - update_date).total_seconds() / self.half_life)
+
+    async def _load_usage(self, keys):
+        keys = [k for k in keys if k not in self.usage]
+        if not keys:
+            return
+        query = {'endpoint_uid': self.endpoint_uid, '$or': [{'organization': o, 'team': t} for o, t in keys]}
+        async for u in FairShareUsage.collection.find(query, {'organization': 1, 'team': 1, 'usage': 1, 'update_date': 1}):
+            self.usage[(u['organization'], u.get('team'))] = (u.get('usage', 0), u.get('update_date'))
+        for k in keys:
+            self.usage.setdefault(k, (0, None))
+
+    def _grant_next(self):
+        keys = [k for k, q in self.waiters.items() if q]
+        if not keys:
+            self.holder = None
+            return
+        now = datetime.datetime.utcnow()
+        key = min(keys, key=lambda k: self._decayed(k, now) / self.waiters[k][0][1])
+        fut, _ = self.waiters[key].popleft()
+        self.holder = key
+        fut.set_result(None)
+
+    async def acquire(self, organization, team, weight=1):
+        key = (organization.pk, team.pk if team else None)
+        await self._load_usage([key])
+        if self.holder is None and not any(self.waiters.values()):
+            self.holder = key
+            return
+        fut = asyncio.get_event_loop().create_future()
+        self.waiters.setdefault(key, deque()).append((fut, weight or 1))
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # granted right before being cancelled, pass it on
+                self._grant_next()
+            else:
+                self.waiters[key] = deque(w for w in self.waiters[key] if w[0] is not fut)
+            raise
+
+    async def release(self, organization, team, duration, wait=None):
+        '''
+        Account the run time of the task in seconds and the time it waited in the queue, then grant the endpoint to the next team
+        '''
+        key = (organization.pk, team.pk if team else None)
+        now = datetime.datetime.utcnow()
+        if not duration and wait is None:
+            # nothing ran, eg. the task was cancelled while waiting for the endpoint
+            self._grant_next()
+            return
+        self.usage[key] = (self._decayed(key, now) + duration, now)
+        self._grant_next()
+
+        update = {
+            '$set': {'usage': self.usage[key][0], 'update_date': now, 'schema_version': '1'},
+            '$inc': {'tasks': 1}
+        }
+        if wait is not None:
+            update['$inc']['wait_total'] = wait
+            update['$inc']['waits'] = 1
+            update['$max'] = {'wait_max': wait}
+        await FairShareUsage.collection.update_one({'endpoint_uid': self.endpoint_uid, 'organization': key[0], 'team': key[1]}, update, upsert=True)
+
+async def get_share_weight(organization):
+    '''
+    The current weight of the organization, it's read on every acquisition as it can be changed any time
+    '''
+    doc = await Organization.collection.find_one({'_id': organization.pk}, {'share_weight': 1})
+    return doc.get('share_weight', 1) if doc else organization.share_weight
+
+def get_gate(endpoint_uid, half_life):
+    if endpoint_uid not in GATES:
+        GATES[endpoint_uid] = FairShareGate(endpoint_uid, half_life)
+    return GATES[endpoint_uid]
@@ -0,0 +1,178 @@
+import asyncio
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import mistune
+from sanic.log import logger
+
+MANIFEST_SUFFIX = '.manifest.json'
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# parsing markdown is CPU bound, keep it out of the event loop and away from the GIL
+_process_pool = None
+
+def get_process_pool():
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor()
+    return _process_pool
+
+def filter_kw(item):
+    item = item.strip()
+    if item.startswith('${') or item.startswith('@{') or item.startswith('&{'):
+        item = item[2:]
+        if not item.endswith('}'):
+            logger.error('{ } mismatch for ' + item)
+        else:
+            item = item[0:-1]
+    return item
+
+def parse_md(md_file):
+    """
+    extract test cases and variables from a markdown test suite
+
+    It's a module level function without any database dependency so that it can be pickled
+    to run in a worker process.
+    """
+    test_cases = []
+    variables = {}
+    with open(md_file, encoding='utf-8') as f:
+        parser = mistune.BlockLexer()
+        text = f.read()
+        parser.parse(mistune.preprocessing(text))
+        for t in parser.tokens:
+            if t["type"] == "table":
+                table_header = t["header"][0].lower()
+                if table_header == 'test case' or table_header == 'test cases':
+                    for c in t["cells"]:
+                        if not c[0] == '---':
+                            test_cases.append(c[0])
+                            break
+                if table_header == 'variable' or table_header == 'variables':
+                    list_var = None
+                    for c in t["cells"]:
+                        if c[0].startswith('#') or c[0].startswith('---'):
+                            continue
+                        if c[0].startswith('${'):
+                            list_var = None
+                            dict_var = None
+                            variables[filter_kw(c[0])] = c[1] if len(c) > 1 else ''
+                        elif c[0].startswith('@'):
+                            dict_var = None
+                            list_var = filter_kw(c[0])
+                            variables[list_var] = c[1:]
+                        elif c[0].startswith('...'):
+                            if list_var:
+                                variables[list_var].extend(c[1:])
+                            elif dict_var:
+                                for i in c[1:]:
+                                    if not i:
+                                        continue
+                                    k, v = i.split('=')
+                                    variables[dict_var][k] = v
+                        elif c[0].startswith('&'):
+                            list_var = None
+                            dict_var = filter_kw(c[0])
+                            variables[dict_var] = {}
+                            for i in c[1:]:
+                                if not i:
+                                    continue
+                                k, v = i.split('=')
+                                variables[dict_var][k] = v
+                        else:
+                            logger.error('Unknown tag: ' + c[0])
+    return test_cases, variables
+
+def file_digest(filename):
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+def get_manifest_path(scripts_root):
+    """
+    The manifest sits next to the scripts root rather than in it to keep it out of the script listing
+    """
+    scripts_root = Path(scripts_root)
+    return scripts_root.parent / (scripts_root.name + MANIFEST_SUFFIX)
+
+def load_manifest(scripts_root):
+    try:
+        with open(get_manifest_path(scripts_root)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def save_manifest(scripts_root, manifest):
+    manifest_path = get_manifest_path(scripts_root)
+    manifest_tmp = manifest_path.with_suffix('.tmp')
+    with open(manifest_tmp, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_tmp, manifest_path)
+
+def scan_scripts(scripts_root, scripts, manifest, force=()):
+    """
+    Compare the scripts against the manifest entries of (mtime, size, sha256), return the changed scripts.
+    The manifest is updated in place.
+    The sha256 is only calculated when mtime or size changes, so that a script extracted again with the
+    same content is not treated as changed.
+    """
+    changed = []
+    for script in scripts:
+        filename = os.path.join(scripts_root, script)
+        try:
+            st = os.stat(filename)
+        except FileNotFoundError:
+            manifest.pop(script, None)
+            continue
+        entry = manifest.get(script)
+        if entry and entry['mtime'] == st.st_mtime and entry['size'] == st.st_size and script not in force:
+            continue
+        digest = file_digest(filename)
+        if not entry or entry['sha256'] != digest or script in force:
+            changed.append(script)
+        manifest[script] = {'mtime': st.st_mtime, 'size': st.st_size, 'sha256': digest}
+    return changed
+
+def refresh_manifest_entry(scripts_root, script):
+    """
+    Record the current content of a script indexed on its own, eg. edited in place, so that installing
+    the packaged content again is not mistaken for unchanged
+    """
+    manifest = load_manifest(scripts_root)
+    try:
+        st = os.stat(os.path.join(scripts_root, script))
+    except FileNotFoundError:
+        if manifest.pop(script, None) is None:
+            return
+    else:
+        manifest[script] = {'mtime': st.st_mtime, 'size': st.st_size, 'sha256': file_digest(os.path.join(scripts_root, script))}
+    save_manifest(scripts_root, manifest)
+
+async def index_scripts(scripts_root, scripts, force=()):
+    """
+    Parse the scripts that have changed since last indexing in the process pool.
+    Scripts in the force list are parsed regardless of the manifest, eg. their test documents are missing.
+    Return a dict of {script: (test_cases, variables)} for the changed scripts only.
+    """
+    loop = asyncio.get_event_loop()
+    manifest = await loop.run_in_executor(None, load_manifest, scripts_root)
+    changed = await loop.run_in_executor(None, scan_scripts, scripts_root, scripts, manifest, set(force))
+
+    pool = get_process_pool()
+    results = await asyncio.gather(*[loop.run_in_executor(pool, parse_md, os.path.join(scripts_root, s)) for s in changed], return_exceptions=True)
+
+    ret = {}
+    for script, result in zip(changed, results):
+        if isinstance(result, Exception):
+            logger.error(f'Failed to parse the test suite {script}: {result}')
+            del manifest[script]
+            continue
+        ret[script] = result
+    await loop.run_in_executor(None, save_manifest, scripts_root, manifest)
+    logger.info(f'Indexed {len(ret)} changed test suites out of {len(scripts)}')
+    return ret
@@ -0,0 +1,128 @@
+import asyncio
+import os
+import tempfile
+import xml.etree.ElementTree as ET
+
+from async_files.utils import async_wraps
+from sanic.log import logger
+
+from app.main.model.database import DurationStat, RobotResult, Task
+from app.main.util import async_exists
+from app.main.util.get_path import get_test_result_path
+from task_runner.util.durations import update_duration_stats
+from task_runner.util.indexer import get_process_pool
+from task_runner.util.outputxml import load_spooled_batch, spool_output
+
+INSERT_BATCH_SIZE = 1000
+KEYWORD_DEPTH = 1
+FINISHED_STATUS = ('successful', 'failed', 'cancelled')
+
+async def _ingest(task, result_dir=None):
+    """
+    Stream the records of the output.xml of a finished task into the robot result store in batches,
+    replacing the task's old records. The output.xml is parsed in the process pool, which spools
+    the records to a temporary file in batches, then the batches are loaded and inserted one by one,
+    so that only a batch of records is held in memory besides the suite and test records which
+    the run time statistics need.
+    Return (the number of records ingested, the suite and test records, whether the task was ingested before).
+    """
+    if result_dir is None:
+        result_dir = await get_test_result_path(task)
+    output_xml = result_dir / 'output.xml'
+    if not await async_exists(output_xml):
+        return 0, [], False
+
+    common = {
+        'schema_version': '1',
+        'task': task.pk,
+        'test_suite': task.test_suite,
+        'endpoint': task.endpoint_run.pk if task.endpoint_run else None,
+        'organization': task.organization.pk,
+        'team': task.team.pk if task.team else None,
+    }
+    fd, spool_file = tempfile.mkstemp(prefix='output-', suffix='.spool')
+    os.close(fd)
+    try:
+        loop = asyncio.get_event_loop()
+        try:
+            count, summary = await loop.run_in_executor(get_process_pool(), spool_output, str(output_xml), spool_file,
+                                                        KEYWORD_DEPTH, INSERT_BATCH_SIZE)
+        except ET.ParseError as e:
+            logger.error(f'Failed to parse {output_xml}: {e}')
+            return 0, [], False
+
+        ret = await RobotResult.collection.delete_many({'task': task.pk})
+        with open(spool_file, 'rb') as f:
+            while True:
+                batch = await async_wraps(load_spooled_batch)(f)
+                if batch is None:
+                    break
+                await RobotResult.collection.insert_many([{**r, **common} for r in batch], ordered=False)
+    finally:
+        os.remove(spool_file)
+    return count, summary, ret.deleted_count > 0
+
+async def _update_stats(task, summary, ingested_before):
+    # a task ingested again must not be counted twice, cancelled runs don't tell the run time
+    if summary and not ingested_before and task.status in ('successful', 'failed'):
+        await update_duration_stats(task, summary)
+
+async def ingest_output(task, result_dir=None):
+    """
+    Ingest the output.xml of a finished task into the robot result store,
+    the run time statistics are updated on the first ingestion.
+    Return the number of records ingested.
+    """
+    count, summary, ingested_before = await _ingest(task, result_dir)
+    await _update_stats(task, summary, ingested_before)
+    return count
+
+async def backfill(concurrency=None, force=False):
+    """
+    Ingest the result directories of the finished tasks, those already ingested are skipped unless forced.
+    The tasks are ingested concurrently, but their durations are folded into the statistics in the order
+    of their run dates since the EWMA weighs the later samples more.
+    """
+    concurrency = concurrency or os.cpu_count() or 1
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+    await RobotResult.ensure_indexes()
+    await DurationStat.ensure_indexes()
+
+    async def worker():
+        tasks = records = 0
+        while True:
+            item = await queue.get()
+            if item is None:
+                return tasks, records
+            task, turn, done = item
+            try:
+                if not force and await RobotResult.collection.find_one({'task': task.pk}, {'_id': 1}):
+                    continue
+                try:
+                    cnt, summary, ingested_before = await _ingest(task)
+                    await turn.wait()
+                    await _update_stats(task, summary, ingested_before)
+                except Exception as e:
+                    logger.error(f'Failed to ingest the results of task {task.pk}: {e}')
+                    continue
+                if cnt:
+                    tasks += 1
+                    records += cnt
+            finally:
+                # the next task must not take its turn before the earlier ones even if this one is skipped
+                await turn.wait()
+                done.set()
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    turn = asyncio.Event()
+    turn.set()
+    async for task in Task.find({'status': {'$in': FINISHED_STATUS}}, sort=[('run_date', 1), ('_id', 1)]):
+        done = asyncio.Event()
+        await queue.put((task, turn, done))
+        turn = done
+    for _ in workers:
+        await queue.put(None)
+    results = await asyncio.gather(*workers)
+    tasks, records = sum(r[0] for r in results), sum(r[1] for r in results)
+    logger.info(f'Ingested {records} records from {tasks} tasks')
+    return tasks, records
@@ -0,0 +1,180 @@
+import ctypes
+import errno
+import os
+import shutil
+import sys
+import uuid
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from sanic.log import logger
+
+CRC_BLOCK_SIZE = 1024 * 1024
+STAGING_PREFIX = '.staging-'
+RETIRED_PREFIX = '.retired-'
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+
+def _load_renameat2():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        renameat2 = ctypes.CDLL(None, use_errno=True).renameat2
+    except (OSError, AttributeError):
+        return None
+    renameat2.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+    renameat2.restype = ctypes.c_int
+    return renameat2
+
+_renameat2 = _load_renameat2()
+
+def file_crc32(filename):
+    crc = 0
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(CRC_BLOCK_SIZE), b''):
+            crc = zlib.crc32(block, crc)
+    return crc
+
+def is_member_unchanged(info, filename):
+    try:
+        if os.path.getsize(filename) != info.file_size:
+            return False
+    except OSError:
+        return False
+    return file_crc32(filename) == info.CRC
+
+def map_members(namelist, scripts_root, libraries_root):
+    """
+    Map the egg members to the install destinations.
+    Members in the scripts directory of a package go to scripts_root/<package> with the scripts level stripped,
+    others go to libraries_root, the members at the egg root are keyed by a package of None.
+    Return a dict of {(root, package): [(member, relative path in the package)]}
+    """
+    targets = {}
+    for name in namelist:
+        if name.startswith('EGG-INFO'):
+            continue
+        parts = name.split('/')
+        if '..' in parts or os.path.isabs(name):
+            continue
+        if len(parts) < 2:
+            targets.setdefault((libraries_root, None), []).append((name, name))
+            continue
+        pkg_name = parts[0]
+        if '/scripts/' in name:
+            idx = parts.index('scripts')
+            if idx != 1:
+                continue
+            root, rel = scripts_root, '/'.join(parts[2:])
+        else:
+            root, rel = libraries_root, '/'.join(parts[1:])
+        if not rel:
+            continue
+        targets.setdefault((root, pkg_name), []).append((name, rel))
+    return targets
+
+def _stage_member(zf, info, current, staging):
+    """
+    Hard link the current file into the staging directory if its CRC and size match the member,
+    otherwise extract the member there. Return True if the member was extracted.
+    """
+    if info.is_dir():
+        os.makedirs(staging, exist_ok=True)
+        return False
+    os.makedirs(os.path.dirname(staging), exist_ok=True)
+    if is_member_unchanged(info, current):
+        try:
+            os.link(current, staging)
+        except OSError:
+            shutil.copy2(current, staging)
+        return False
+    with zf.open(info) as src, open(staging, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    return True
+
+def exchange_paths(a, b):
+    """
+    Exchange two existing paths atomically by renameat2(RENAME_EXCHANGE), return False if it's not supported
+    by the platform or the file system
+    """
+    if _renameat2 is None:
+        return False
+    if _renameat2(AT_FDCWD, os.fsencode(a), AT_FDCWD, os.fsencode(b), RENAME_EXCHANGE) == 0:
+        return True
+    err = ctypes.get_errno()
+    if err in (errno.ENOSYS, errno.EINVAL, errno.ENOTSUP):
+        return False
+    raise OSError(err, os.strerror(err), str(b))
+
+def swap_directory(staging, target):
+    """
+    Replace the target directory with the staging directory, readers see either the old tree or the new tree.
+    Where the directories can't be exchanged atomically the old tree is renamed away first, the target is then
+    missing for the moment between the two renames.
+    """
+    if not target.exists():
+        os.rename(staging, target)
+        return
+    if exchange_paths(staging, target):
+        # the staging path holds the old tree now
+        shutil.rmtree(staging, ignore_errors=True)
+        return
+    retired = target.parent / (RETIRED_PREFIX + target.name + '-' + uuid.uuid4().hex)
+    os.rename(target, retired)
+    os.rename(staging, target)
+    shutil.rmtree(retired, ignore_errors=True)
+
+def install_package_files(package_file, scripts_root, libraries_root, max_workers=None):
+    """
+    Install the egg into the scripts root and libraries root, only the members changed against
+    what is already on disk are extracted, the unchanged files are hard linked.
+    Every package directory is staged aside then swapped in, so that running tasks never see a half installed tree,
+    the modules at the egg root are staged as single files and renamed over the old ones.
+    Return the member name list of the egg.
+    """
+    scripts_root, libraries_root = Path(scripts_root), Path(libraries_root)
+    extracted = 0
+    with zipfile.ZipFile(package_file) as zf:
+        namelist = zf.namelist()
+        targets = map_members(namelist, scripts_root, libraries_root)
+        stagings = {}
+        module_stagings = []
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = []
+                for (root, pkg_name), members in targets.items():
+                    os.makedirs(root, exist_ok=True)
+                    if pkg_name is None:
+                        for name, rel in members:
+                            staging = root / (STAGING_PREFIX + rel + '-' + uuid.uuid4().hex)
+                            module_stagings.append((staging, root / rel))
+                            futures.append(executor.submit(_stage_member, zf, zf.getinfo(name), root / rel, staging))
+                        continue
+                    staging = root / (STAGING_PREFIX + pkg_name + '-' + uuid.uuid4().hex)
+                    os.makedirs(staging)
+                    stagings[(root, pkg_name)] = staging
+                    for name, rel in members:
+                        futures.append(executor.submit(_stage_member, zf, zf.getinfo(name), root / pkg_name / rel, staging / rel))
+                for future in futures:
+                    if future.result():
+                        extracted += 1
+        except Exception:
+            for staging in stagings.values():
+                shutil.rmtree(staging, ignore_errors=True)
+            for staging, _ in module_stagings:
+                if os.path.exists(staging):
+                    os.remove(staging)
+            raise
+
+    for (root, pkg_name), staging in stagings.items():
+        swap_directory(staging, root / pkg_name)
+    for staging, target in module_stagings:
+        if target.exists() and os.path.samefile(staging, target):
+            # an unchanged module is staged as a hard link of itself, which rename leaves in place
+            os.remove(staging)
+        else:
+            os.replace(staging, target)
+    logger.info(f'Installed {package_file}: {extracted} files extracted')
+    return namelist
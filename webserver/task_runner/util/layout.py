@@ -0,0 +1,80 @@
+import asyncio
+import os
+import re
+
+from async_files.utils import async_wraps
+from bson import ObjectId
+from sanic.log import logger
+
+from app.main.model.database import Organization, Task, Team
+from app.main.util.get_path import get_result_shard, get_test_results_root
+
+MIGRATE_BATCH_SIZE = 500
+FINISHED_STATUS = ('successful', 'failed', 'cancelled')
+TASK_ID_MATCH = re.compile(r'^[0-9a-f]{24}$').match
+
+def _list_flat_dirs(results_root):
+    try:
+        with os.scandir(results_root) as it:
+            return [e.name for e in it if TASK_ID_MATCH(e.name) and e.is_dir(follow_symlinks=False)]
+    except FileNotFoundError:
+        return []
+
+def _move_dir(results_root, name):
+    target = results_root / get_result_shard(name) / name
+    target.parent.mkdir(parents=True, exist_ok=True)
+    # renamed within the file system so that a directory is never seen half moved
+    os.rename(results_root / name, target)
+
+async def _results_roots():
+    async for organization in Organization.find():
+        yield await get_test_results_root(organization=organization)
+        async for team in Team.find({'organization': organization.pk}):
+            yield await get_test_results_root(team=team, organization=organization)
+
+async def migrate_result_layout(jobs=None, dry_run=False):
+    """
+    Move the result directories of the flat layout test_results/<task id> to the sharded layout in parallel
+    while the server is running, the directories of the tasks not finished yet, or whose results are still being
+    post-processed, are left for the next run.
+    Return (moved, skipped) directories.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    queue = asyncio.Queue(maxsize=jobs * 2)
+    moved = skipped = 0
+
+    async def worker():
+        nonlocal moved
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            results_root, name = item
+            try:
+                if not dry_run:
+                    await async_wraps(_move_dir)(results_root, name)
+                moved += 1
+            except OSError as e:
+                logger.error(f'Failed to move {results_root / name}: {e}')
+
+    workers = [asyncio.create_task(worker()) for _ in range(jobs)]
+    try:
+        async for results_root in _results_roots():
+            names = await async_wraps(_list_flat_dirs)(results_root)
+            for i in range(0, len(names), MIGRATE_BATCH_SIZE):
+                batch = names[i:i + MIGRATE_BATCH_SIZE]
+                # a task keeps writing to the directory it started with until its results are post-processed
+                active = {str(t['_id']) async for t in Task.collection.find({'_id': {'$in': [ObjectId(n) for n in batch]},
+                                                                              '$or': [{'status': {'$nin': FINISHED_STATUS}}, {'results_ready': False}]},
+                                                                             {'_id': 1})}
+                for name in batch:
+                    if name in active:
+                        skipped += 1
+                        continue
+                    await queue.put((results_root, name))
+    finally:
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    logger.info(f'Moved {moved} result directories to the sharded layout, skipped {skipped} of the tasks in progress')
+    return moved, skipped
@@ -0,0 +1,109 @@
+import datetime
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from app.main.model.database import EndpointLease, Event
+
+class LeaseManager:
+    '''
+    Leases on the endpoints owned by this task runner instance.
+
+    An instance owns the endpoints connected to it and runs their tasks, the leases are renewed periodically
+    while in use. A lease not renewed in time expires, then the endpoint fails over to the instance it reconnects to.
+    '''
+    def __init__(self, owner, url, ttl):
+        self.owner = owner
+        self.url = url
+        self.ttl = ttl
+        self.held = set()
+
+    def holds(self, endpoint_uid):
+        return endpoint_uid in self.held
+
+    async def acquire(self, endpoint_uid):
+        '''
+        Acquire the lease on an endpoint unless it's owned by another live instance,
+        return (acquired, the previous owner if the lease is taken over from another instance)
+        '''
+        now = datetime.datetime.utcnow()
+        query = {'endpoint_uid': endpoint_uid, '$or': [{'owner': self.owner}, {'expire_date': {'$lt': now}}]}
+        update = {
+            '$set': {'owner': self.owner, 'url': self.url, 'expire_date': now + datetime.timedelta(seconds=self.ttl)},
+            '$setOnInsert': {'schema_version': '1', 'events': []}
+        }
+        try:
+            previous = await EndpointLease.collection.find_one_and_update(query, update, upsert=True, return_document=ReturnDocument.BEFORE)
+        except DuplicateKeyError:
+            # the query doesn't match a lease of another live instance, so the upsert conflicts with it
+            return False, None
+        self.held.add(endpoint_uid)
+        if previous and previous.get('owner') == self.owner:
+            return True, None
+        await EndpointLease.collection.update_one({'endpoint_uid': endpoint_uid, 'owner': self.owner}, {'$set': {'acquire_date': now}})
+        return True, previous.get('owner') if previous else None
+
+    async def renew(self, in_use):
+        '''
+        Renew the leases of the endpoints in use and release the others, return the endpoints whose leases are lost
+        '''
+        now = datetime.datetime.utcnow()
+        for endpoint_uid in self.held - set(in_use):
+            await self.release(endpoint_uid)
+        if not self.held:
+            return set()
+        held = list(self.held)
+        await EndpointLease.collection.update_many({'endpoint_uid': {'$in': held}, 'owner': self.owner},
+                                                   {'$set': {'expire_date': now + datetime.timedelta(seconds=self.ttl)}})
+        kept = {l['endpoint_uid'] async for l in EndpointLease.collection.find({'endpoint_uid': {'$in': held}, 'owner': self.owner}, {'endpoint_uid': 1})}
+        lost = set(held) - kept
+        self.held -= lost
+        return lost
+
+    async def release(self, endpoint_uid):
+        # expire rather than delete the lease so that the events forwarded to it are taken over by the next owner
+        self.held.discard(endpoint_uid)
+        await EndpointLease.collection.update_one({'endpoint_uid': endpoint_uid, 'owner': self.owner},
+                                                  {'$set': {'expire_date': datetime.datetime.utcnow()}})
+
+    async def get_owner(self, endpoint_uid):
+        '''
+        The lease of the endpoint owned by another live instance, None if there isn't
+        '''
+        return await EndpointLease.collection.find_one({'endpoint_uid': endpoint_uid, 'owner': {'$ne': self.owner},
+                                                        'expire_date': {'$gte': datetime.datetime.utcnow()}}, {'owner': 1, 'url': 1})
+
+    async def peer_endpoints(self):
+        '''
+        The endpoints owned by the other live instances
+        '''
+        query = {'owner': {'$ne': self.owner}, 'expire_date': {'$gte': datetime.datetime.utcnow()}}
+        return {l['endpoint_uid'] async for l in EndpointLease.collection.find(query, {'endpoint_uid': 1})}
+
+    async def forward(self, endpoint_uid, event_id):
+        '''
+        Forward an event to the live instance owning the endpoint, return False if there isn't one
+        '''
+        ret = await EndpointLease.collection.update_one({'endpoint_uid': endpoint_uid, 'owner': {'$ne': self.owner},
+                                                         'expire_date': {'$gte': datetime.datetime.utcnow()}},
+                                                        {'$push': {'events': event_id}})
+        return ret.modified_count == 1
+
+    async def take_events(self):
+        '''
+        Take the events forwarded to the endpoints owned by this instance.
+
+        The events are claimed before they are removed from the leases, so that those not processed because
+        of a crash are requeued by their claims rather than lost.
+        '''
+        events = []
+        async for l in EndpointLease.collection.find({'owner': self.owner, 'events.0': {'$exists': True}}, {'events': 1}):
+            for event_id in l['events']:
+                # an event left on the lease by a crash after it was claimed isn't taken twice
+                if await Event.collection.find_one_and_update({'_id': event_id, 'status': 'Forwarded'},
+                                                              {'$set': {'status': 'Processing', 'owner': self.owner,
+                                                                        'claim_date': datetime.datetime.utcnow()}},
+                                                              projection={'_id': 1}):
+                    events.append(event_id)
+            await EndpointLease.collection.update_one({'_id': l['_id'], 'owner': self.owner}, {'$pullAll': {'events': l['events']}})
+        return events
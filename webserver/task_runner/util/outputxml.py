@@ -0,0 +1,129 @@
+import datetime
+import pickle
+import xml.etree.ElementTree as ET
+
+ITEM_KINDS = {'suite': 'suite', 'test': 'test', 'kw': 'keyword'}
+TIME_FORMAT = '%Y%m%d %H:%M:%S.%f'
+MESSAGE_MAX_LENGTH = 4096
+
+def _parse_time(value):
+    if not value or value == 'N/A':
+        return None
+    try:
+        return datetime.datetime.strptime(value, TIME_FORMAT)
+    except ValueError:
+        try:
+            return datetime.datetime.fromisoformat(value)
+        except ValueError:
+            return None
+
+def _set_status(item, elem):
+    item['status'] = elem.get('status')
+    start_time = _parse_time(elem.get('starttime') or elem.get('start'))
+    end_time = _parse_time(elem.get('endtime'))
+    if not end_time and start_time and elem.get('elapsed'):
+        # robot 7 records the elapsed seconds instead of the end time
+        end_time = start_time + datetime.timedelta(seconds=float(elem.get('elapsed')))
+    item['start_time'] = start_time
+    item['end_time'] = end_time
+    if start_time and end_time:
+        item['duration'] = int((end_time - start_time).total_seconds() * 1000)
+    message = (elem.text or '').strip()
+    if message:
+        item['message'] = message[:MESSAGE_MAX_LENGTH]
+
+def iter_output(output_xml, keyword_depth=1):
+    """
+    Yield the suite, test and keyword records from robot's output.xml as their elements end
+
+    The file is parsed incrementally and every element is detached from its parent once it's done,
+    so the memory usage depends on the nesting depth rather than the file size.
+    Keywords nested deeper than keyword_depth are not recorded.
+    """
+    elements = []
+    items = []    # the record of each open element, None for elements other than suite, test and keyword
+    for event, elem in ET.iterparse(output_xml, events=('start', 'end')):
+        if event == 'start':
+            item = None
+            kind = ITEM_KINDS.get(elem.tag)
+            if kind:
+                owner = next((i for i in reversed(items) if i), None)
+                name = elem.get('name', '')
+                depth = 0
+                if kind == 'keyword':
+                    depth = owner['depth'] + 1 if owner and owner['kind'] == 'keyword' else 1
+                item = {
+                    'kind': kind,
+                    'name': name,
+                    'longname': owner['longname'] + '.' + name if owner else name,
+                    'status': None,
+                    'duration': None,
+                    'tags': [],
+                    'depth': depth,
+                }
+            elements.append(elem)
+            items.append(item)
+            continue
+
+        if elem.tag == 'status':
+            if len(items) > 1 and items[-2]:
+                _set_status(items[-2], elem)
+        elif elem.tag == 'tag':
+            owner = next((i for i in reversed(items) if i), None)
+            if owner and elem.text:
+                owner['tags'].append(elem.text)
+        elif items[-1] and items[-1]['depth'] <= keyword_depth:
+            yield items[-1]
+
+        elements.pop()
+        items.pop()
+        if elements:
+            elements[-1].remove(elem)
+
+def iter_output_batches(output_xml, keyword_depth=1, batch_size=1000):
+    """
+    Yield the records of iter_output in lists of at most batch_size
+    """
+    batch = []
+    for record in iter_output(output_xml, keyword_depth):
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def spool_output(output_xml, spool_file, keyword_depth=1, batch_size=1000):
+    """
+    Pickle the records of iter_output_batches one batch after another into the spool file for the caller
+    to load a batch at a time, so that neither this process nor the caller holds all the records.
+    Return (the number of records, the suite and test records with the fields the run time statistics need).
+    It's a module level function without any database dependency so that it can be pickled
+    to run in a worker process.
+    """
+    count = 0
+    summary = []
+    with open(spool_file, 'wb') as f:
+        for batch in iter_output_batches(output_xml, keyword_depth, batch_size):
+            pickle.dump(batch, f, protocol=pickle.HIGHEST_PROTOCOL)
+            count += len(batch)
+            summary.extend({'kind': r['kind'], 'longname': r['longname'], 'duration': r['duration']}
+                           for r in batch if r['kind'] != 'keyword')
+    return count, summary
+
+def load_spooled_batch(f):
+    """
+    Load the next batch pickled by spool_output from the spool file, None at the end
+    """
+    try:
+        return pickle.load(f)
+    except EOFError:
+        return None
+
+def parse_output(output_xml, keyword_depth=1):
+    """
+    Extract all the records of iter_output in a list
+    It's a module level function without any database dependency so that it can be pickled
+    to run in a worker process.
+    """
+    return list(iter_output(output_xml, keyword_depth))
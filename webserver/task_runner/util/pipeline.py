@@ -0,0 +1,145 @@
+import datetime
+
+from bson import ObjectId
+from sanic.log import logger
+
+from app.main.model.database import Pipeline, Task
+from app.main.service.task_service import prepare_tasks, schedule_tasks
+
+NODE_CONDITIONS = ('success', 'failure', 'always')
+NODE_FINISHED = ('successful', 'failed', 'skipped', 'cancelled')
+NODE_SCHEDULE_GRACE = 60    # seconds a task recorded on a node may take to be inserted before it's taken as lost
+
+def sort_nodes(nodes):
+    """
+    Topological order of the node names by Kahn's algorithm, None if the nodes have a cycle
+    """
+    indegree = {n['name']: len(n['depends_on']) for n in nodes}
+    dependents = {n['name']: [] for n in nodes}
+    for n in nodes:
+        for d in n['depends_on']:
+            dependents[d].append(n['name'])
+    ready = [name for name, count in indegree.items() if count == 0]
+    order = []
+    while ready:
+        name = ready.pop(0)
+        order.append(name)
+        for d in dependents[name]:
+            indegree[d] -= 1
+            if indegree[d] == 0:
+                ready.append(d)
+    return order if len(order) == len(nodes) else None
+
+def node_status(statuses):
+    """
+    Status of a node from the statuses of its tasks, a node of parallelized tasks fails if any of them fails
+    """
+    if any(s in ('waiting', 'running') for s in statuses):
+        return 'running'
+    if any(s == 'cancelled' for s in statuses):
+        return 'cancelled'
+    if statuses and all(s == 'successful' for s in statuses):
+        return 'successful'
+    return 'failed'
+
+def is_released(node, states):
+    """
+    Whether the node should run once all of the nodes it depends on have finished, otherwise it's skipped
+    """
+    deps = [states[d] for d in node['depends_on']]
+    if node['condition'] == 'always':
+        return True
+    if node['condition'] == 'failure':
+        return any(s == 'failed' for s in deps)
+    return all(s == 'successful' for s in deps)
+
+async def schedule_node(pipeline, i, node, organization, team):
+    """
+    Schedule the tasks of the i-th node, return an error message if failed.
+    The task ids are recorded on the node before the tasks are queued so that their finishing can't be missed.
+    """
+    err, plan = await prepare_tasks([node['task']], organization, team, pipeline.creator)
+    if err:
+        return err['message']
+    for task, _ in plan[0]:
+        task.id = ObjectId()
+        task.pipeline = pipeline
+        task.pipeline_node = node['name']
+    node['tasks'] = [task.pk for task, _ in plan[0]]
+    await Pipeline.collection.update_one({'_id': pipeline.pk}, {'$set': {f'nodes.{i}.tasks': node['tasks']}})
+    err, _ = await schedule_tasks(plan, organization, team)
+    if err:
+        return err['message']
+    return None
+
+def task_status(statuses, task_id):
+    """
+    Status of a task of a node, a task missing for longer than the scheduling takes was deleted or never inserted
+    """
+    if task_id in statuses:
+        return statuses[task_id]
+    age = datetime.datetime.now(datetime.timezone.utc) - task_id.generation_time
+    return 'waiting' if age.total_seconds() < NODE_SCHEDULE_GRACE else 'failed'
+
+async def advance_pipeline(pipeline_id):
+    """
+    Update the nodes of a pipeline by the statuses of their tasks, then schedule the nodes whose dependencies have finished
+    or skip them if their conditions don't hold, until no more node could be released.
+
+    Every node is claimed atomically by its pending status, so that the pipeline can be advanced by concurrent finishing tasks.
+    """
+    pipeline = await Pipeline.find_one({'_id': pipeline_id})
+    if not pipeline:
+        return
+    nodes = pipeline.nodes
+    organization = await pipeline.organization.fetch()
+    team = await pipeline.team.fetch() if pipeline.team else None
+
+    task_ids = [t for n in nodes if n['status'] == 'running' for t in n['tasks']]
+    statuses = {t['_id']: t['status'] for t in await Task.collection.find({'_id': {'$in': task_ids}}, {'status': 1}).to_list(len(task_ids))}
+    for i, node in enumerate(nodes):
+        # a node just released may have no tasks scheduled yet
+        if node['status'] != 'running' or not node['tasks']:
+            continue
+        status = node_status([task_status(statuses, t) for t in node['tasks']])
+        if status != 'running':
+            await Pipeline.collection.update_one({'_id': pipeline.pk, f'nodes.{i}.status': 'running'}, {'$set': {f'nodes.{i}.status': status}})
+            node['status'] = status
+
+    if pipeline.status != 'running':
+        # cancelled, only the nodes still running are updated
+        return
+
+    lost = False
+    changed = True
+    while changed and not lost:
+        changed = False
+        states = {n['name']: n['status'] for n in nodes}
+        for i, node in enumerate(nodes):
+            if node['status'] != 'pending' or any(states[d] not in NODE_FINISHED for d in node['depends_on']):
+                continue
+            status = 'running' if is_released(node, states) else 'skipped'
+            ret = await Pipeline.collection.update_one({'_id': pipeline.pk, f'nodes.{i}.status': 'pending'}, {'$set': {f'nodes.{i}.status': status}})
+            if ret.modified_count == 0:
+                # released by another finishing task which will go on advancing the pipeline
+                lost = True
+                break
+            node['status'] = status
+            changed = True
+            if status == 'skipped':
+                continue
+
+            err = await schedule_node(pipeline, i, node, organization, team)
+            if err:
+                logger.error(f'Failed to schedule the node {node["name"]} of pipeline {pipeline.pk}: {err}')
+                node['status'] = 'failed'
+                await Pipeline.collection.update_one({'_id': pipeline.pk}, {'$set': {f'nodes.{i}.status': 'failed', f'nodes.{i}.error': err}})
+
+    if lost:
+        # the nodes updated by the other task count for the status as well
+        doc = await Pipeline.collection.find_one({'_id': pipeline.pk}, {'nodes': 1})
+        nodes = doc['nodes'] if doc else nodes
+    update = {'update_date': datetime.datetime.utcnow()}
+    if all(n['status'] in NODE_FINISHED for n in nodes):
+        update['status'] = 'failed' if any(n['status'] in ('failed', 'cancelled') for n in nodes) else 'successful'
+    await Pipeline.collection.update_one({'_id': pipeline.pk, 'status': 'running'}, {'$set': update})
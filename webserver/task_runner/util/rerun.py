@@ -0,0 +1,53 @@
+import asyncio
+import os
+import xml.etree.ElementTree as ET
+
+from sanic.log import logger
+
+from app.main.model.database import RobotResult
+from app.main.util import async_exists
+from app.main.util.get_path import get_test_result_path
+from task_runner.util.indexer import get_process_pool
+from task_runner.util.outputxml import parse_output
+from task_runner.util.shard import merge_outputs
+
+RERUN_OUTPUT = 'rerun.xml'
+
+async def get_failed_test_cases(task):
+    """
+    The failed test cases of a finished task from the robot result store, or from its output.xml if not ingested,
+    eg. a sharded task whose results are ingested by the shards
+    """
+    records = await RobotResult.collection.find({'task': task.pk, 'kind': 'test'}, {'name': 1, 'status': 1}).to_list(None)
+    if not records:
+        output_xml = await get_test_result_path(task) / 'output.xml'
+        if not await async_exists(output_xml):
+            return None
+        loop = asyncio.get_event_loop()
+        try:
+            records = await loop.run_in_executor(get_process_pool(), parse_output, str(output_xml), 0)
+        except ET.ParseError as e:
+            logger.error(f'Failed to parse {output_xml}: {e}')
+            return None
+        records = [r for r in records if r['kind'] == 'test']
+    failed = []
+    for r in records:
+        if r['status'] == 'FAIL' and r['name'] not in failed:
+            failed.append(r['name'])
+    return failed
+
+async def merge_rerun(task, result_dir):
+    """
+    Merge the output of a rerun into the output of the task it reruns, the way of robot's --rerunfailed,
+    the combined output.xml, log.html and report.html replace those of the rerun whose output.xml is kept as rerun.xml
+    """
+    rerun_of = await task.rerun_of.fetch()
+    original = await get_test_result_path(rerun_of) / 'output.xml'
+    output_xml = result_dir / 'output.xml'
+    if not await async_exists(original) or not await async_exists(output_xml):
+        return False
+    await asyncio.get_event_loop().run_in_executor(None, os.replace, output_xml, result_dir / RERUN_OUTPUT)
+    if not await merge_outputs([original, result_dir / RERUN_OUTPUT], result_dir, task.test_suite):
+        await asyncio.get_event_loop().run_in_executor(None, os.replace, result_dir / RERUN_OUTPUT, output_xml)
+        return False
+    return True
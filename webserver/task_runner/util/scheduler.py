@@ -0,0 +1,84 @@
+import datetime
+import heapq
+
+from app.main.model.database import QUEUE_PRIORITY, Task, TaskQueue
+
+class EndpointScheduler:
+    '''
+    In-memory priority scheduler of the tasks queuing on an endpoint, backed by the persisted task queues of the endpoint.
+
+    The task queues are read again only after being woken by a push event rather than on every scan.
+    Tasks are taken from a heap of their priorities aged by the waiting time so that lower priority tasks can't starve.
+    '''
+    def __init__(self, endpoint, organization, team, aging=0):
+        self.endpoint = endpoint
+        self.organization = organization
+        self.team = team
+        self.aging = aging      # priority levels gained per hour of waiting
+        self.heap = []
+        self.taskqueues = {}
+        self.stale = True
+        self.to_delete = False
+        self.released = False
+
+    def wake(self):
+        self.stale = True
+
+    def release(self):
+        '''
+        Stop giving out tasks as the endpoint is served by another instance now
+        '''
+        self.released = True
+
+    def _key(self, priority, enqueue_date):
+        # the aging grows linearly with the waiting time at the same rate for all tasks, so ordering tasks by
+        # their aged priorities at any moment is the same as ordering by priority - aging * enqueue time,
+        # which doesn't change while a task is in the heap
+        return self.aging * enqueue_date.timestamp() / 3600 - priority
+
+    async def refresh(self):
+        self.stale = False
+        taskqueues = await TaskQueue.find({'organization': self.organization.pk, 'team': self.team.pk if self.team else None, 'endpoint': self.endpoint.pk}).to_list(len(QUEUE_PRIORITY))
+        self.taskqueues = {q.pk: q for q in taskqueues}
+        self.to_delete = any(q.to_delete for q in taskqueues)
+
+        ids = [t.pk for q in taskqueues for t in q.tasks]
+        dates = {t['_id']: t.get('schedule_date') for t in await Task.collection.find({'_id': {'$in': ids}}, {'schedule_date': 1}).to_list(len(ids))}
+        now = datetime.datetime.utcnow()
+        self.heap = []
+        for q in taskqueues:
+            enqueue_date = None
+            for seq, t in enumerate(q.tasks):
+                # keep the order of the queue for the tasks of the same priority
+                date = dates.get(t.pk) or now
+                enqueue_date = max(date, enqueue_date) if enqueue_date else date
+                self.heap.append((self._key(q.priority, enqueue_date), seq, t.pk, q.pk))
+        heapq.heapify(self.heap)
+
+    async def pop(self, selector=None):
+        '''
+        Pop the next task, return (task queue, task), task queue is None if no task is ready,
+        task is None if it's gone from the task queue, eg. cancelled.
+
+        With the selector, a task queue selector factory of selector(taskqueue), the task to run is selected by it
+        from the task queue chosen by the heap.
+        '''
+        if self.stale:
+            await self.refresh()
+        if self.to_delete or self.released or not self.heap:
+            return None, None
+
+        _, _, task_id, queue_id = heapq.heappop(self.heap)
+        taskqueue = self.taskqueues[queue_id]
+        select = selector(taskqueue) if selector else None
+        if select:
+            # the selected task may not be the one on top of the heap, rebuild the heap next time
+            self.stale = True
+        else:
+            async def select(tasks):
+                return next((i for i, t in enumerate(tasks) if t.pk == task_id), None)
+        task = await taskqueue.pop(select=select)
+        if task is None:
+            # the task may still be in the persisted queue, eg. the queue lock wasn't acquired, read it again
+            self.stale = True
+        return taskqueue, task
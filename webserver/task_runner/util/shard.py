@@ -0,0 +1,103 @@
+import asyncio
+import datetime
+import statistics
+
+from sanic.log import logger
+
+from app.main.model.database import DurationStat, Task
+from app.main.util import async_exists, async_makedirs
+from app.main.util.fileserve import precompress_files
+from app.main.util.get_path import get_test_result_path
+from task_runner.util.durations import case_duration
+
+FINISHED_STATUS = ('successful', 'failed', 'cancelled')
+
+def split_test_cases(test_cases, durations, shards):
+    """
+    Split the test cases into shards of total durations as even as possible by placing the longest first,
+    test cases never run before are taken as of the mean duration, each shard keeps the original order
+    """
+    known = [d for d in durations.values() if d is not None]
+    fallback = statistics.mean(known) if known else 1
+    weight = {c: durations.get(c) if durations.get(c) is not None else fallback for c in test_cases}
+
+    bins = [[] for _ in range(min(shards, len(test_cases)))]
+    loads = [0] * len(bins)
+    for case in sorted(test_cases, key=lambda c: weight[c], reverse=True):
+        i = loads.index(min(loads))
+        bins[i].append(case)
+        loads[i] += weight[case]
+    order = {c: i for i, c in enumerate(test_cases)}
+    return [sorted(b, key=lambda c: order[c]) for b in bins]
+
+async def merge_outputs(outputs, result_dir, name):
+    """
+    Merge the robot outputs into output.xml, log.html and report.html in the result directory,
+    tests in the later outputs replace those of the same names in the earlier ones
+    """
+    args = ['--merge', '--name', name, '--outputdir', str(result_dir), '--output', 'output.xml', '--nostatusrc', *[str(o) for o in outputs]]
+    p = await asyncio.create_subprocess_exec('rebot', *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+    stdout, _ = await p.communicate()
+    if p.returncode != 0:
+        logger.error(f'Failed to merge the robot outputs into {result_dir}:\n{stdout.decode(errors="replace")}')
+        return False
+    return True
+
+async def split_test_suite(test_suite, test_cases, shards, organization, team):
+    """
+    Split the test cases of a test suite into shards balanced by the durations across all endpoints
+    """
+    durations = {}
+    query = {
+        'organization': organization.pk,
+        'team': team.pk if team else None,
+        'test_suite': test_suite,
+        'endpoint': None
+    }
+    async for s in DurationStat.collection.find(query, {'test_case': 1, 'ewma': 1}):
+        durations[s['test_case']] = s['ewma']
+    # the statistics are keyed by the full names of the test cases
+    return split_test_cases(test_cases, {c: case_duration(durations, c) for c in test_cases}, shards)
+
+async def start_shard(task):
+    """
+    The parent task is running since its first shard starts to run
+    """
+    await Task.collection.update_one({'_id': task.parent.pk, 'status': 'waiting'},
+                                     {'$set': {'status': 'running', 'run_date': task.run_date}})
+
+async def finish_shard(task):
+    """
+    Merge the results of the shards into the parent task with rebot once all of them have finished,
+    return the parent task if it's done by this call
+    """
+    parent = await task.parent.fetch()
+    shards = await Task.find({'parent': parent.pk}).to_list(None)
+    if any(t.status not in FINISHED_STATUS for t in shards):
+        return None
+    # only the last shard to finish gets to merge
+    if not await Task.collection.find_one_and_update({'_id': parent.pk, 'kickedoff': 0}, {'$set': {'kickedoff': 1}}):
+        return None
+
+    result_dir = await get_test_result_path(parent)
+    await async_makedirs(result_dir, exist_ok=True)
+    outputs = []
+    for t in shards:
+        output_xml = await get_test_result_path(t) / 'output.xml'
+        if await async_exists(output_xml):
+            outputs.append(str(output_xml))
+    if outputs and await merge_outputs(outputs, result_dir, parent.test_suite):
+        await precompress_files(result_dir)
+
+    await parent.reload()
+    if parent.status != 'cancelled':
+        if any(t.status == 'cancelled' for t in shards):
+            parent.status = 'cancelled'
+        elif all(t.status == 'successful' for t in shards) and outputs:
+            parent.status = 'successful'
+        else:
+            parent.status = 'failed'
+    run_dates = [t.run_date for t in shards if t.run_date]
+    parent.run_date = min(run_dates) if run_dates else datetime.datetime.utcnow()
+    await parent.commit()
+    return parent